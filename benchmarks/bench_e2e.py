@@ -0,0 +1,177 @@
+import os, sys, json, glob, logging, tempfile, subprocess, time
+from argparse import ArgumentParser
+from bench_utils import KEYEE_DIR, environment, compare
+
+from synthetic_data import build_offline_tokenizer, write_corpus
+
+# configuration
+parser = ArgumentParser(description='Run generate_data.py, one training epoch and eval.py on CPU with a tiny random BART and synthetic data.')
+parser.add_argument('--dataset', default='ace05e', choices=['ace05e', 'ace05ep', 'ere'])
+parser.add_argument('--n_train', type=int, default=500, help='Training sentences')
+parser.add_argument('--n_eval', type=int, default=50, help='Dev and test sentences')
+parser.add_argument('--d_model', type=int, default=64)
+parser.add_argument('--layers', type=int, default=2, help='Encoder and decoder layers')
+parser.add_argument('--heads', type=int, default=2)
+parser.add_argument('--train_batch_size', type=int, default=16)
+parser.add_argument('--eval_batch_size', type=int, default=32)
+parser.add_argument('--max_output_length', type=int, default=64)
+parser.add_argument('--precision', default='fp32', choices=['fp32', 'bf16'], help='Training and generation precision')
+parser.add_argument('--threads', type=int, default=4, help='OMP_NUM_THREADS of every stage')
+parser.add_argument('--seed', type=int, default=42)
+parser.add_argument('--work_dir', help='Directory of the data, model and outputs (default: a temporary directory)')
+parser.add_argument('-o', '--output', default='bench_e2e.json')
+parser.add_argument('--compare', help='Results of an earlier run, stages slower than --threshold times are reported')
+parser.add_argument('--threshold', type=float, default=1.2)
+args = parser.parse_args()
+
+# logger
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(message)s', datefmt='[%Y-%m-%d %H:%M:%S]')
+logger = logging.getLogger(__name__)
+
+work_dir = os.path.abspath(args.work_dir or tempfile.mkdtemp(prefix='keyee_e2e_'))
+data_dir = os.path.join(work_dir, 'data')
+finetune_dir = os.path.join(work_dir, 'finetune')
+model_dir = os.path.join(work_dir, 'tiny-bart')
+output_dir = os.path.join(work_dir, 'output')
+for path in [data_dir, finetune_dir, output_dir]:
+    os.makedirs(path, exist_ok=True)
+
+def build_tiny_bart():
+    """A randomly initialized BART with the offline tokenizer, saved like a pretrained checkpoint."""
+    import torch
+    from transformers import BartConfig, BartForConditionalGeneration
+
+    tokenizer = build_offline_tokenizer(model_dir)
+    model_config = BartConfig(vocab_size=len(tokenizer), d_model=args.d_model, max_position_embeddings=1024,
+                              encoder_layers=args.layers, decoder_layers=args.layers,
+                              encoder_attention_heads=args.heads, decoder_attention_heads=args.heads,
+                              encoder_ffn_dim=args.d_model * 4, decoder_ffn_dim=args.d_model * 4,
+                              pad_token_id=tokenizer.pad_token_id, bos_token_id=tokenizer.bos_token_id,
+                              eos_token_id=tokenizer.eos_token_id, decoder_start_token_id=tokenizer.eos_token_id,
+                              forced_eos_token_id=None)
+    torch.manual_seed(args.seed)
+    BartForConditionalGeneration(model_config).save_pretrained(model_dir)
+    return tokenizer
+
+def corpus_stats(path):
+    sentences, tokens = 0, 0
+    with open(path) as f:
+        for line in f:
+            sentences += 1
+            tokens += len(json.loads(line)['tokens'])
+    return sentences, tokens
+
+def run_stage(name, script, script_args, sentences, tokens, profile_path):
+    """Run one pipeline script and report its wall time, throughput, peak RSS and profiler breakdown."""
+    env = dict(os.environ, OMP_NUM_THREADS=str(args.threads), CUDA_VISIBLE_DEVICES='')
+    log_path = os.path.join(work_dir, f'{name}.log')
+    logger.info(f'Running {name}, log in {log_path}')
+    start = time.perf_counter()
+    with open(log_path, 'w') as log_file:
+        process = subprocess.Popen([sys.executable, os.path.join(KEYEE_DIR, script)] + script_args,
+                                   cwd=work_dir, stdout=log_file, stderr=subprocess.STDOUT, env=env)
+        # wait4 gives the resource usage of this child only
+        _, status, usage = os.wait4(process.pid, 0)
+        # negative for a signal, like subprocess (os.waitstatus_to_exitcode needs Python 3.9)
+        process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    elapsed = time.perf_counter() - start
+    if process.returncode != 0:
+        raise RuntimeError(f'{name} failed with code {process.returncode}, see {log_path}')
+
+    profile_path = profile_path() if callable(profile_path) else profile_path
+    profile = {}
+    if profile_path and os.path.exists(profile_path):
+        with open(profile_path) as f:
+            profile = json.load(f)
+    result = {
+        'time_min': elapsed,
+        'time_mean': elapsed,
+        'items': sentences,
+        'items_per_sec': sentences / elapsed,
+        'tokens': tokens,
+        'tokens_per_sec': tokens / elapsed,
+        'peak_rss_mb': usage.ru_maxrss / 1024.0,
+        'profile': profile,
+    }
+    logger.info(f'{name:15s} {elapsed:9.2f}s {result["items_per_sec"]:10.1f} sentences/s {result["tokens_per_sec"]:10.1f} tokens/s '
+                f'{result["peak_rss_mb"]:9.1f} MB peak RSS')
+    for stage, stats in profile.items():
+        logger.info('    {:28s} {}'.format(stage, ', '.join(['{}: {:.4f}'.format(k, v) if isinstance(v, float) else '{}: {}'.format(k, v)
+                                                            for k, v in stats.items()])))
+    return result
+
+# 1. tiny model and synthetic data
+build_tiny_bart()
+template_file = 'template_ere' if args.dataset == 'ere' else 'template_ace'
+tokenizer = build_offline_tokenizer(os.path.join(work_dir, 'tokenizer'))
+tokenizer.add_tokens(['<Trigger>', '<sep>', '<and>', '<Keyword>', '</Keyword>'])
+splits = {'train': args.n_train, 'dev': args.n_eval, 'test': args.n_eval}
+stats = {}
+for i, (split, n_sentences) in enumerate(splits.items()):
+    path = os.path.join(data_dir, f'{split}.oneie.json')
+    write_corpus(path, n_sentences, tokenizer, template_file=template_file, seed=args.seed + i)
+    stats[split] = corpus_stats(path)
+
+# 2. configuration, the base config of the dataset on CPU with the tiny model
+with open(os.path.join(os.path.dirname(KEYEE_DIR), 'config', f'config_keyee_{args.dataset}.json')) as f:
+    config = json.load(f)
+config.update({
+    'gpu_device': -1,
+    'seed': args.seed,
+    'train_file': os.path.join(data_dir, 'train.oneie.json'),
+    'dev_file': os.path.join(data_dir, 'dev.oneie.json'),
+    'test_file': os.path.join(data_dir, 'test.oneie.json'),
+    'finetune_dir': finetune_dir,
+    'train_finetune_file': os.path.join(finetune_dir, 'train_all.pkl'),
+    'dev_finetune_file': os.path.join(finetune_dir, 'dev_all.pkl'),
+    'test_finetune_file': os.path.join(finetune_dir, 'test_all.pkl'),
+    'keyword_train_finetune_file': os.path.join(finetune_dir, 'train_keywords_all.pkl'),
+    'keyword_dev_finetune_file': os.path.join(finetune_dir, 'dev_keywords_all.pkl'),
+    'keyword_test_finetune_file': os.path.join(finetune_dir, 'test_keywords_all.pkl'),
+    'vocab_file': os.path.join(finetune_dir, 'vocab.json'),
+    'output_dir': output_dir,
+    'cache_dir': work_dir,
+    'model_name': model_dir,
+    'max_epoch': 1,
+    'warmup_epoch': 0,
+    'train_batch_size': args.train_batch_size,
+    'eval_batch_size': args.eval_batch_size,
+    'accumulate_step': 1,
+    'max_length': 1024,
+    'max_output_length': args.max_output_length,
+    'ignore_first_header': False,
+    'profile': True,
+    'precision': args.precision,
+})
+config_path = os.path.join(work_dir, 'config.json')
+with open(config_path, 'w') as f:
+    json.dump(config, f, indent=4)
+
+def train_run_dir():
+    return sorted(glob.glob(os.path.join(output_dir, '*')))[-1]
+
+# 3. the pipeline
+all_sentences = sum(s[0] for s in stats.values())
+all_tokens = sum(s[1] for s in stats.values())
+results = {}
+results['generate_data'] = run_stage('generate_data', 'generate_data.py', ['-c', config_path], all_sentences, all_tokens,
+                                     os.path.join(finetune_dir, 'profile.json'))
+results['train'] = run_stage('train', 'train.py', ['-c', config_path], all_sentences, all_tokens,
+                             lambda: os.path.join(train_run_dir(), 'profile.json'))
+results['eval'] = run_stage('eval', 'eval.py', ['-c', config_path, '-e', os.path.join(train_run_dir(), 'best_model.mdl'), '--no_dev'],
+                            stats['test'][0], stats['test'][1], lambda: os.path.join(train_run_dir(), 'eval_profile.json'))
+
+benchmark_config = dict(vars(args), work_dir=work_dir)
+report = {'environment': environment(), 'config': benchmark_config, 'corpus': stats, 'results': {str(args.n_train): results}}
+with open(args.output, 'w') as f:
+    json.dump(report, f, indent=4)
+logger.info(f'Saved the results to {args.output}')
+
+if args.compare:
+    with open(args.compare) as f:
+        baseline = json.load(f)['results']
+    regressions = compare(report['results'], baseline, args.threshold)
+    for size, name, ratio in regressions:
+        logger.info(f'Regression: {name} at {size} training sentences is {ratio:.2f}x slower than in {args.compare}')
+    if not regressions:
+        logger.info(f'No stage is more than {args.threshold:.2f}x slower than in {args.compare}')
@@ -0,0 +1,112 @@
+import os, json, random, logging, tempfile
+from argparse import ArgumentParser
+from bench_utils import load_tokenizer, environment, measure, compare
+
+from dataset import EEDataset, GenDataset, write_examples
+from template_base import event_template_generator
+from synthetic_data import write_corpus
+from decoding import get_span_idx
+from metrics import cal_scores
+from utils import generate_vocabs
+
+# configuration
+parser = ArgumentParser(description='Time the CPU-side hot paths of the pipeline on synthetic data.')
+parser.add_argument('--sizes', nargs='+', type=int, default=[100, 1000, 5000], help='Corpus sizes (sentences)')
+parser.add_argument('--repeat', type=int, default=3)
+parser.add_argument('--dataset', default='ace05e', choices=['ace05e', 'ere'])
+parser.add_argument('--tokenizer', help='Pretrained tokenizer name or path (default: an offline byte-level BART tokenizer)')
+parser.add_argument('--batch_size', type=int, default=16, help='Batch size of GenDataset.collate_fn')
+parser.add_argument('--seed', type=int, default=42)
+parser.add_argument('--work_dir', help='Directory of the synthetic files (default: a temporary directory)')
+parser.add_argument('-o', '--output', default='bench_hotpaths.json')
+parser.add_argument('--compare', help='Results of an earlier run, benchmarks slower than --threshold times are reported')
+parser.add_argument('--threshold', type=float, default=1.2)
+args = parser.parse_args()
+
+# logger
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(message)s', datefmt='[%Y-%m-%d %H:%M:%S]')
+logger = logging.getLogger(__name__)
+
+template_file = 'template_ace' if args.dataset == 'ace05e' else 'template_ere'
+input_style = ['event_type_sent', 'template']
+output_style = ['trigger:sentence', 'argument:sentence']
+work_dir = args.work_dir or tempfile.mkdtemp(prefix='keyee_bench_')
+os.makedirs(work_dir, exist_ok=True)
+
+def perturb(items, rng):
+    """Drop about a fifth of the gold mentions and add as many wrong ones, as a stand-in for predictions."""
+    preds = []
+    for item in items:
+        kept = [x for x in item if rng.random() > 0.2]
+        kept += [x[:-1] + ('Other',) if isinstance(x[-1], str) else x for x in item if rng.random() < 0.2]
+        preds.append(kept)
+    return preds
+
+def bench_size(tokenizer, size, rng):
+    results = {}
+    def record(name, fn, items):
+        times = measure(fn, args.repeat)
+        results[name] = {'time_min': min(times), 'time_mean': sum(times) / len(times), 'items': items,
+                         'items_per_sec': items / min(times) if min(times) > 0 else 0.0}
+        logger.info(f'{size:>7d} {name:24s} {min(times):9.4f}s {results[name]["items_per_sec"]:12.1f} items/s')
+
+    path = os.path.join(work_dir, f'synthetic.{size}.json')
+    write_corpus(path, size, tokenizer, template_file=template_file, seed=args.seed)
+
+    # EEDataset.load_data
+    data_set = EEDataset(tokenizer, path, max_length=100000)
+    record('load_data', lambda: EEDataset(tokenizer, path, max_length=100000), len(data_set))
+    vocab = generate_vocabs([data_set])
+    instances = list(data_set)
+
+    # event_template_generator construction
+    make_generators = lambda: [event_template_generator(template_file, d.tokens, d.triggers, d.roles, input_style, output_style, vocab, True) for d in instances]
+    generators = make_generators()
+    record('template_generator', make_generators, len(generators))
+
+    templates = [(i, t) for i, g in enumerate(generators) for t in g.event_templates]
+    record('keywords_output_str', lambda: [t.generate_keywords_output_str() for _, t in templates], len(templates))
+
+    # gold outputs stand in for generated text
+    outputs = [(i, t, pair[1], keyword_pair[1]) for i, g in enumerate(generators)
+               for t, pair, keyword_pair in zip(g.event_templates, g.data, g.keyword_data)]
+    record('decode', lambda: [t.decode(o) for _, t, o, _ in outputs], len(outputs))
+    record('decode_keywords', lambda: [t.decode_keywords(k) for _, t, _, k in outputs], len(outputs))
+
+    spans = [(i, t, obj[0]) for i, t, o, _ in outputs for obj in t.decode(o)]
+    record('predstr2span', lambda: [t.predstr2span(s) for _, t, s in spans], len(spans))
+    record('get_span_idx', lambda: [get_span_idx(instances[i].piece_idxs, instances[i].token_start_idxs, s, tokenizer) for i, _, s in spans], len(spans))
+
+    # GenDataset.collate_fn
+    gen_path = os.path.join(work_dir, f'synthetic.{size}.pkl')
+    write_examples(gen_path, [x[0] for g in generators for x in g.data], [x[1] for g in generators for x in g.data],
+                   [(x[2], x[4], x[5]) for g in generators for x in g.data])
+    gen_set = GenDataset(tokenizer, 100000, gen_path, 100000, device='cpu')
+    examples = list(gen_set)
+    batches = [examples[i:i + args.batch_size] for i in range(0, len(examples), args.batch_size)]
+    record('collate_fn', lambda: [gen_set.collate_fn(batch) for batch in batches], len(gen_set))
+
+    # cal_scores
+    pred_triggers = perturb(data_set.gold_triggers, rng)
+    pred_roles = perturb(data_set.gold_roles, rng)
+    record('cal_scores', lambda: cal_scores(data_set.gold_triggers, pred_triggers, data_set.gold_roles, pred_roles), len(data_set))
+    return results
+
+tokenizer = load_tokenizer(args.tokenizer, work_dir)
+results = {}
+for size in args.sizes:
+    results[str(size)] = bench_size(tokenizer, size, random.Random(args.seed))
+
+report = {'environment': environment(), 'config': vars(args), 'results': results}
+with open(args.output, 'w') as f:
+    json.dump(report, f, indent=4)
+logger.info(f'Saved the results to {args.output}')
+
+if args.compare:
+    with open(args.compare) as f:
+        baseline = json.load(f)['results']
+    regressions = compare(results, baseline, args.threshold)
+    for size, name, ratio in regressions:
+        logger.info(f'Regression: {name} at size {size} is {ratio:.2f}x slower than in {args.compare}')
+    if not regressions:
+        logger.info(f'No benchmark is more than {args.threshold:.2f}x slower than in {args.compare}')
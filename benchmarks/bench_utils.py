@@ -0,0 +1,59 @@
+import os, sys, json, time, platform, subprocess
+
+# the keyee scripts import each other by module name
+KEYEE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'keyee')
+if KEYEE_DIR not in sys.path:
+    sys.path.insert(0, KEYEE_DIR)
+
+from synthetic_data import build_offline_tokenizer, SPECIAL_TOKENS
+
+def load_tokenizer(name_or_path, cache_dir):
+    """A pretrained tokenizer (name or path) with the project's special tokens, or the offline one when `name_or_path` is None."""
+    from transformers import AutoTokenizer
+
+    if name_or_path is None:
+        name_or_path = os.path.join(cache_dir, 'offline_tokenizer')
+        if not os.path.exists(os.path.join(name_or_path, 'tokenizer.json')):
+            build_offline_tokenizer(name_or_path)
+    tokenizer = AutoTokenizer.from_pretrained(name_or_path)
+    tokenizer.add_tokens(SPECIAL_TOKENS)
+    return tokenizer
+
+def environment():
+    """Versions and commit the results were measured with."""
+    import torch, transformers
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=KEYEE_DIR, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ''
+    return {
+        'commit': commit,
+        'time': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime()),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'torch': torch.__version__,
+        'transformers': transformers.__version__,
+        'torch_threads': torch.get_num_threads(),
+    }
+
+def measure(fn, repeat):
+    """Run `fn` `repeat` times and return the wall times."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return times
+
+def compare(results, baseline, threshold):
+    """Benchmarks whose best time is more than `threshold` times slower than in `baseline`."""
+    regressions = []
+    for size, benches in results.items():
+        for name, stats in benches.items():
+            old = baseline.get(size, {}).get(name)
+            if old is None or old['time_min'] <= 0:
+                continue
+            ratio = stats['time_min'] / old['time_min']
+            if ratio > threshold:
+                regressions.append((size, name, ratio))
+    return regressions
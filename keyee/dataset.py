@@ -1,7 +1,11 @@
 import torch
-import json, logging, pickle
+import os, sys, json, struct, random, logging, pickle
+from array import array
+from bisect import bisect_left
+from itertools import accumulate
+from functools import lru_cache
 from tqdm import tqdm
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler
 from collections import namedtuple
 from utils import pad_sequence_to_length
 
@@ -21,133 +25,148 @@ def remove_overlap_entities(entities):
     :param entities (list): a list of entity mentions.
     :return: processed entity mentions and a table of mapped IDs.
     """
-    tokens = [None] * 1000
+    # the kept entities never overlap, so their spans are disjoint and sorted by start, the
+    # entity overlapping a span that starts last holds the last taken token of the span
+    starts, ends, ids = [], [], []
     entities_ = []
     id_map = {}
     for entity in entities:
         start, end = entity['start'], entity['end']
-        break_flag = False
-        for i in range(start, end):
-            if tokens[i]:
-                id_map[entity['id']] = tokens[i]
-                break_flag = True
-        if break_flag:
+        i = bisect_left(starts, end) - 1
+        if start < end and i >= 0 and ends[i] > start:
+            id_map[entity['id']] = ids[i]
             continue
         entities_.append(entity)
-        for i in range(start, end):
-            tokens[i] = entity['id']
+        if start < end:
+            i = bisect_left(starts, start)
+            starts.insert(i, start)
+            ends.insert(i, end)
+            ids.insert(i, entity['id'])
     return entities_, id_map
 
 def get_role_list(entities, events, id_map):
     entity_idxs = {entity['id']: (i,entity) for i, entity in enumerate(entities)}
-    visited = [[0] * len(entities) for _ in range(len(events))]
-    role_list = []
+    visited = set()
     role_list = []
     for i, event in enumerate(events):
         for arg in event['arguments']:
             entity_idx = entity_idxs[id_map.get(arg['entity_id'], arg['entity_id'])]
             
             # This will automatically remove multi role scenario
-            if visited[i][entity_idx[0]] == 0:
+            if (i, entity_idx[0]) not in visited:
                 # ((trigger start, trigger end, trigger type), (argument start, argument end, role type))
                 temp = ((event['trigger']['start'], event['trigger']['end'], event['event_type']),
                         (entity_idx[1]['start'], entity_idx[1]['end'], arg['role']))
                 role_list.append(temp)
-                visited[i][entity_idx[0]] = 1
+                visited.add((i, entity_idx[0]))
     role_list.sort(key=lambda x: (x[0][0], x[1][0]))
     return role_list
 
 class EEDataset(Dataset):
+    """
+    Sentences of a OneIE JSONL file. The file is parsed line by line into flat columns: the
+    tokens, pieces and piece ids of all the instances are concatenated and sliced with
+    per-instance offsets, and the JSON dicts are dropped once converted, so memory grows
+    with the size of the data only. `self[i]` builds the `EEInstance` of a sentence.
+    """
     def __init__(self, tokenizer, path, max_length=128, fair_compare=True):
         self.tokenizer = tokenizer
         self.path = path
-        self.data = []
-        self.insts = []
         self.max_length = max_length
         self.fair_compare = fair_compare
+        self.doc_ids = []
+        self.wnd_ids = []
+        self.tokens = []
+        self.pieces = []
+        self.piece_idxs = array('i')
+        self.token_lens = array('i')
+        # len(tokens) + 1 entries per instance, the start of instance i is token_offsets[i] + i
+        self.token_start_idxs = array('i')
+        self.token_offsets = array('q', [0])
+        self.piece_offsets = array('q', [0])
         self.gold_triggers = []
         self.gold_roles = []
+        self.event_type_set = set()
+        self.role_type_set = set()
         self.load_data()
 
     def __len__(self):
-        return len(self.data)
+        return len(self.wnd_ids)
 
     def __getitem__(self, item):
-        return self.data[item]
-
-    @property
-    def event_type_set(self):
-        type_set = set()
-        for inst in self.insts:
-            for event in inst['event_mentions']:
-                type_set.add(event['event_type'])
-        return type_set
+        if item < 0:
+            item += len(self)
+        if not 0 <= item < len(self):
+            raise IndexError('EEDataset index out of range')
+        token_start, token_end = self.token_offsets[item], self.token_offsets[item + 1]
+        piece_start, piece_end = self.piece_offsets[item], self.piece_offsets[item + 1]
+        return EEInstance(
+            doc_id=self.doc_ids[item],
+            wnd_id=self.wnd_ids[item],
+            tokens=self.tokens[token_start:token_end],
+            pieces=self.pieces[piece_start:piece_end],
+            piece_idxs=self.piece_idxs[piece_start:piece_end].tolist(),
+            token_lens=self.token_lens[token_start:token_end].tolist(),
+            token_start_idxs=self.token_start_idxs[token_start + item:token_end + item + 1].tolist(),
+            triggers=self.gold_triggers[item],
+            roles=self.gold_roles[item],
+        )
 
-    @property
-    def role_type_set(self):
-        type_set = set()
-        for inst in self.insts:
-            for event in inst['event_mentions']:
-                for arg in event['arguments']:
-                    type_set.add(arg['role'])
-        return type_set
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
 
     def load_data(self):
+        line_num = 0
         with open(self.path, 'r', encoding='utf-8') as fp:
-            lines = fp.readlines()
-        self.insts = []
-        for line in lines:
-            inst = json.loads(line)
-            inst_len = len(inst['pieces'])
-            if inst_len > self.max_length:
-                continue
-            self.insts.append(inst)
-
-        for inst in tqdm(self.insts):
-            doc_id = inst['doc_id']
-            wnd_id = inst['wnd_id']
-            tokens = inst['tokens']
-            pieces = inst['pieces']
-            
-            entities = inst['entity_mentions']
-            if self.fair_compare:
-                entities, entity_id_map = remove_overlap_entities(entities)
-            else:
-                entities = entities
-                entity_id_map = {}
-                
-            events = inst['event_mentions']
-            events.sort(key=lambda x: x['trigger']['start'])
-            
-            token_num = len(tokens)
-            token_lens = inst['token_lens']
-            
-            piece_idxs = self.tokenizer.convert_tokens_to_ids(pieces)
-            assert sum(token_lens) == len(piece_idxs)
-                        
-            triggers = [(e['trigger']['start'], e['trigger']['end'], e['event_type']) for e in events]
-            no_duplicated_triggers = set(triggers)
-            assert len(triggers) == len(no_duplicated_triggers)
-            roles = get_role_list(entities, events, entity_id_map)
-            
-            token_start_idxs = [sum(token_lens[:_]) for _ in range(len(token_lens))] + [sum(token_lens)]
-
-            instance = EEInstance(
-                doc_id=doc_id,
-                wnd_id=wnd_id,
-                tokens=tokens,
-                pieces=pieces,
-                piece_idxs=piece_idxs,
-                token_lens=token_lens,
-                token_start_idxs=token_start_idxs,
-                triggers=triggers,
-                roles=roles,
-            )
-            self.data.append(instance)
-            self.gold_triggers.append(triggers)
-            self.gold_roles.append(roles)
-            
-        logger.info(f'Loaded {len(self)}/{len(lines)} instances from {self.path}')
+            for line in tqdm(fp):
+                line_num += 1
+                inst = json.loads(line)
+                if len(inst['pieces']) > self.max_length:
+                    continue
+                self.add_instance(inst)
+        logger.info(f'Loaded {len(self)}/{line_num} instances from {self.path}')
+
+    def add_instance(self, inst):
+        tokens = inst['tokens']
+        pieces = inst['pieces']
+
+        entities = inst['entity_mentions']
+        if self.fair_compare:
+            entities, entity_id_map = remove_overlap_entities(entities)
+        else:
+            entities = entities
+            entity_id_map = {}
+
+        events = inst['event_mentions']
+        events.sort(key=lambda x: x['trigger']['start'])
+
+        token_lens = inst['token_lens']
+
+        piece_idxs = self.tokenizer.convert_tokens_to_ids(pieces)
+        assert sum(token_lens) == len(piece_idxs)
+
+        triggers = [(e['trigger']['start'], e['trigger']['end'], e['event_type']) for e in events]
+        no_duplicated_triggers = set(triggers)
+        assert len(triggers) == len(no_duplicated_triggers)
+        roles = get_role_list(entities, events, entity_id_map)
+
+        for event in events:
+            self.event_type_set.add(event['event_type'])
+            self.role_type_set.update(arg['role'] for arg in event['arguments'])
+
+        # words and pieces repeat across sentences, interned they are stored once
+        self.doc_ids.append(sys.intern(inst['doc_id']))
+        self.wnd_ids.append(inst['wnd_id'])
+        self.tokens.extend(map(sys.intern, tokens))
+        self.pieces.extend(map(sys.intern, pieces))
+        self.piece_idxs.extend(piece_idxs)
+        self.token_lens.extend(token_lens)
+        self.token_start_idxs.extend(accumulate(token_lens, initial=0))
+        self.token_offsets.append(len(self.tokens))
+        self.piece_offsets.append(len(self.pieces))
+        self.gold_triggers.append(triggers)
+        self.gold_roles.append(roles)
 
     def collate_fn(self, batch):
         tokens = [inst.tokens for inst in batch]
@@ -170,29 +189,225 @@ class EEDataset(Dataset):
             wnd_ids=wnd_ids,
         )
 
+RECORD_MAGIC = b'KEYEEREC'
+
+class ExampleWriter(object):
+    """
+    Writes finetune examples to a record file. A record is the pickled examples of one
+    sentence: its passage and, per example, the id of its prompt, its target and its info.
+    An input is the passage followed by the prompt of its event type, so both are stored
+    once. The header (prompt table and offset index) is written after the records and its
+    offset is the last 8 bytes of the file.
+    """
+    def __init__(self, path):
+        self.file = open(path, 'wb')
+        self.file.write(RECORD_MAGIC)
+        self.prompts = {}
+        self.event_types = {}
+        self.offsets = array('q', [len(RECORD_MAGIC)])
+        self.doc_ids = []
+        # per example: its record, its position in the record, its event type and whether it is a negative
+        self.record = array('i')
+        self.position = array('i')
+        self.event_type = array('i')
+        self.negative = array('b')
+
+    def __len__(self):
+        return len(self.record)
+
+    def add_record(self, doc_id, passage, examples):
+        """`examples` are the (prompt, target, info, negative) of the examples of one sentence."""
+        # equal targets and keyword spans of the sentence are pickled once
+        shared = {}
+        def share(value):
+            return shared.setdefault(tuple(value) if isinstance(value, list) else value, value)
+
+        rows = []
+        for position, (prompt, target, info, negative) in enumerate(examples):
+            if isinstance(info, tuple) and isinstance(info[0], list) and all(isinstance(span, tuple) for span in info[0]):
+                info = (share(info[0]),) + info[1:]
+            rows.append((self.prompts.setdefault(prompt, len(self.prompts)), share(target), info))
+            event_type = info[1] if isinstance(info, tuple) else info['event type']
+            self.event_type.append(self.event_types.setdefault(event_type, len(self.event_types)))
+            self.record.append(len(self.doc_ids))
+            self.position.append(position)
+            self.negative.append(bool(negative))
+        self.file.write(pickle.dumps((passage, rows), protocol=pickle.HIGHEST_PROTOCOL))
+        self.offsets.append(self.file.tell())
+        self.doc_ids.append(doc_id)
+
+    def add_examples(self, doc_id, inputs, targets, infos, negatives=None):
+        """Add the examples made by generate_data.py of one document, those of a sentence are consecutive."""
+        key, examples = None, []
+        for i, (input_str, target, info) in enumerate(zip(inputs, targets, infos)):
+            passage = ' '.join(info[2]) if isinstance(info, tuple) else ''
+            if not input_str.startswith(passage):
+                passage = ''
+            if passage != key and examples:
+                self.add_record(doc_id, key, examples)
+                examples = []
+            key = passage
+            examples.append((input_str[len(passage):], target, info, negatives[i] if negatives is not None else False))
+        if examples:
+            self.add_record(doc_id, key, examples)
+
+    def close(self):
+        header_offset = self.file.tell()
+        pickle.dump({
+            'prompts': list(self.prompts),
+            'event_types': list(self.event_types),
+            'offsets': self.offsets,
+            'doc_ids': self.doc_ids,
+            'record': self.record,
+            'position': self.position,
+            'event_type': self.event_type,
+            'negative': self.negative,
+        }, self.file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.file.write(struct.pack('<q', header_offset))
+        self.file.close()
+
+def write_examples(path, inputs, targets, infos, doc_ids=None, negatives=None):
+    """Write the examples made by generate_data.py, the examples of a sentence are consecutive."""
+    writer = ExampleWriter(path)
+    doc_ids = doc_ids if doc_ids is not None else [None] * len(inputs)
+    start = 0
+    for end in range(1, len(inputs) + 1):
+        if end == len(inputs) or doc_ids[end] != doc_ids[start]:
+            writer.add_examples(doc_ids[start], inputs[start:end], targets[start:end], infos[start:end],
+                                negatives[start:end] if negatives is not None else None)
+            start = end
+    writer.close()
+    return len(writer)
+
+def read_header(path):
+    """The header of a record file, None for the single pickles written by earlier versions."""
+    with open(path, 'rb') as f:
+        if f.read(len(RECORD_MAGIC)) != RECORD_MAGIC:
+            return None
+        f.seek(-8, os.SEEK_END)
+        f.seek(struct.unpack('<q', f.read(8))[0])
+        return pickle.load(f)
+
+def subset_examples(path, output_path, doc_ids):
+    """Copy the records of the documents in `doc_ids` to a new record file and return the number of examples."""
+    header = read_header(path)
+    offsets = header['offsets']
+    negative = header.get('negative') or array('b', bytes(len(header['record'])))
+    writer = ExampleWriter(output_path)
+    with open(path, 'rb') as f:
+        for record, doc_id in enumerate(header['doc_ids']):
+            if doc_id in doc_ids:
+                f.seek(offsets[record])
+                passage, rows = pickle.loads(f.read(offsets[record + 1] - offsets[record]))
+                # the examples of a record are consecutive
+                first = bisect_left(header['record'], record)
+                writer.add_record(doc_id, passage, [(header['prompts'][prompt_id], target, info, negative[first + i])
+                                                    for i, (prompt_id, target, info) in enumerate(rows)])
+    writer.close()
+    return len(writer)
+
+class GenInstance(object):
+    """
+    A generated example, its input is rebuilt from the shared passage and prompt when read.
+    `info` is (gold events or keyword spans, event type, tokens) of its sentence.
+    """
+    __slots__ = ['passage', 'prompt', 'target', 'info']
+
+    def __init__(self, passage, prompt, target, info):
+        self.passage = passage
+        self.prompt = prompt
+        self.target = target
+        self.info = info
+
+    @property
+    def input(self):
+        return self.passage + self.prompt
+
 class GenDataset(Dataset):
-    def __init__(self, tokenizer, max_length, path, max_output_length=None, unseen_types=[], no_bos=False):
+    """
+    Finetune examples of generate_data.py. Record files are read on demand: only the header
+    is loaded up front and the records of the requested examples are read from the file,
+    the last `cache_size` of them are kept. Single pickles of earlier versions are loaded
+    whole into `self.data`.
+    """
+    def __init__(self, tokenizer, max_length, path, max_output_length=None, unseen_types=[], no_bos=False, device='cuda', cache_size=1024):
         self.tokenizer = tokenizer
+        self.device = device
         self.max_length = self.max_output_length = max_length
         if max_output_length is not None:
             self.max_output_length = max_output_length
         self.path = path
         self.no_bos = no_bos # if you use bart, then this should be False; if you use t5, then this should be True
+        self.cache_size = cache_size
         self.data = []
+        self.header = None
+        self.fd = None
+        self.cached_record = None
         self.load_data(unseen_types)
         # self.data = self.data[:100] # FOR DEBUG
 
     def __len__(self):
-        return len(self.data)
+        return len(self.index) if self.header is not None else len(self.data)
 
     def __getitem__(self, item):
-        return self.data[item]
+        if self.header is None:
+            return self.data[item]
+        if self.cached_record is None:
+            self.cached_record = lru_cache(maxsize=self.cache_size)(self.read_record)
+        example = self.index[item]
+        return self.cached_record(self.header['record'][example])[self.header['position'][example]]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getstate__(self):
+        # the file is opened again and the cache is rebuilt in other processes
+        state = dict(self.__dict__)
+        state['fd'] = None
+        state['cached_record'] = None
+        return state
+
+    def pairs_with(self, other):
+        """Whether example i of this dataset and of `other` are of the same sentence and event type, for every i."""
+        if self.header is None or other.header is None or len(self) != len(other):
+            return False
+        keys = lambda data_set: [(data_set.header['record'][e], data_set.header['event_types'][data_set.header['event_type'][e]])
+                                 for e in data_set.index]
+        return keys(self) == keys(other)
+
+    def read_record(self, record):
+        if self.fd is None:
+            self.fd = os.open(self.path, os.O_RDONLY)
+        offsets = self.header['offsets']
+        passage, rows = pickle.loads(os.pread(self.fd, offsets[record + 1] - offsets[record], offsets[record]))
+        prompts = self.header['prompts']
+        return [GenInstance(passage, prompts[prompt_id], target, info) for prompt_id, target, info in rows]
 
     def load_data(self, unseen_types):
+        self.header = read_header(self.path)
+        if self.header is None:
+            self.load_pickle(unseen_types)
+            return
+        event_types = self.header['event_types']
+        if len(unseen_types) > 0:
+            self.index = array('i', [i for i, t in enumerate(self.header['event_type']) if event_types[t] not in unseen_types])
+        else:
+            self.index = array('i', range(len(self.header['event_type'])))
+        logger.info(f'Indexed {len(self)} instances in {len(self.header["doc_ids"])} records of {self.path}')
+
+    def load_pickle(self, unseen_types):
         with open(self.path, 'rb') as f:
             data = pickle.load(f)
 
-        for l_in, l_out, l_info in zip(data['input'], data['target'], data['all']):
+        # every event type of a sentence gives an example, equal token lists, keyword spans
+        # and targets (e.g. of the negative examples) are kept once
+        shared = {}
+        def intern(value):
+            return shared.setdefault(tuple(value) if isinstance(value, list) else value, value)
+
+        # single pickles keep the whole input
+        for input_str, l_out, l_info in zip(data['input'], data['target'], data['all']):
             if len(unseen_types) > 0:
                 if isinstance(l_info, tuple):
                     # instance base
@@ -202,16 +417,17 @@ class GenDataset(Dataset):
                     # trigger base, used in argument model
                     if l_info['event type'] in unseen_types:
                         continue
-            self.data.append({
-                'input': l_in,
-                'target': l_out,
-                'info': l_info
-            })
+            if isinstance(l_info, tuple):
+                gold, event_type, tokens = l_info
+                if isinstance(gold, list) and all(isinstance(span, tuple) for span in gold):
+                    gold = intern(gold)
+                l_info = (gold, sys.intern(event_type), intern(tokens))
+            self.data.append(GenInstance(input_str, '', intern(l_out), l_info))
         logger.info(f'Loaded {len(self)} instances from {self.path}')
 
     def collate_fn(self, batch):
-        input_text = [x['input'] for x in batch]
-        target_text = [x['target'] for x in batch]
+        input_text = [x.input for x in batch]
+        target_text = [x.target for x in batch]
 
         # encoder inputs
         inputs = self.tokenizer(input_text, return_tensors='pt', padding=True, max_length=self.max_length)
@@ -232,12 +448,12 @@ class GenDataset(Dataset):
         lbl_attn = torch.cat((dec_attn[:, 1:], torch.zeros((batch_size, 1), dtype=torch.long)), dim=1)
         lbl_idxs = raw_lbl_idxs.masked_fill(lbl_attn==0, -100) # ignore padding
         
-        enc_idxs = enc_idxs.cuda()
-        enc_attn = enc_attn.cuda()
-        dec_idxs = dec_idxs.cuda()
-        dec_attn = dec_attn.cuda()
-        raw_lbl_idxs = raw_lbl_idxs.cuda()
-        lbl_idxs = lbl_idxs.cuda()
+        enc_idxs = enc_idxs.to(self.device)
+        enc_attn = enc_attn.to(self.device)
+        dec_idxs = dec_idxs.to(self.device)
+        dec_attn = dec_attn.to(self.device)
+        raw_lbl_idxs = raw_lbl_idxs.to(self.device)
+        lbl_idxs = lbl_idxs.to(self.device)
         
         return GenBatch(
             input_text=input_text,
@@ -248,5 +464,85 @@ class GenDataset(Dataset):
             dec_attn=dec_attn,
             lbl_idxs=lbl_idxs,
             raw_lbl_idxs=raw_lbl_idxs,
-            infos=[x['info'] for x in batch]
-        )
\ No newline at end of file
+            infos=[x.info for x in batch]
+        )
+
+class NegativeSampler(Sampler):
+    """
+    The training examples of an epoch: every positive example and, per sentence, `n_negative`
+    of its negative examples drawn anew, in random order. `schedule` lists n_negative per
+    epoch (from epoch 1, the last value is kept for the later epochs). With `num_replicas`
+    processes every process gets its part, as with DistributedSampler. Datasets without
+    negative flags (single pickles of earlier versions) are shuffled whole.
+
+    After `set_hardness`, the negatives of a sentence are drawn with weights that favor the
+    ones the model gets wrong.
+    """
+    def __init__(self, data_set, n_negative, schedule=None, seed=0, num_replicas=1, rank=0):
+        self.n_negative = n_negative
+        self.schedule = schedule
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 1
+        self.weights = None
+        self.positives = []
+        # dataset indices of the negatives, per sentence
+        self.negatives = []
+        header = data_set.header
+        if header is None or header.get('negative') is None:
+            self.positives = list(range(len(data_set)))
+            return
+        groups = {}
+        for i, example in enumerate(data_set.index):
+            if header['negative'][example]:
+                groups.setdefault(header['record'][example], []).append(i)
+            else:
+                self.positives.append(i)
+        self.negatives = list(groups.values())
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def set_hardness(self, hardness, uniform=0.5):
+        """
+        `hardness` maps the dataset index of every negative to e.g. its loss. A negative is then
+        drawn with weight `uniform` + (1 - `uniform`) * hardness / mean hardness, so `uniform`
+        keeps some of the easy ones in every epoch.
+        """
+        mean = sum(hardness.values()) / max(len(hardness), 1)
+        self.weights = {i: max(uniform + (1 - uniform) * h / mean if mean > 0 else 1.0, 1e-6) for i, h in hardness.items()}
+
+    def negatives_per_sentence(self, epoch):
+        if not self.schedule:
+            return self.n_negative
+        return self.schedule[min(max(epoch, 1), len(self.schedule)) - 1]
+
+    def total_size(self, epoch):
+        """Number of examples of `epoch` over all the processes."""
+        n_negative = self.negatives_per_sentence(epoch)
+        return len(self.positives) + sum(min(len(group), n_negative) for group in self.negatives)
+
+    def __len__(self):
+        return (self.total_size(self.epoch) + self.num_replicas - 1) // self.num_replicas
+
+    def __iter__(self):
+        rng = random.Random(self.seed + self.epoch)
+        n_negative = self.negatives_per_sentence(self.epoch)
+        indices = list(self.positives)
+        for group in self.negatives:
+            if len(group) <= n_negative:
+                indices.extend(group)
+            elif self.weights is None:
+                indices.extend(rng.sample(group, n_negative))
+            else:
+                # weighted sampling without replacement (Efraimidis and Spirakis)
+                keys = {i: rng.random() ** (1.0 / self.weights[i]) for i in group}
+                indices.extend(sorted(group, key=keys.get, reverse=True)[:n_negative])
+        rng.shuffle(indices)
+
+        # repeat a few examples so that every process gets as many
+        total = len(self) * self.num_replicas
+        while len(indices) < total:
+            indices += indices[:total - len(indices)]
+        return iter(indices[self.rank:total:self.num_replicas])
@@ -0,0 +1,178 @@
+import sys
+import numpy as np
+import torch
+from utils import Profiler
+
+NO_PROFILER = Profiler(enabled=False)
+
+def get_span_idx(pieces, token_start_idxs, span, tokenizer, trigger_span=None):
+    """
+    This function is how we map the generated prediction back to span prediction.
+
+    Detailed Explanation:
+        We will first split our prediction and use tokenizer to tokenize our predicted "span" into pieces. Then, we will find whether we can find a continuous span in the original "pieces" can match tokenized "span".
+
+    If it is an argument/relation extraction task, we will return the one which is closest to the trigger_span.
+    """
+    words = []
+    for s in span.split(' '):
+        words.extend(tokenizer.encode(s, add_special_tokens=False))
+
+    candidates = []
+    for i in range(len(pieces)):
+        j = 0
+        k = 0
+        while j < len(words) and i+k < len(pieces):
+            if pieces[i+k] == words[j]:
+                j += 1
+                k += 1
+            elif tokenizer.decode(words[j]) == "":
+                j += 1
+            elif tokenizer.decode(pieces[i+k]) == "":
+                k += 1
+            else:
+                break
+        if j == len(words):
+            candidates.append((i, i+k))
+
+    candidates = [(token_start_idxs.index(c1), token_start_idxs.index(c2)) for c1, c2 in candidates if c1 in token_start_idxs and c2 in token_start_idxs]
+    if len(candidates) < 1:
+        return -1, -1
+    else:
+        if trigger_span is None:
+            return candidates[0]
+        else:
+            return sorted(candidates, key=lambda x: np.abs(trigger_span[0]-x[0]))[0]
+
+def get_span_idx_tri(pieces, token_start_idxs, span, tokenizer, trigger_span=None):
+    """
+    This function is how we map the generated prediction back to span prediction.
+
+    Detailed Explanation:
+        We will first split our prediction and use tokenizer to tokenize our predicted "span" into pieces. Then, we will find whether we can find a continuous span in the original "pieces" can match tokenized "span".
+
+    If it is an argument/relation extraction task, we will return the one which is closest to the trigger_span.
+    """
+    words = []
+    for s in span.split(' '):
+        words.extend(tokenizer.encode(s, add_special_tokens=False))
+
+    candidates = []
+    for i in range(len(pieces)):
+        j = 0
+        k = 0
+        while j < len(words) and i+k < len(pieces):
+            if pieces[i+k] == words[j]:
+                j += 1
+                k += 1
+            elif tokenizer.decode(words[j]) == "":
+                j += 1
+            elif tokenizer.decode(pieces[i+k]) == "":
+                k += 1
+            else:
+                break
+        if j == len(words):
+            candidates.append((i, i+k))
+
+    candidates = [(token_start_idxs.index(c1), token_start_idxs.index(c2)) for c1, c2 in candidates if c1 in token_start_idxs and c2 in token_start_idxs]
+    if len(candidates) < 1:
+        return [(-1, -1)]
+    else:
+        if trigger_span is None:
+            return candidates
+        else:
+            return sorted(candidates, key=lambda x: np.abs(trigger_span[0]-x[0]))
+
+def encode_prompts(tokenizer, batch, vocab, template_file, config):
+    """
+    Build and tokenize the input prompt of every event type for the sentences of an EEBatch.
+
+    The result only depends on the data and the config, so it can be computed once and
+    reused, e.g. when several checkpoints are evaluated on the same set.
+    """
+    encoded = {}
+    for event_type in vocab['event_type_itos']:
+        theclass = getattr(sys.modules[template_file], event_type.replace(':', '_').replace('-', '_'), False)
+
+        inputs = []
+        for tokens in batch.tokens:
+            template = theclass(config.input_style, config.output_style, tokens, event_type)
+            inputs.append(template.generate_input_str(''))
+
+        inputs = tokenizer(inputs, return_tensors='pt', padding=True, max_length=config.max_length)
+        encoded[event_type] = (inputs['input_ids'], inputs['attention_mask'])
+    return encoded
+
+def predict_batch(model, tokenizer, batch, vocab, template_file, config, device='cuda', encoded=None, profiler=NO_PROFILER):
+    """
+    Run the event-type prompts of every sentence in an EEBatch through the model and map
+    the generated text back to token spans. `encoded` can be the output of `encode_prompts`
+    for this batch to skip building and tokenizing the prompts.
+
+    Returns three lists aligned with `batch.tokens`: predicted triggers
+    (start, end, event type), predicted roles ((trigger), (start, end, role type)) and the
+    raw generated text for each event type.
+    """
+    if encoded is None:
+        with profiler.timer('prompt'):
+            encoded = encode_prompts(tokenizer, batch, vocab, template_file, config)
+
+    p_triggers = [[] for _ in range(len(batch.tokens))]
+    p_roles = [[] for _ in range(len(batch.tokens))]
+    p_texts = [[] for _ in range(len(batch.tokens))]
+    for event_type in vocab['event_type_itos']:
+        theclass = getattr(sys.modules[template_file], event_type.replace(':', '_').replace('-', '_'), False)
+        enc_idxs = encoded[event_type][0].to(device)
+        enc_attn = encoded[event_type][1].to(device)
+
+        with profiler.timer('generate'), torch.no_grad():
+            outputs = model.model.generate(input_ids=enc_idxs, attention_mask=enc_attn, num_beams=config.beam_size, max_length=config.max_output_length)
+        profiler.count('generate/examples', len(batch.tokens))
+        profiler.count('generate/tokens', enc_idxs.numel())
+        with profiler.timer('detokenize'):
+            final_outputs = [tokenizer.decode(output, skip_special_tokens=True, clean_up_tokenization_spaces=True) for output in outputs]
+
+        for bid, (tokens, p_text) in enumerate(zip(batch.tokens, final_outputs)):
+            with profiler.timer('template_decode'):
+                template = theclass(config.input_style, config.output_style, tokens, event_type)
+                pred_object = template.decode(p_text)
+
+            pred_trigger_object = []
+            pred_argument_object = []
+            for obj in pred_object:
+                if obj[1] == event_type:
+                    pred_trigger_object.append(obj)
+                else:
+                    pred_argument_object.append(obj)
+
+            with profiler.timer('span_match'):
+                # decode triggers
+                triggers_ = [mention + (event_type, kwargs) for span, _, kwargs in pred_trigger_object for mention in get_span_idx_tri(batch.piece_idxs[bid], batch.token_start_idxs[bid], span, tokenizer)]
+                triggers_ = [t for t in triggers_ if t[0] != -1]
+                p_triggers_ = [t[:-1] for t in triggers_]
+                p_triggers_ = list(set(p_triggers_))
+                p_triggers[bid].extend(p_triggers_)
+
+                # decode arguments
+                tri_id2obj = {}
+                for t in triggers_:
+                    tri_id2obj[t[3]['tri counter']] = (t[0], t[1], t[2])
+
+                roles_ = []
+                for span, role_type, kwargs in pred_argument_object:
+                    corres_tri_id = kwargs['cor tri cnt']
+                    if corres_tri_id in tri_id2obj.keys():
+                        arg_span = get_span_idx(batch.piece_idxs[bid], batch.token_start_idxs[bid], span, tokenizer, tri_id2obj[corres_tri_id])
+                        if arg_span[0] != -1:
+                            roles_.append((tri_id2obj[corres_tri_id], (arg_span[0], arg_span[1], role_type)))
+                    else:
+                        arg_span = get_span_idx(batch.piece_idxs[bid], batch.token_start_idxs[bid], span, tokenizer)
+                        if arg_span[0] != -1:
+                            roles_.append(((0, 1, event_type), (arg_span[0], arg_span[1], role_type)))
+
+            p_roles[bid].extend(roles_)
+            p_texts[bid].append(p_text)
+
+    p_roles = [list(set(role)) for role in p_roles]
+
+    return p_triggers, p_roles, p_texts
@@ -1,25 +1,51 @@
-import os, sys, json, logging, pprint, tqdm
+import os, sys, json, glob, logging, pprint, subprocess, tqdm
 import numpy as np
 import torch
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Subset
 from transformers import AutoTokenizer
 from model import GenerativeModel
 from dataset import GenDataset, EEDataset
-from utils import compute_f1
+from metrics import EventScorer, log_scores
+from decoding import predict_batch, encode_prompts
+from utils import Profiler, PRECISION_DTYPES, check_precision
 from argparse import ArgumentParser, Namespace
 import ipdb
 
 # configuration
 parser = ArgumentParser()
 parser.add_argument('-c', '--config', required=True)
-parser.add_argument('-e', '--model', required=True)
+parser.add_argument('-e', '--model', required=True, help='A checkpoint, a directory of checkpoints (*.mdl, searched recursively) or a glob')
 parser.add_argument('--no_dev', action='store_true', default=False)
 parser.add_argument('--eval_batch_size', type=int)
 parser.add_argument('--write_file', type=str)
+parser.add_argument('--save_counts', type=str, help='Save per-sentence test counts (.npz) for significance testing')
+parser.add_argument('--precision', choices=['fp32', 'fp16', 'bf16'], help='Precision of the weights during generation (default: precision of the config, else fp32)')
+parser.add_argument('--parity_check', action='store_true', default=False, help='Also evaluate in fp32 and compare F1 with --precision (on dev, or test with --no_dev)')
+parser.add_argument('--parity_tolerance', type=float, default=0.5, help='Largest F1 difference (points) accepted by the parity check')
+parser.add_argument('--cache_batches', action='store_true', default=False, help='Keep the collated batches and tokenized prompts in memory and reuse them for every checkpoint')
+parser.add_argument('--summary_file', type=str, help='Comparison table of all evaluated checkpoints (default: eval_summary.tsv next to eval.log)')
+parser.add_argument('--gpu_device', type=int, help='Overrides gpu_device of the config, -1 evaluates on CPU')
+parser.add_argument('--num_shards', type=int, default=1, help='Split dev and test into this many contiguous blocks of batches')
+parser.add_argument('--shard_id', type=int, default=0, help='Block evaluated by this process, its partial results are saved to --shard_dir')
+parser.add_argument('--shard_dir', type=str, help='Partial results of the shards (default: shards/ next to eval.log)')
+parser.add_argument('--merge', action='store_true', default=False, help='Merge the partial results of the --num_shards shards instead of evaluating')
+parser.add_argument('--launch', type=int, help='Evaluate this many shards in parallel subprocesses, then merge them')
+parser.add_argument('--devices', type=int, nargs='+', help='gpu_device of the launched shards, in turn (default: gpu_device of the config)')
 args = parser.parse_args()
 with open(args.config) as fp:
     config = json.load(fp)
 config = Namespace(**config)
+if args.gpu_device is not None:
+    config.gpu_device = args.gpu_device
+if args.eval_batch_size:
+    config.eval_batch_size=args.eval_batch_size
+
+# sharding, a shard process saves its partial results and the merge reports them like a single process
+if args.launch:
+    args.num_shards = args.launch
+assert 0 <= args.shard_id < args.num_shards, f'--shard_id must be in [0, {args.num_shards})'
+merging = args.merge or bool(args.launch)
+sharded = args.num_shards > 1 and not merging
 
 if config.dataset == "ace05e" or config.dataset == "ace05ep":
     import template_ace
@@ -33,375 +59,288 @@ np.random.seed(config.seed)
 torch.manual_seed(config.seed)
 torch.backends.cudnn.enabled = False
 
+# checkpoints
+if os.path.isdir(args.model):
+    log_dir = args.model
+    checkpoints = sorted(glob.glob(os.path.join(args.model, '**', '*.mdl'), recursive=True))
+elif glob.has_magic(args.model):
+    log_dir = os.path.dirname(args.model.split('*')[0]) or '.'
+    checkpoints = sorted(glob.glob(args.model, recursive=True))
+else:
+    log_dir = os.path.dirname(args.model) or '.'
+    checkpoints = [args.model]
+assert len(checkpoints) > 0, f'No checkpoint found in {args.model}'
+
+shard_dir = args.shard_dir or os.path.join(log_dir, 'shards')
+if sharded or args.launch:
+    os.makedirs(shard_dir, exist_ok=True)
+
 # logger
-log_path = os.path.join(os.path.dirname(args.model), "eval.log")
+log_path = os.path.join(shard_dir, f'eval.shard{args.shard_id}.log') if sharded else os.path.join(log_dir, "eval.log")
 logging.basicConfig(format='%(asctime)s - %(name)s - %(message)s', datefmt='[%Y-%m-%d %H:%M:%S]', force=True,
                     handlers=[logging.FileHandler(log_path), logging.StreamHandler()])
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 logger.info(f"\n{pprint.pformat(vars(config), indent=4)}")
+logger.info(f"Evaluating {len(checkpoints)} checkpoint(s)")
+profiler = Profiler(enabled=getattr(config, 'profile', True), sync_cuda=getattr(config, 'profile_sync', False))
 
-def get_span_idx(pieces, token_start_idxs, span, tokenizer, trigger_span=None):
-    """
-    This function is how we map the generated prediction back to span prediction.
+def checkpoint_tag(checkpoint):
+    return os.path.splitext(os.path.relpath(checkpoint, log_dir))[0].replace(os.sep, '.')
 
-    Detailed Explanation:
-        We will first split our prediction and use tokenizer to tokenize our predicted "span" into pieces. Then, we will find whether we can find a continuous span in the original "pieces" can match tokenized "span". 
+def checkpoint_path(path, checkpoint):
+    """Output path for one checkpoint; when several checkpoints are evaluated the checkpoint name is added to `path`."""
+    if len(checkpoints) == 1:
+        return path
+    root, ext = os.path.splitext(path)
+    return f'{root}.{checkpoint_tag(checkpoint)}{ext}'
 
-    If it is an argument/relation extraction task, we will return the one which is closest to the trigger_span.
-    """
-    words = []
-    for s in span.split(' '):
-        words.extend(tokenizer.encode(s, add_special_tokens=False))
-    
-    candidates = []
-    for i in range(len(pieces)):
-        j = 0
-        k = 0
-        while j < len(words) and i+k < len(pieces):
-            if pieces[i+k] == words[j]:
-                j += 1
-                k += 1
-            elif tokenizer.decode(words[j]) == "":
-                j += 1
-            elif tokenizer.decode(pieces[i+k]) == "":
-                k += 1
-            else:
-                break
-        if j == len(words):
-            candidates.append((i, i+k))
-            
-    candidates = [(token_start_idxs.index(c1), token_start_idxs.index(c2)) for c1, c2 in candidates if c1 in token_start_idxs and c2 in token_start_idxs]
-    if len(candidates) < 1:
-        return -1, -1
-    else:
-        if trigger_span is None:
-            return candidates[0]
-        else:
-            return sorted(candidates, key=lambda x: np.abs(trigger_span[0]-x[0]))[0]
+def shard_path(checkpoint, shard_id):
+    return os.path.join(shard_dir, f'{checkpoint_tag(checkpoint)}.shard{shard_id}of{args.num_shards}.json')
 
-def get_span_idx_tri(pieces, token_start_idxs, span, tokenizer, trigger_span=None):
+def shard(dataset):
     """
-    This function is how we map the generated prediction back to span prediction.
-
-    Detailed Explanation:
-        We will first split our prediction and use tokenizer to tokenize our predicted "span" into pieces. Then, we will find whether we can find a continuous span in the original "pieces" can match tokenized "span". 
+    The contiguous block of `dataset` evaluated by this process. Blocks are made of whole
+    batches, so every batch is padded and generated exactly as in a single process.
+    """
+    if args.num_shards == 1:
+        return dataset
+    batch_num = (len(dataset) + config.eval_batch_size - 1) // config.eval_batch_size
+    start = batch_num * args.shard_id // args.num_shards * config.eval_batch_size
+    end = batch_num * (args.shard_id + 1) // args.num_shards * config.eval_batch_size
+    return Subset(dataset, range(min(start, len(dataset)), min(end, len(dataset))))
 
-    If it is an argument/relation extraction task, we will return the one which is closest to the trigger_span.
+class Batches(object):
     """
-    words = []
-    for s in span.split(' '):
-        words.extend(tokenizer.encode(s, add_special_tokens=False))
-    
-    candidates = []
-    for i in range(len(pieces)):
-        j = 0
-        k = 0
-        while j < len(words) and i+k < len(pieces):
-            if pieces[i+k] == words[j]:
-                j += 1
-                k += 1
-            elif tokenizer.decode(words[j]) == "":
-                j += 1
-            elif tokenizer.decode(pieces[i+k]) == "":
-                k += 1
-            else:
-                break
-        if j == len(words):
-            candidates.append((i, i+k))
-            
-    candidates = [(token_start_idxs.index(c1), token_start_idxs.index(c2)) for c1, c2 in candidates if c1 in token_start_idxs and c2 in token_start_idxs]
-    if len(candidates) < 1:
-        return [(-1, -1)]
-    else:
-        if trigger_span is None:
-            return candidates
-        else:
-            return sorted(candidates, key=lambda x: np.abs(trigger_span[0]-x[0]))
-
-def cal_scores(gold_triggers, pred_triggers, gold_roles, pred_roles):
-    assert len(gold_triggers) == len(pred_triggers)
-    assert len(gold_roles) == len(pred_roles)    
-    # tri_id
-    gold_tri_id_num, pred_tri_id_num, match_tri_id_num = 0, 0, 0
-    for gold_trigger, pred_trigger in zip(gold_triggers, pred_triggers):
-        gold_set = set([(t[0], t[1]) for t in gold_trigger])
-        pred_set = set([(t[0], t[1]) for t in pred_trigger])
-        gold_tri_id_num += len(gold_set)
-        pred_tri_id_num += len(pred_set)
-        match_tri_id_num += len(gold_set & pred_set)
-    
-    # tri_cls
-    gold_tri_cls_num, pred_tri_cls_num, match_tri_cls_num = 0, 0, 0
-    for gold_trigger, pred_trigger in zip(gold_triggers, pred_triggers):
-        gold_set = set(gold_trigger)
-        pred_set = set(pred_trigger)
-        gold_tri_cls_num += len(gold_set)
-        pred_tri_cls_num += len(pred_set)
-        match_tri_cls_num += len(gold_set & pred_set)
-    
-    # arg_id
-    gold_arg_id_num, pred_arg_id_num, match_arg_id_num = 0, 0, 0
-    for gold_role, pred_role in zip(gold_roles, pred_roles):
-        gold_set = set([(r[0][2],)+r[1][:-1] for r in gold_role])
-        pred_set = set([(r[0][2],)+r[1][:-1] for r in pred_role])
-        
-        gold_arg_id_num += len(gold_set)
-        pred_arg_id_num += len(pred_set)
-        match_arg_id_num += len(gold_set & pred_set)
-        
-    # arg_cls
-    gold_arg_cls_num, pred_arg_cls_num, match_arg_cls_num = 0, 0, 0
-    for gold_role, pred_role in zip(gold_roles, pred_roles):
-        gold_set = set([(r[0][2],)+r[1] for r in gold_role])
-        pred_set = set([(r[0][2],)+r[1] for r in pred_role])
-        
-        gold_arg_cls_num += len(gold_set)
-        pred_arg_cls_num += len(pred_set)
-        match_arg_cls_num += len(gold_set & pred_set)
-    
-    scores = {
-        'tri_id': (gold_tri_id_num, pred_tri_id_num, match_tri_id_num) + compute_f1(pred_tri_id_num, gold_tri_id_num, match_tri_id_num),
-        'tri_cls': (gold_tri_cls_num, pred_tri_cls_num, match_tri_cls_num) + compute_f1(pred_tri_cls_num, gold_tri_cls_num, match_tri_cls_num),
-        'arg_id': (gold_arg_id_num, pred_arg_id_num, match_arg_id_num) + compute_f1(pred_arg_id_num, gold_arg_id_num, match_arg_id_num),
-        'arg_cls': (gold_arg_cls_num, pred_arg_cls_num, match_arg_cls_num) + compute_f1(pred_arg_cls_num, gold_arg_cls_num, match_arg_cls_num),
-    }
-    
-    return scores
-
-# set GPU device
-torch.cuda.set_device(config.gpu_device)
-
-# check valid styles
-assert np.all([style in ['event_type', 'event_type_sent', 'static_keywords', 'template'] for style in config.input_style])
-assert np.all([style in ['trigger:sentence', 'argument:sentence'] for style in config.output_style])
-              
-# tokenizer
-tokenizer = AutoTokenizer.from_pretrained(config.model_name, cache_dir=config.cache_dir)
-special_tokens = ['<Trigger>', '<sep>', '<and>', '<Keyword>', '</Keyword>']
-tokenizer.add_tokens(special_tokens)
+    The batches of `dataset` (the block of this shard) with their tokenized prompts, collated
+    and tokenized one at a time while they are evaluated. With `cache` they are kept after
+    the first pass and reused for every later checkpoint, at the cost of memory growing with
+    the size of the set.
+    """
+    def __init__(self, dataset, cache=False):
+        self.dataset = dataset
+        self.loader = DataLoader(shard(dataset), batch_size=config.eval_batch_size, shuffle=False, collate_fn=profiler.wrap(dataset.collate_fn, 'collate'))
+        self.cache = cache
+        self.batches = None
 
-if args.eval_batch_size:
-    config.eval_batch_size=args.eval_batch_size
+    def __len__(self):
+        return len(self.loader)
 
-# load data
-dev_set = EEDataset(tokenizer, config.dev_file, max_length=config.max_length)
-test_set = EEDataset(tokenizer, config.test_file, max_length=config.max_length)
-dev_batch_num = len(dev_set) // config.eval_batch_size + (len(dev_set) % config.eval_batch_size != 0)
-test_batch_num = len(test_set) // config.eval_batch_size + (len(test_set) % config.eval_batch_size != 0)
-with open(config.vocab_file) as f:
-    vocab = json.load(f)
-
-# load model
-logger.info(f"Loading model from {args.model}")
-model = GenerativeModel(config, tokenizer)
-model.load_state_dict(torch.load(args.model, map_location=f'cuda:{config.gpu_device}'))
-model.cuda(device=config.gpu_device)
-model.eval()
-
-# eval dev set
-if not args.no_dev:
-    progress = tqdm.tqdm(total=dev_batch_num, ncols=75, desc='Dev')
-    dev_gold_triggers, dev_gold_roles, dev_pred_triggers, dev_pred_roles = [], [], [], []
-    
-    for batch in DataLoader(dev_set, batch_size=config.eval_batch_size, shuffle=False, collate_fn=dev_set.collate_fn):
+    def __iter__(self):
+        if self.batches is not None:
+            yield from self.batches
+            return
+        batches = []
+        for batch in self.loader:
+            with profiler.timer('prompt'):
+                encoded = encode_prompts(tokenizer, batch, vocab, template_file, config)
+            if self.cache:
+                batches.append((batch, encoded))
+            yield batch, encoded
+        if self.cache:
+            self.batches = batches
+
+def evaluate(batches, desc, ignore_first_header=False, keep_outputs=False, keep_sentence_counts=False):
+    progress = tqdm.tqdm(total=len(batches), ncols=75, desc=desc)
+    scorer = EventScorer(keep_sentence_counts=keep_sentence_counts)
+    wnd_ids = []
+    write_object = []
+    for batch, encoded in batches:
         progress.update(1)
-        
-        p_triggers = [[] for _ in range(len(batch.tokens))]
-        p_roles = [[] for _ in range(len(batch.tokens))]
-        for event_type in vocab['event_type_itos']:
-            theclass = getattr(sys.modules[template_file], event_type.replace(':', '_').replace('-', '_'), False)
-            
-            inputs = []
-            for tokens in batch.tokens:
-                template = theclass(config.input_style, config.output_style, tokens, event_type)
-                inputs.append(template.generate_input_str(''))
-            
-            inputs = tokenizer(inputs, return_tensors='pt', padding=True, max_length=config.max_length)
-            enc_idxs = inputs['input_ids'].cuda()
-            enc_attn = inputs['attention_mask'].cuda()
-            
-            outputs = model.model.generate(input_ids=enc_idxs, attention_mask=enc_attn, num_beams=config.beam_size, max_length=config.max_output_length)
-            final_outputs = [tokenizer.decode(output, skip_special_tokens=True, clean_up_tokenization_spaces=True) for output in outputs]
-            
-            for bid, (tokens, p_text) in enumerate(zip(batch.tokens, final_outputs)):
-                template = theclass(config.input_style, config.output_style, tokens, event_type)
-                pred_object = template.decode(p_text)
-                
-                pred_trigger_object = []
-                pred_argument_object = []
-                for obj in pred_object:
-                    if obj[1] == event_type:
-                        pred_trigger_object.append(obj)
-                    else:
-                        pred_argument_object.append(obj)
-                
-                # decode triggers
-                triggers_ = [mention + (event_type, kwargs) for span, _, kwargs in pred_trigger_object for mention in get_span_idx_tri(batch.piece_idxs[bid], batch.token_start_idxs[bid], span, tokenizer)]
-                triggers_ = [t for t in triggers_ if t[0] != -1]
-                p_triggers_ = [t[:-1] for t in triggers_]
-                p_triggers_ = list(set(p_triggers_))
-                p_triggers[bid].extend(p_triggers_)
-                
-                # decode arguments
-                tri_id2obj = {}
-                for t in triggers_:
-                    try:
-                        tri_id2obj[t[3]['tri counter']] = (t[0], t[1], t[2])
-                    except:
-                        ipdb.set_trace()
-                
-                roles_ = []
-                for span, role_type, kwargs in pred_argument_object:
-                    corres_tri_id = kwargs['cor tri cnt']
-                    if corres_tri_id in tri_id2obj.keys():
-                        arg_span = get_span_idx(batch.piece_idxs[bid], batch.token_start_idxs[bid], span, tokenizer, tri_id2obj[corres_tri_id])
-                        if arg_span[0] != -1:
-                            roles_.append((tri_id2obj[corres_tri_id], (arg_span[0], arg_span[1], role_type)))
-                    else:
-                        arg_span = get_span_idx(batch.piece_idxs[bid], batch.token_start_idxs[bid], span, tokenizer)
-                        if arg_span[0] != -1:
-                            roles_.append(((0, 1, event_type), (arg_span[0], arg_span[1], role_type)))
-                
-                p_roles[bid].extend(roles_)
-                
-        p_roles = [list(set(role)) for role in p_roles]
-        
-        dev_gold_triggers.extend(batch.triggers)
-        dev_gold_roles.extend(batch.roles)
-        dev_pred_triggers.extend(p_triggers)
-        dev_pred_roles.extend(p_roles)
-                
+        p_triggers, p_roles, p_texts = predict_batch(model, tokenizer, batch, vocab, template_file, config, device=device, encoded=encoded, profiler=profiler)
+
+        if ignore_first_header:
+            for bid, wnd_id in enumerate(batch.wnd_ids):
+                if int(wnd_id.split('-')[-1]) < 4:
+                    p_triggers[bid] = []
+                    p_roles[bid] = []
+
+        with profiler.timer('score'):
+            scorer.update(batch.triggers, p_triggers, batch.roles, p_roles)
+            live_scores = scorer.scores()
+        progress.set_postfix(tri_cls=live_scores['tri_cls'][5], arg_cls=live_scores['arg_cls'][5])
+        if keep_sentence_counts:
+            wnd_ids.extend(batch.wnd_ids)
+        if keep_outputs:
+            for tokens, gt, gr, pt, pr, te in zip(batch.tokens, batch.triggers, batch.roles, p_triggers, p_roles, p_texts):
+                write_object.append({
+                    "input text": " ".join(tokens),
+                    "pred text": te,
+                    "pred triggers": pt,
+                    "gold triggers": gt,
+                    "pred roles": pr,
+                    "gold roles": gr
+                })
     progress.close()
-    
-    # calculate scores
-    dev_scores = cal_scores(dev_gold_triggers, dev_pred_triggers, dev_gold_roles, dev_pred_roles)
-    
-    logger.info("---------------------------------------------------------------------")
-    logger.info('Trigger I  - P: {:6.2f} ({:4d}/{:4d}), R: {:6.2f} ({:4d}/{:4d}), F: {:6.2f}'.format(
-        dev_scores['tri_id'][3] * 100.0, dev_scores['tri_id'][2], dev_scores['tri_id'][1], 
-        dev_scores['tri_id'][4] * 100.0, dev_scores['tri_id'][2], dev_scores['tri_id'][0], dev_scores['tri_id'][5] * 100.0))
-    logger.info('Trigger C  - P: {:6.2f} ({:4d}/{:4d}), R: {:6.2f} ({:4d}/{:4d}), F: {:6.2f}'.format(
-        dev_scores['tri_cls'][3] * 100.0, dev_scores['tri_cls'][2], dev_scores['tri_cls'][1], 
-        dev_scores['tri_cls'][4] * 100.0, dev_scores['tri_cls'][2], dev_scores['tri_cls'][0], dev_scores['tri_cls'][5] * 100.0))
-    logger.info("---------------------------------------------------------------------")
-    logger.info('Role I     - P: {:6.2f} ({:4d}/{:4d}), R: {:6.2f} ({:4d}/{:4d}), F: {:6.2f}'.format(
-        dev_scores['arg_id'][3] * 100.0, dev_scores['arg_id'][2], dev_scores['arg_id'][1], 
-        dev_scores['arg_id'][4] * 100.0, dev_scores['arg_id'][2], dev_scores['arg_id'][0], dev_scores['arg_id'][5] * 100.0))
-    logger.info('Role C     - P: {:6.2f} ({:4d}/{:4d}), R: {:6.2f} ({:4d}/{:4d}), F: {:6.2f}'.format(
-        dev_scores['arg_cls'][3] * 100.0, dev_scores['arg_cls'][2], dev_scores['arg_cls'][1], 
-        dev_scores['arg_cls'][4] * 100.0, dev_scores['arg_cls'][2], dev_scores['arg_cls'][0], dev_scores['arg_cls'][5] * 100.0))
-    logger.info("---------------------------------------------------------------------")
-    
-    
-# test set
-progress = tqdm.tqdm(total=test_batch_num, ncols=75, desc='Test')
-test_gold_triggers, test_gold_roles, test_pred_triggers, test_pred_roles = [], [], [], []
-write_object = []
-for batch in DataLoader(test_set, batch_size=config.eval_batch_size, shuffle=False, collate_fn=test_set.collate_fn):
-    progress.update(1)
-    p_triggers = [[] for _ in range(len(batch.tokens))]
-    p_roles = [[] for _ in range(len(batch.tokens))]
-    p_texts = [[] for _ in range(len(batch.tokens))]
-    for event_type in vocab['event_type_itos']:
-        theclass = getattr(sys.modules[template_file], event_type.replace(':', '_').replace('-', '_'), False)
-        
-        inputs = []
-        for tokens in batch.tokens:
-            template = theclass(config.input_style, config.output_style, tokens, event_type)
-            inputs.append(template.generate_input_str(''))
-        
-        inputs = tokenizer(inputs, return_tensors='pt', padding=True, max_length=config.max_length)
-        enc_idxs = inputs['input_ids'].cuda()
-        enc_attn = inputs['attention_mask'].cuda()
-        
-        outputs = model.model.generate(input_ids=enc_idxs, attention_mask=enc_attn, num_beams=config.beam_size, max_length=config.max_output_length)
-        final_outputs = [tokenizer.decode(output, skip_special_tokens=True, clean_up_tokenization_spaces=True) for output in outputs]
-        
-        for bid, (tokens, p_text) in enumerate(zip(batch.tokens, final_outputs)):
-            template = theclass(config.input_style, config.output_style, tokens, event_type)
-            pred_object = template.decode(p_text)
-            
-            pred_trigger_object = []
-            pred_argument_object = []
-            for obj in pred_object:
-                if obj[1] == event_type:
-                    pred_trigger_object.append(obj)
-                else:
-                    pred_argument_object.append(obj)
-            
-            # decode triggers
-            triggers_ = [mention + (event_type, kwargs) for span, _, kwargs in pred_trigger_object for mention in get_span_idx_tri(batch.piece_idxs[bid], batch.token_start_idxs[bid], span, tokenizer)]
-
-            triggers_ = [t for t in triggers_ if t[0] != -1]
-            p_triggers_ = [t[:-1] for t in triggers_]
-            p_triggers_ = list(set(p_triggers_))
-            
-            p_triggers[bid].extend(p_triggers_)
-            
-            # decode arguments
-            tri_id2obj = {}
-            for t in triggers_:
-                tri_id2obj[t[3]['tri counter']] = (t[0], t[1], t[2])
-            
-            roles_ = []
-            for span, role_type, kwargs in pred_argument_object:
-                corres_tri_id = kwargs['cor tri cnt']
-                if corres_tri_id in tri_id2obj.keys():
-                    arg_span = get_span_idx(batch.piece_idxs[bid], batch.token_start_idxs[bid], span, tokenizer, tri_id2obj[corres_tri_id])
-                    if arg_span[0] != -1:
-                        roles_.append((tri_id2obj[corres_tri_id], (arg_span[0], arg_span[1], role_type)))
-                else:
-                    arg_span = get_span_idx(batch.piece_idxs[bid], batch.token_start_idxs[bid], span, tokenizer)
-                    if arg_span[0] != -1:
-                        roles_.append(((0, 1, event_type), (arg_span[0], arg_span[1], role_type)))
-            
-            p_roles[bid].extend(roles_)
-            p_texts[bid].append(p_text)
-
-    p_roles = [list(set(role)) for role in p_roles]
-    
-    if config.ignore_first_header:
-        for bid, wnd_id in enumerate(batch.wnd_ids):
-            if int(wnd_id.split('-')[-1]) < 4:
-                p_triggers[bid] = []
-                p_roles[bid] = []
-    
-    test_gold_triggers.extend(batch.triggers)
-    test_gold_roles.extend(batch.roles)
-    test_pred_triggers.extend(p_triggers)
-    test_pred_roles.extend(p_roles)
-    for tokens, gt, gr, pt, pr, te in zip(batch.tokens, batch.triggers, batch.roles, p_triggers, p_roles, p_texts):
-        write_object.append({
-            "input text": " ".join(tokens),
-            "pred text": te,
-            "pred triggers": pt,
-            "gold triggers": gt,
-            "pred roles": pr,
-            "gold roles": gr
-        })
-            
-progress.close()
-
-# calculate scores
-test_scores = cal_scores(test_gold_triggers, test_pred_triggers, test_gold_roles, test_pred_roles)
-
-logger.info("---------------------------------------------------------------------")
-logger.info('Trigger I  - P: {:6.2f} ({:4d}/{:4d}), R: {:6.2f} ({:4d}/{:4d}), F: {:6.2f}'.format(
-    test_scores['tri_id'][3] * 100.0, test_scores['tri_id'][2], test_scores['tri_id'][1], 
-    test_scores['tri_id'][4] * 100.0, test_scores['tri_id'][2], test_scores['tri_id'][0], test_scores['tri_id'][5] * 100.0))
-logger.info('Trigger C  - P: {:6.2f} ({:4d}/{:4d}), R: {:6.2f} ({:4d}/{:4d}), F: {:6.2f}'.format(
-    test_scores['tri_cls'][3] * 100.0, test_scores['tri_cls'][2], test_scores['tri_cls'][1], 
-    test_scores['tri_cls'][4] * 100.0, test_scores['tri_cls'][2], test_scores['tri_cls'][0], test_scores['tri_cls'][5] * 100.0))
-logger.info("---------------------------------------------------------------------")
-logger.info('Role I     - P: {:6.2f} ({:4d}/{:4d}), R: {:6.2f} ({:4d}/{:4d}), F: {:6.2f}'.format(
-    test_scores['arg_id'][3] * 100.0, test_scores['arg_id'][2], test_scores['arg_id'][1], 
-    test_scores['arg_id'][4] * 100.0, test_scores['arg_id'][2], test_scores['arg_id'][0], test_scores['arg_id'][5] * 100.0))
-logger.info('Role C     - P: {:6.2f} ({:4d}/{:4d}), R: {:6.2f} ({:4d}/{:4d}), F: {:6.2f}'.format(
-    test_scores['arg_cls'][3] * 100.0, test_scores['arg_cls'][2], test_scores['arg_cls'][1], 
-    test_scores['arg_cls'][4] * 100.0, test_scores['arg_cls'][2], test_scores['arg_cls'][0], test_scores['arg_cls'][5] * 100.0))
-logger.info("---------------------------------------------------------------------")
-
-if args.write_file:
-    with open(args.write_file, 'w') as fw:
-        json.dump(write_object, fw, indent=4)
+    return scorer, write_object, wnd_ids
+
+def launch_shards():
+    """Evaluate every shard in its own subprocess, all at the same time, and wait for them."""
+    devices = args.devices or [config.gpu_device]
+    processes = []
+    for shard_id in range(args.num_shards):
+        command = [sys.executable, os.path.abspath(__file__), '-c', args.config, '-e', args.model,
+                   '--num_shards', str(args.num_shards), '--shard_id', str(shard_id), '--shard_dir', shard_dir,
+                   '--gpu_device', str(devices[shard_id % len(devices)])]
+        for name in ['eval_batch_size', 'write_file', 'save_counts', 'precision']:
+            if getattr(args, name):
+                command += [f'--{name}', str(getattr(args, name))]
+        for name in ['no_dev', 'parity_check', 'cache_batches']:
+            if getattr(args, name):
+                command.append(f'--{name}')
+        output_path = os.path.join(shard_dir, f'eval.shard{shard_id}.out')
+        with open(output_path, 'w') as output:
+            processes.append((output_path, subprocess.Popen(command, stdout=output, stderr=subprocess.STDOUT)))
+        logger.info(f"Launched shard {shard_id} on device {devices[shard_id % len(devices)]}, output in {output_path}")
+    failed = [output_path for output_path, process in processes if process.wait() != 0]
+    if failed:
+        raise RuntimeError(f"{len(failed)} shard(s) failed, see {', '.join(failed)}")
+
+def save_shard(checkpoint, parity_scorer, dev_scorer, test_scorer, write_object, wnd_ids):
+    with open(shard_path(checkpoint, args.shard_id), 'w') as fw:
+        json.dump({
+            'parity': parity_scorer.state_dict() if parity_scorer is not None else None,
+            'dev': dev_scorer.state_dict() if dev_scorer is not None else None,
+            'test': test_scorer.state_dict(),
+            'write_object': write_object,
+            'wnd_ids': wnd_ids,
+        }, fw)
+    logger.info(f'Saved the partial results to {shard_path(checkpoint, args.shard_id)}')
+
+def merge_shards(checkpoint):
+    """The partial results of every shard of `checkpoint`, merged in shard order, i.e. in the order of the data."""
+    scorers, write_object, wnd_ids = {}, [], []
+    for shard_id in range(args.num_shards):
+        with open(shard_path(checkpoint, shard_id)) as fp:
+            part = json.load(fp)
+        for split in ['parity', 'dev', 'test']:
+            if part[split] is not None:
+                scorer = EventScorer.from_state_dict(part[split])
+                scorers[split] = scorers[split].merge(scorer) if split in scorers else scorer
+        write_object.extend(part['write_object'])
+        wnd_ids.extend(part['wnd_ids'])
+    logger.info(f"Merged {args.num_shards} shard(s) of {checkpoint}")
+    return scorers.get('parity'), scorers.get('dev'), scorers['test'], write_object, wnd_ids
+
+# generation precision, the weights are cast after loading
+precision = args.precision or getattr(config, 'precision', 'fp32')
+
+if args.launch:
+    launch_shards()
+
+if not merging:
+    # set GPU device, a negative gpu_device evaluates on CPU
+    if config.gpu_device >= 0:
+        torch.cuda.set_device(config.gpu_device)
+        device = torch.device('cuda', config.gpu_device)
+    else:
+        device = torch.device('cpu')
+    check_precision(precision, device)
+
+    # check valid styles
+    assert np.all([style in ['event_type', 'event_type_sent', 'static_keywords', 'template'] for style in config.input_style])
+    assert np.all([style in ['trigger:sentence', 'argument:sentence'] for style in config.output_style])
+
+    # tokenizer
+    tokenizer = AutoTokenizer.from_pretrained(config.model_name, cache_dir=config.cache_dir)
+    special_tokens = ['<Trigger>', '<sep>', '<and>', '<Keyword>', '</Keyword>']
+    tokenizer.add_tokens(special_tokens)
+
+    # load data
+    with open(config.vocab_file) as f:
+        vocab = json.load(f)
+    if not args.no_dev:
+        dev_set = EEDataset(tokenizer, config.dev_file, max_length=config.max_length)
+        dev_batches = Batches(dev_set, cache=args.cache_batches)
+    test_set = EEDataset(tokenizer, config.test_file, max_length=config.max_length)
+    test_batches = Batches(test_set, cache=args.cache_batches)
+
+    # the model is built once, the weights of every checkpoint are loaded into it in turn
+    model = GenerativeModel(config, tokenizer)
+    model.to(device)
+    model.eval()
+
+summary = []
+for checkpoint in checkpoints:
+    result = {'checkpoint': checkpoint}
+    if merging:
+        parity_scorer, dev_scorer, test_scorer, write_object, test_wnd_ids = merge_shards(checkpoint)
+    else:
+        logger.info(f"Loading model from {checkpoint}")
+        model.to(torch.float32)
+        model.load_state_dict(torch.load(checkpoint, map_location=device))
+        model.eval()
+
+        # reference scores in full precision
+        parity_scorer = None
+        if args.parity_check and precision != 'fp32':
+            parity_scorer, _, _ = evaluate(dev_batches if not args.no_dev else test_batches, 'Parity fp32')
+        model.to(PRECISION_DTYPES[precision])
+
+        # eval dev set
+        dev_scorer = None
+        if not args.no_dev:
+            dev_scorer, _, _ = evaluate(dev_batches, 'Dev')
+
+        # test set
+        test_scorer, write_object, test_wnd_ids = evaluate(test_batches, 'Test', ignore_first_header=config.ignore_first_header,
+                                                           keep_outputs=bool(args.write_file), keep_sentence_counts=bool(args.save_counts))
+
+    if sharded:
+        save_shard(checkpoint, parity_scorer, dev_scorer, test_scorer, write_object, test_wnd_ids)
+        continue
+
+    if dev_scorer is not None:
+        result['dev'] = dev_scores = dev_scorer.scores()
+        log_scores(logger, dev_scores)
+    result['test'] = test_scores = test_scorer.scores()
+    log_scores(logger, test_scores)
+    summary.append(result)
+
+    if parity_scorer is not None:
+        parity_scores = parity_scorer.scores()
+        low_scores = result['dev'] if not args.no_dev else result['test']
+        for metric in ['tri_id', 'tri_cls', 'arg_id', 'arg_cls']:
+            delta = (low_scores[metric][5] - parity_scores[metric][5]) * 100.0
+            logger.info('Parity {:7s} - fp32 F: {:6.2f}, {} F: {:6.2f}, diff: {:+6.2f}{}'.format(
+                metric, parity_scores[metric][5] * 100.0, precision, low_scores[metric][5] * 100.0, delta,
+                '' if abs(delta) <= args.parity_tolerance else ' (above tolerance {:.2f})'.format(args.parity_tolerance)))
+
+    type_scores = test_scorer.type_scores()
+    for event_type, score in type_scores['event_type']['tri_cls'].items():
+        logger.info('{:35s} - Trigger C F: {:6.2f} ({:4d}/{:4d}/{:4d}), Role C F: {:6.2f}'.format(
+            event_type, score[5] * 100.0, score[2], score[1], score[0],
+            type_scores['event_type']['arg_cls'].get(event_type, (0, 0, 0, 0.0, 0.0, 0.0))[5] * 100.0))
+
+    if args.write_file:
+        with open(checkpoint_path(args.write_file, checkpoint), 'w') as fw:
+            json.dump(write_object, fw, indent=4)
+
+    if args.save_counts:
+        counts_path = checkpoint_path(args.save_counts, checkpoint)
+        np.savez(counts_path, counts=test_scorer.sentence_count_array(), wnd_ids=np.array(test_wnd_ids))
+        logger.info(f'Saved per-sentence counts to {counts_path}')
+
+# a shard only saves its partial results, they are reported by the merge
+if sharded:
+    profiler.log(logger)
+    profiler.dump(os.path.join(shard_dir, f'eval_profile.shard{args.shard_id}.json'))
+    sys.exit(0)
+
+# comparison table
+metrics = ['tri_id', 'tri_cls', 'arg_id', 'arg_cls']
+header = ['checkpoint'] + [f'{split}_{metric}' for split in (['dev', 'test'] if not args.no_dev else ['test']) for metric in metrics]
+rows = [[result['checkpoint']] + ['{:.2f}'.format(result[split][metric][5] * 100.0) for split in (['dev', 'test'] if not args.no_dev else ['test']) for metric in metrics]
+        for result in summary]
+summary_file = args.summary_file or os.path.join(log_dir, 'eval_summary.tsv')
+with open(summary_file, 'w') as fw:
+    fw.write('\t'.join(header) + '\n')
+    for row in rows:
+        fw.write('\t'.join(row) + '\n')
+logger.info("Summary\n" + '\n'.join(['\t'.join(header)] + ['\t'.join(row) for row in rows]))
+logger.info(f'Saved the comparison table to {summary_file}')
+
+# per-stage timing, every shard dumps its own
+if not merging:
+    profiler.log(logger)
+    profiler.dump(os.path.join(log_dir, 'eval_profile.json'))
@@ -1,9 +1,9 @@
-import os, json, pickle, logging, pprint, random
+import os, json, logging, pprint, random
 import numpy as np
 from tqdm import tqdm
-from dataset import EEDataset
+from dataset import EEDataset, ExampleWriter
 from argparse import ArgumentParser, Namespace
-from utils import generate_vocabs
+from utils import generate_vocabs, Profiler
 from transformers import AutoTokenizer
 from template_base import event_template_generator
 import ipdb
@@ -32,54 +32,89 @@ np.random.seed(config.seed)
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(message)s', datefmt='[%Y-%m-%d %H:%M:%S]')
 logger = logging.getLogger(__name__)
 logger.info(f"\n{pprint.pformat(vars(config), indent=4)}")
-
-def generate_data(data_set, vocab, config):
-    inputs = []
-    targets = []
-    events = []
-    
-    keyword_inputs = []
-    keyword_targets = []
-    keywords = []
-
-    def organize_data(data, config):
+profiler = Profiler(enabled=getattr(config, 'profile', True))
+
+def generate_data(data_set, vocab, config, name, keep_negatives=False):
+    """
+    Write the examples of every sentence of `data_set` to `{name}_all.pkl` and
+    `{name}_keywords_all.pkl`, the records of a sentence as soon as they are generated. With
+    `keep_negatives` all the negative examples are kept and flagged, and train.py draws
+    n_negative of them per sentence every epoch; otherwise n_negative random ones are kept.
+    Either way the EE and keyword examples of a sentence are in the same event type order,
+    so they pair up index by index. Returns the number of EE examples.
+    """
+    writer = ExampleWriter(os.path.join(config.finetune_dir, f'{name}_all.pkl'))
+    keyword_writer = ExampleWriter(os.path.join(config.finetune_dir, f'{name}_keywords_all.pkl'))
+
+    # readable copies of the inputs and targets, for inspection only
+    save_json_copies = getattr(config, 'save_json_copies', False)
+    json_copies = {f'{name}_input': [], f'{name}_target': [], f'{name}_keywords_input': [], f'{name}_keywords_target': []}
+
+    def organize_data(data, config, order):
         inputs = []
         targets = []
         infos = []
+        negatives = []
 
         pos_data_ = [dt for dt in data if dt[3]]
         neg_data_ = [dt for dt in data if not dt[3]]
-        np.random.shuffle(neg_data_)
+        if order is not None:
+            neg_data_ = [neg_data_[i] for i in order]
         
         # data => (input_str, output_str, self.gold_event, gold_sample, self.event_type, self.tokens)
         for data_ in pos_data_:
             inputs.append(data_[0])
             targets.append(data_[1])
             infos.append((data_[2], data_[4], data_[5]))
+            negatives.append(False)
         
-        neg_data_ = neg_data_[:config.n_negative]
+        if not keep_negatives:
+            neg_data_ = neg_data_[:config.n_negative]
         for data_ in neg_data_:
             inputs.append(data_[0])
             targets.append(data_[1])
             infos.append((data_[2], data_[4], data_[5]))
+            negatives.append(True)
         
-        return inputs, targets, infos
-
-    for data in tqdm(data_set.data):
-        event_template = event_template_generator(template_file, data.tokens, data.triggers, data.roles, config.input_style, config.output_style, vocab, True)
-        
-        event_data, keyword_data = event_template.get_training_data()
-        inputs_, targets_, events_ = organize_data(event_data, config)
-        inputs.extend(inputs_)
-        targets.extend(targets_)
-        events.extend(events_)
-
-        inputs_, targets_, keywords_ = organize_data(keyword_data, config)
-        keyword_inputs.extend(inputs_)
-        keyword_targets.extend(targets_)
-        keywords.extend(keywords_)
-
-    return inputs, targets, events, keyword_inputs, keyword_targets, keywords
+        return inputs, targets, infos, negatives
+
+    for data in tqdm(data_set, total=len(data_set)):
+        with profiler.timer('template'):
+            event_template = event_template_generator(template_file, data.tokens, data.triggers, data.roles, config.input_style, config.output_style, vocab, True)
+            
+            event_data, keyword_data = event_template.get_training_data()
+        profiler.count('template/examples', 1)
+        profiler.count('template/tokens', len(data.tokens))
+        assert [dt[4] for dt in event_data] == [dt[4] for dt in keyword_data], 'EE and keyword examples do not match'
+
+        # the same random negatives for the EE and keyword examples, the training ones are all kept in order
+        order = None
+        if not keep_negatives:
+            order = np.random.permutation(sum(1 for dt in event_data if not dt[3]))
+
+        with profiler.timer('organize'):
+            examples = organize_data(event_data, config, order)
+            keyword_examples = organize_data(keyword_data, config, order)
+
+        with profiler.timer('write'):
+            writer.add_examples(data.doc_id, *examples)
+            keyword_writer.add_examples(data.doc_id, *keyword_examples)
+
+        if save_json_copies:
+            json_copies[f'{name}_input'].extend(examples[0])
+            json_copies[f'{name}_target'].extend(examples[1])
+            json_copies[f'{name}_keywords_input'].extend(keyword_examples[0])
+            json_copies[f'{name}_keywords_target'].extend(keyword_examples[1])
+
+    with profiler.timer('write'):
+        writer.close()
+        keyword_writer.close()
+        if save_json_copies:
+            for file_name, values in json_copies.items():
+                with open(os.path.join(config.finetune_dir, f'{file_name}.json'), 'w') as f:
+                    json.dump(values, f, indent=4)
+
+    return len(writer)
 
 # check valid styles
 assert np.all([style in ['event_type', 'event_type_sent', 'static_keywords', 'template'] for style in config.input_style])
@@ -94,99 +129,27 @@ if not os.path.exists(config.finetune_dir):
     os.makedirs(config.finetune_dir)
 
 # load data
-train_set = EEDataset(tokenizer, config.train_file, max_length=config.max_length)
-dev_set = EEDataset(tokenizer, config.dev_file, max_length=config.max_length)
-test_set = EEDataset(tokenizer, config.test_file, max_length=config.max_length)
+with profiler.timer('load'):
+    train_set = EEDataset(tokenizer, config.train_file, max_length=config.max_length)
+    dev_set = EEDataset(tokenizer, config.dev_file, max_length=config.max_length)
+    test_set = EEDataset(tokenizer, config.test_file, max_length=config.max_length)
+profiler.count('load/examples', len(train_set) + len(dev_set) + len(test_set))
 vocab = generate_vocabs([train_set, dev_set, test_set])
 
 # save vocabulary
 with open('{}/vocab.json'.format(config.finetune_dir), 'w') as f:
     json.dump(vocab, f, indent=4)    
 
-# generate finetune data
-train_inputs, train_targets, train_events, train_k_inputs, train_k_targets, train_keywords = generate_data(train_set, vocab, config)
-logger.info(f"Generated {len(train_inputs)} training examples from {len(train_set)} instance")
-
-with open('{}/train_input.json'.format(config.finetune_dir), 'w') as f:
-    json.dump(train_inputs, f, indent=4)
-
-with open('{}/train_target.json'.format(config.finetune_dir), 'w') as f:
-    json.dump(train_targets, f, indent=4)
-
-with open('{}/train_all.pkl'.format(config.finetune_dir), 'wb') as f:
-    pickle.dump({
-        'input': train_inputs,
-        'target': train_targets,
-        'all': train_events
-    }, f)
-
-with open(os.path.join(config.finetune_dir, 'train_keywords_input.json'), 'w') as f:
-    json.dump(train_k_inputs, f, indent=4)
-
-with open(os.path.join(config.finetune_dir, 'train_keywords_target.json'), 'w') as f:
-    json.dump(train_k_targets, f, indent=4)
-
-with open(os.path.join(config.finetune_dir, 'train_keywords_all.pkl'), 'wb') as f:
-    pickle.dump({
-        'input': train_k_inputs,
-        'target': train_k_targets,
-        'all': train_keywords
-    }, f)
-    
-dev_inputs, dev_targets, dev_events, dev_k_inputs, dev_k_targets, dev_keywords = generate_data(dev_set, vocab, config)
-logger.info(f"Generated {len(dev_inputs)} dev examples from {len(dev_set)} instance")
-
-with open('{}/dev_input.json'.format(config.finetune_dir), 'w') as f:
-    json.dump(dev_inputs, f, indent=4)
-
-with open('{}/dev_target.json'.format(config.finetune_dir), 'w') as f:
-    json.dump(dev_targets, f, indent=4)
-
-with open('{}/dev_all.pkl'.format(config.finetune_dir), 'wb') as f:
-    pickle.dump({
-        'input': dev_inputs,
-        'target': dev_targets,
-        'all': dev_events
-    }, f)
-
-with open(os.path.join(config.finetune_dir, 'dev_keywords_input.json'), 'w') as f:
-    json.dump(dev_k_inputs, f, indent=4)
-
-with open(os.path.join(config.finetune_dir, 'dev_keywords_target.json'), 'w') as f:
-    json.dump(dev_k_targets, f, indent=4)
-
-with open(os.path.join(config.finetune_dir, 'dev_keywords_all.pkl'), 'wb') as f:
-    pickle.dump({
-        'input': dev_k_inputs,
-        'target': dev_k_targets,
-        'all': dev_keywords
-    }, f)
-    
-test_inputs, test_targets, test_events, test_k_inputs, test_k_targets, test_keywords = generate_data(test_set, vocab, config)
-logger.info(f"Generated {len(test_inputs)} test examples from {len(test_set)} instance")
-
-with open('{}/test_input.json'.format(config.finetune_dir), 'w') as f:
-    json.dump(test_inputs, f, indent=4)
-
-with open('{}/test_target.json'.format(config.finetune_dir), 'w') as f:
-    json.dump(test_targets, f, indent=4)
-
-with open('{}/test_all.pkl'.format(config.finetune_dir), 'wb') as f:
-    pickle.dump({
-        'input': test_inputs,
-        'target': test_targets,
-        'all': test_events
-    }, f)
-
-with open(os.path.join(config.finetune_dir, 'test_keywords_input.json'), 'w') as f:
-    json.dump(test_k_inputs, f, indent=4)
-
-with open(os.path.join(config.finetune_dir, 'test_keywords_target.json'), 'w') as f:
-    json.dump(test_k_targets, f, indent=4)
-
-with open(os.path.join(config.finetune_dir, 'test_keywords_all.pkl'), 'wb') as f:
-    pickle.dump({
-        'input': test_k_inputs,
-        'target': test_k_targets,
-        'all': test_keywords
-    }, f)
\ No newline at end of file
+# generate finetune data, all the training negatives are kept and sampled per epoch by train.py, dev and
+# test keep a fixed sample so that their scores can be compared across epochs
+train_num = generate_data(train_set, vocab, config, 'train', keep_negatives=True)
+logger.info(f"Generated {train_num} training examples from {len(train_set)} instance")
+
+dev_num = generate_data(dev_set, vocab, config, 'dev', keep_negatives=False)
+logger.info(f"Generated {dev_num} dev examples from {len(dev_set)} instance")
+
+test_num = generate_data(test_set, vocab, config, 'test', keep_negatives=False)
+logger.info(f"Generated {test_num} test examples from {len(test_set)} instance")
+
+profiler.log(logger)
+profiler.dump(os.path.join(config.finetune_dir, 'profile.json'))
@@ -0,0 +1,207 @@
+import os, json, glob, logging, pprint, tqdm
+import numpy as np
+import torch
+from transformers import AutoTokenizer
+from model import GenerativeModel
+from dataset import EEInstance, EEBatch
+from decoding import predict_batch
+from argparse import ArgumentParser, Namespace
+
+# configuration
+parser = ArgumentParser()
+parser.add_argument('-c', '--config', required=True)
+parser.add_argument('-e', '--model', required=True)
+parser.add_argument('-i', '--input', required=True, help='JSONL file, text file or directory of .txt documents')
+parser.add_argument('-o', '--output', required=True, help='Path to the output JSONL file')
+parser.add_argument('-w', '--window', default=1, type=int, help='Number of sentences per window')
+parser.add_argument('--batch_size', type=int, help='Number of windows per micro-batch (default: eval_batch_size)')
+parser.add_argument('--flush_every', default=100, type=int, help='Flush the output file every N micro-batches')
+args = parser.parse_args()
+with open(args.config) as fp:
+    config = json.load(fp)
+config = Namespace(**config)
+
+if config.dataset == "ace05e" or config.dataset == "ace05ep":
+    import template_ace
+    template_file = "template_ace"
+elif config.dataset == "ere":
+    import template_ere
+    template_file = "template_ere"
+
+# fix random seed
+np.random.seed(config.seed)
+torch.manual_seed(config.seed)
+torch.backends.cudnn.enabled = False
+
+# logger
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(message)s', datefmt='[%Y-%m-%d %H:%M:%S]')
+logger = logging.getLogger(__name__)
+logger.info(f"\n{pprint.pformat(vars(config), indent=4)}")
+
+def split_text(text):
+    """Sentence split and tokenize raw text the same way as the English path of the preprocessing scripts."""
+    from nltk import sent_tokenize, wordpunct_tokenize
+    return [wordpunct_tokenize(sent) for sent in sent_tokenize(text)]
+
+def read_documents(path):
+    """
+    Lazily yield documents from `path`. Each document is a tuple of
+    (doc_id, wnd_id, sentences), where sentences is a list of token lists and wnd_id is only
+    set when the line is already an OneIE window.
+
+    Supported inputs:
+        - a directory or a glob of .txt files, one raw document per file
+        - a .txt file, one raw document per line
+        - a JSONL file where each line has either `tokens` (an OneIE window, used as is),
+          `sentences` (DyGIE++ style token lists) or `text` (raw text)
+    """
+    if os.path.isdir(path) or glob.has_magic(path):
+        pattern = os.path.join(path, '*.txt') if os.path.isdir(path) else path
+        for file_path in sorted(glob.glob(pattern)):
+            with open(file_path, 'r', encoding='utf-8') as fp:
+                doc_id = os.path.splitext(os.path.basename(file_path))[0]
+                yield doc_id, None, split_text(fp.read())
+    elif path.endswith('.txt'):
+        with open(path, 'r', encoding='utf-8') as fp:
+            for line_idx, line in enumerate(fp):
+                if line.strip():
+                    yield 'doc{}'.format(line_idx), None, split_text(line)
+    else:
+        with open(path, 'r', encoding='utf-8') as fp:
+            for line_idx, line in enumerate(fp):
+                if not line.strip():
+                    continue
+                doc = json.loads(line)
+                doc_id = doc.get('doc_id', doc.get('doc_key', 'doc{}'.format(line_idx)))
+                if 'tokens' in doc:
+                    yield doc_id, doc.get('wnd_id', '{}-0'.format(doc_id)), [doc['tokens']]
+                elif 'sentences' in doc:
+                    yield doc_id, None, doc['sentences']
+                else:
+                    yield doc_id, None, split_text(doc['text'])
+
+def document_to_windows(doc_id, sentences, window_size_):
+    """Concatenate consecutive sentences into windows, following `sentence2window` in preprocessing."""
+    sentences = [sent for sent in sentences if len(sent) > 0]
+    if window_size_ > len(sentences):
+        window_size = len(sentences)
+    else:
+        window_size = window_size_
+    for i in range(len(sentences)-window_size+1):
+        yield doc_id, '{}-{}'.format(doc_id, i), [t for sent in sentences[i:i+window_size] for t in sent]
+
+def iter_windows(path, window_size):
+    for doc_id, wnd_id, sentences in read_documents(path):
+        if wnd_id is not None:
+            yield doc_id, wnd_id, sentences[0]
+        else:
+            yield from document_to_windows(doc_id, sentences, window_size)
+
+def build_instance(doc_id, wnd_id, tokens):
+    pieces = [tokenizer.tokenize(t) for t in tokens]
+    token_lens = [len(p) for p in pieces]
+    pieces = [p for ps in pieces for p in ps]
+    token_start_idxs = [0]
+    for token_len in token_lens:
+        token_start_idxs.append(token_start_idxs[-1] + token_len)
+    return EEInstance(
+        doc_id=doc_id,
+        wnd_id=wnd_id,
+        tokens=tokens,
+        pieces=pieces,
+        piece_idxs=tokenizer.convert_tokens_to_ids(pieces),
+        token_lens=token_lens,
+        token_start_idxs=token_start_idxs,
+    )
+
+def to_event_objects(tokens, triggers, roles):
+    events = []
+    trigger2event = {}
+    for start, end, event_type in sorted(triggers):
+        event = {
+            'event_type': event_type,
+            'trigger': {'start': start, 'end': end, 'text': ' '.join(tokens[start:end])},
+            'arguments': []
+        }
+        trigger2event[(start, end, event_type)] = event
+        events.append(event)
+    for trigger, (start, end, role) in sorted(roles):
+        if trigger in trigger2event:
+            trigger2event[trigger]['arguments'].append({
+                'role': role, 'start': start, 'end': end, 'text': ' '.join(tokens[start:end])
+            })
+    return events
+
+def run_batch(batch_insts, fw):
+    batch = EEBatch(
+        tokens=[inst.tokens for inst in batch_insts],
+        pieces=[inst.pieces for inst in batch_insts],
+        piece_idxs=[inst.piece_idxs for inst in batch_insts],
+        token_lens=[inst.token_lens for inst in batch_insts],
+        token_start_idxs=[inst.token_start_idxs for inst in batch_insts],
+        wnd_ids=[inst.wnd_id for inst in batch_insts],
+    )
+    p_triggers, p_roles, p_texts = predict_batch(model, tokenizer, batch, vocab, template_file, config, device=device)
+    for inst, pt, pr, te in zip(batch_insts, p_triggers, p_roles, p_texts):
+        fw.write(json.dumps({
+            'doc_id': inst.doc_id,
+            'wnd_id': inst.wnd_id,
+            'tokens': inst.tokens,
+            'pred text': te,
+            'events': to_event_objects(inst.tokens, pt, pr)
+        }) + '\n')
+
+# set device
+if config.gpu_device >= 0 and torch.cuda.is_available():
+    torch.cuda.set_device(config.gpu_device)
+    device = torch.device('cuda', config.gpu_device)
+else:
+    device = torch.device('cpu')
+
+# check valid styles
+assert np.all([style in ['event_type', 'event_type_sent', 'static_keywords', 'template'] for style in config.input_style])
+assert np.all([style in ['trigger:sentence', 'argument:sentence'] for style in config.output_style])
+
+# tokenizer
+tokenizer = AutoTokenizer.from_pretrained(config.model_name, cache_dir=config.cache_dir)
+special_tokens = ['<Trigger>', '<sep>', '<and>', '<Keyword>', '</Keyword>']
+tokenizer.add_tokens(special_tokens)
+
+batch_size = args.batch_size or config.eval_batch_size
+with open(config.vocab_file) as f:
+    vocab = json.load(f)
+
+# load model
+logger.info(f"Loading model from {args.model}")
+model = GenerativeModel(config, tokenizer)
+model.load_state_dict(torch.load(args.model, map_location=device))
+model.to(device)
+model.eval()
+
+# windows are read, predicted and written one micro-batch at a time, so memory does not grow with the corpus
+wnd_num, skip_num, batch_num = 0, 0, 0
+progress = tqdm.tqdm(ncols=75, desc='Inference', unit='wnd')
+with open(args.output, 'w', encoding='utf-8') as fw:
+    batch_insts = []
+    for doc_id, wnd_id, tokens in iter_windows(args.input, args.window):
+        inst = build_instance(doc_id, wnd_id, tokens)
+        if len(inst.pieces) == 0 or len(inst.pieces) > config.max_length:
+            skip_num += 1
+            fw.write(json.dumps({'doc_id': doc_id, 'wnd_id': wnd_id, 'tokens': tokens, 'events': [], 'skipped': True}) + '\n')
+            continue
+        batch_insts.append(inst)
+        if len(batch_insts) == batch_size:
+            run_batch(batch_insts, fw)
+            wnd_num += len(batch_insts)
+            progress.update(len(batch_insts))
+            batch_insts = []
+            batch_num += 1
+            if batch_num % args.flush_every == 0:
+                fw.flush()
+    if batch_insts:
+        run_batch(batch_insts, fw)
+        wnd_num += len(batch_insts)
+        progress.update(len(batch_insts))
+progress.close()
+
+logger.info(f'Extracted events from {wnd_num} windows ({skip_num} skipped for exceeding max_length {config.max_length}), written to {args.output}')
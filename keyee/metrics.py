@@ -0,0 +1,240 @@
+import numpy as np
+from collections import Counter
+from utils import compute_f1
+
+METRICS = ['tri_id', 'tri_cls', 'arg_id', 'arg_cls']
+
+class EventScorer(object):
+    """
+    Incremental scorer for trigger and argument extraction.
+
+    Counts are updated batch by batch, so scores are available at any point of a long
+    evaluation and memory does not grow with the number of sentences. Besides the four
+    overall metrics, gold/pred/match counts are kept per event type (triggers and
+    arguments) and per role type. Scorers of different shards or processes can be
+    combined with `merge` or through `state_dict`/`from_state_dict`.
+
+    With `keep_sentence_counts`, the per-sentence counts are also recorded so that
+    significance tests can be run on them (see `sentence_count_array`).
+    """
+    def __init__(self, keep_sentence_counts=False):
+        self.keep_sentence_counts = keep_sentence_counts
+        self.sentence_counts = []
+        self.sentence_num = 0
+        self.counts = {metric: [0, 0, 0] for metric in METRICS}
+        self.event_type_counts = {'tri_cls': [Counter(), Counter(), Counter()], 'arg_cls': [Counter(), Counter(), Counter()]}
+        self.role_type_counts = [Counter(), Counter(), Counter()]
+
+    def update(self, gold_triggers, pred_triggers, gold_roles, pred_roles):
+        assert len(gold_triggers) == len(pred_triggers)
+        assert len(gold_roles) == len(pred_roles)
+        for gold_trigger, pred_trigger, gold_role, pred_role in zip(gold_triggers, pred_triggers, gold_roles, pred_roles):
+            self.update_instance(gold_trigger, pred_trigger, gold_role, pred_role)
+
+    def update_instance(self, gold_trigger, pred_trigger, gold_role, pred_role):
+        """Update the counts with a single sentence and return its (gold, pred, match) counts per metric."""
+        # each set is built once and the identification sets are projected from the classification ones
+        gold_tri_cls = set(gold_trigger)
+        pred_tri_cls = set(pred_trigger)
+        gold_arg_cls = set([(r[0][2],)+r[1] for r in gold_role])
+        pred_arg_cls = set([(r[0][2],)+r[1] for r in pred_role])
+        match_tri_cls = gold_tri_cls & pred_tri_cls
+        match_arg_cls = gold_arg_cls & pred_arg_cls
+
+        gold_tri_id = set([t[:2] for t in gold_tri_cls])
+        pred_tri_id = set([t[:2] for t in pred_tri_cls])
+        gold_arg_id = set([r[:-1] for r in gold_arg_cls])
+        pred_arg_id = set([r[:-1] for r in pred_arg_cls])
+
+        sub_counts = {
+            'tri_id': (len(gold_tri_id), len(pred_tri_id), len(gold_tri_id & pred_tri_id)),
+            'tri_cls': (len(gold_tri_cls), len(pred_tri_cls), len(match_tri_cls)),
+            'arg_id': (len(gold_arg_id), len(pred_arg_id), len(gold_arg_id & pred_arg_id)),
+            'arg_cls': (len(gold_arg_cls), len(pred_arg_cls), len(match_arg_cls)),
+        }
+        for metric, sub_count in sub_counts.items():
+            for i in range(3):
+                self.counts[metric][i] += sub_count[i]
+
+        for counter, items in zip(self.event_type_counts['tri_cls'], [gold_tri_cls, pred_tri_cls, match_tri_cls]):
+            counter.update([t[2] for t in items])
+        for counter, items in zip(self.event_type_counts['arg_cls'], [gold_arg_cls, pred_arg_cls, match_arg_cls]):
+            counter.update([r[0] for r in items])
+        for counter, items in zip(self.role_type_counts, [gold_arg_cls, pred_arg_cls, match_arg_cls]):
+            counter.update([r[-1] for r in items])
+
+        if self.keep_sentence_counts:
+            self.sentence_counts.append(tuple(n for metric in METRICS for n in sub_counts[metric]))
+        self.sentence_num += 1
+        return sub_counts
+
+    def merge(self, other):
+        self.sentence_counts.extend(other.sentence_counts)
+        self.sentence_num += other.sentence_num
+        for metric in METRICS:
+            for i in range(3):
+                self.counts[metric][i] += other.counts[metric][i]
+        for metric in self.event_type_counts:
+            for i in range(3):
+                self.event_type_counts[metric][i].update(other.event_type_counts[metric][i])
+        for i in range(3):
+            self.role_type_counts[i].update(other.role_type_counts[i])
+        return self
+
+    def scores(self):
+        """Overall scores, in the same format as `cal_scores`: (gold, pred, match, precision, recall, f1)."""
+        scores = {}
+        for metric in METRICS:
+            gold_num, pred_num, match_num = self.counts[metric]
+            scores[metric] = (gold_num, pred_num, match_num) + compute_f1(pred_num, gold_num, match_num)
+        return scores
+
+    def type_scores(self):
+        """Per event type (tri_cls, arg_cls) and per role type (arg_cls) scores."""
+        def _scores(gold_counter, pred_counter, match_counter):
+            output = {}
+            for key in sorted(set(gold_counter) | set(pred_counter)):
+                gold_num, pred_num, match_num = gold_counter[key], pred_counter[key], match_counter[key]
+                output[key] = (gold_num, pred_num, match_num) + compute_f1(pred_num, gold_num, match_num)
+            return output
+
+        return {
+            'event_type': {metric: _scores(*counters) for metric, counters in self.event_type_counts.items()},
+            'role_type': _scores(*self.role_type_counts),
+        }
+
+    def sentence_count_array(self):
+        """Per-sentence counts as an int array of shape (sentence_num, len(METRICS), 3) of (gold, pred, match)."""
+        assert self.keep_sentence_counts, 'sentence counts are only kept with keep_sentence_counts=True'
+        return np.array(self.sentence_counts, dtype=np.int64).reshape(-1, len(METRICS), 3)
+
+    def state_dict(self):
+        return {
+            'keep_sentence_counts': self.keep_sentence_counts,
+            'sentence_counts': [list(c) for c in self.sentence_counts],
+            'sentence_num': self.sentence_num,
+            'counts': {metric: list(count) for metric, count in self.counts.items()},
+            'event_type_counts': {metric: [dict(c) for c in counters] for metric, counters in self.event_type_counts.items()},
+            'role_type_counts': [dict(c) for c in self.role_type_counts],
+        }
+
+    @classmethod
+    def from_state_dict(cls, state):
+        scorer = cls(keep_sentence_counts=state.get('keep_sentence_counts', False))
+        scorer.sentence_counts = [tuple(c) for c in state.get('sentence_counts', [])]
+        scorer.sentence_num = state['sentence_num']
+        scorer.counts = {metric: list(count) for metric, count in state['counts'].items()}
+        scorer.event_type_counts = {metric: [Counter(c) for c in counters] for metric, counters in state['event_type_counts'].items()}
+        scorer.role_type_counts = [Counter(c) for c in state['role_type_counts']]
+        return scorer
+
+def f1_from_counts(counts):
+    """Vectorized F1 over the last axis of an array of (gold, pred, match) counts, equal to `compute_f1(pred, gold, match)[2]`."""
+    counts = np.asarray(counts, dtype=np.float64)
+    denom = counts[..., 0] + counts[..., 1]
+    return np.divide(2 * counts[..., 2], denom, out=np.zeros_like(denom), where=(denom > 0) & (counts[..., 2] > 0))
+
+def _bootstrap_weights(rng, sentence_num, sample_num):
+    # resampling N sentences with replacement is a multinomial draw of how often each sentence is picked
+    return rng.multinomial(sentence_num, np.full(sentence_num, 1.0 / sentence_num), size=sample_num)
+
+def _chunks(n_samples, sentence_num, max_elements=2**24):
+    chunk_size = max(1, min(n_samples, max_elements // max(sentence_num, 1)))
+    for start in range(0, n_samples, chunk_size):
+        yield min(chunk_size, n_samples - start)
+
+def bootstrap_confidence_interval(counts, n_samples=1000, alpha=0.05, seed=42):
+    """
+    Percentile bootstrap confidence interval of every F1 metric.
+
+    args:
+        counts: per-sentence counts of shape (N, len(METRICS), 3), see `EventScorer.sentence_count_array`
+    returns:
+        dict metric -> (f1, lower, upper)
+    """
+    counts = np.asarray(counts)
+    sentence_num = counts.shape[0]
+    flat_counts = counts.reshape(sentence_num, -1)
+    rng = np.random.default_rng(seed)
+    sample_f1 = []
+    for chunk_size in _chunks(n_samples, sentence_num):
+        weights = _bootstrap_weights(rng, sentence_num, chunk_size)
+        sample_f1.append(f1_from_counts((weights @ flat_counts).reshape(chunk_size, len(METRICS), 3)))
+    sample_f1 = np.concatenate(sample_f1, axis=0)
+    f1 = f1_from_counts(counts.sum(axis=0))
+    lower = np.percentile(sample_f1, 100 * alpha / 2, axis=0)
+    upper = np.percentile(sample_f1, 100 * (1 - alpha / 2), axis=0)
+    return {metric: (float(f1[i]), float(lower[i]), float(upper[i])) for i, metric in enumerate(METRICS)}
+
+def paired_bootstrap_test(counts_a, counts_b, n_samples=10000, seed=42):
+    """
+    Paired bootstrap test (Berg-Kirkpatrick et al., 2012), one-sided in the direction of the observed
+    difference: of A being better than B if delta > 0, of B being better than A if delta < 0. Without
+    a difference (e.g. identical outputs) the p-value is 1. Both systems must be scored on the same
+    sentences in the same order.
+
+    returns:
+        dict metric -> (delta f1, p-value)
+    """
+    counts_a, counts_b = np.asarray(counts_a), np.asarray(counts_b)
+    assert counts_a.shape == counts_b.shape
+    sentence_num = counts_a.shape[0]
+    flat_a, flat_b = counts_a.reshape(sentence_num, -1), counts_b.reshape(sentence_num, -1)
+    delta = f1_from_counts(counts_a.sum(axis=0)) - f1_from_counts(counts_b.sum(axis=0))
+    sign = np.sign(delta)
+    rng = np.random.default_rng(seed)
+    exceed = np.zeros(len(METRICS), dtype=np.int64)
+    for chunk_size in _chunks(n_samples, sentence_num):
+        weights = _bootstrap_weights(rng, sentence_num, chunk_size)
+        sample_delta = f1_from_counts((weights @ flat_a).reshape(chunk_size, len(METRICS), 3)) \
+            - f1_from_counts((weights @ flat_b).reshape(chunk_size, len(METRICS), 3))
+        exceed += (sign * sample_delta > 2 * sign * delta).sum(axis=0)
+    p_values = np.where(sign == 0, 1.0, exceed / n_samples)
+    return {metric: (float(delta[i]), float(p_values[i])) for i, metric in enumerate(METRICS)}
+
+def approximate_randomization_test(counts_a, counts_b, n_samples=10000, seed=42):
+    """
+    Two-sided approximate randomization test: the outputs of A and B are swapped per sentence
+    with probability 0.5 and the F1 difference is compared with the observed one.
+
+    returns:
+        dict metric -> (delta f1, p-value)
+    """
+    counts_a, counts_b = np.asarray(counts_a), np.asarray(counts_b)
+    assert counts_a.shape == counts_b.shape
+    sentence_num = counts_a.shape[0]
+    total_a, total_b = counts_a.sum(axis=0).reshape(-1), counts_b.sum(axis=0).reshape(-1)
+    diff = (counts_a - counts_b).reshape(sentence_num, -1)
+    delta = f1_from_counts(counts_a.sum(axis=0)) - f1_from_counts(counts_b.sum(axis=0))
+    rng = np.random.default_rng(seed)
+    exceed = np.zeros(len(METRICS), dtype=np.int64)
+    for chunk_size in _chunks(n_samples, sentence_num):
+        swap = (rng.random((chunk_size, sentence_num)) < 0.5).astype(np.int64)
+        swapped = swap @ diff
+        sample_delta = f1_from_counts((total_a - swapped).reshape(chunk_size, len(METRICS), 3)) \
+            - f1_from_counts((total_b + swapped).reshape(chunk_size, len(METRICS), 3))
+        exceed += (np.abs(sample_delta) >= np.abs(delta) - 1e-12).sum(axis=0)
+    p_values = (exceed + 1) / (n_samples + 1)
+    return {metric: (float(delta[i]), float(p_values[i])) for i, metric in enumerate(METRICS)}
+
+def cal_scores(gold_triggers, pred_triggers, gold_roles, pred_roles):
+    scorer = EventScorer()
+    scorer.update(gold_triggers, pred_triggers, gold_roles, pred_roles)
+    return scorer.scores()
+
+def log_scores(logger, scores):
+    logger.info("---------------------------------------------------------------------")
+    logger.info('Trigger I  - P: {:6.2f} ({:4d}/{:4d}), R: {:6.2f} ({:4d}/{:4d}), F: {:6.2f}'.format(
+        scores['tri_id'][3] * 100.0, scores['tri_id'][2], scores['tri_id'][1],
+        scores['tri_id'][4] * 100.0, scores['tri_id'][2], scores['tri_id'][0], scores['tri_id'][5] * 100.0))
+    logger.info('Trigger C  - P: {:6.2f} ({:4d}/{:4d}), R: {:6.2f} ({:4d}/{:4d}), F: {:6.2f}'.format(
+        scores['tri_cls'][3] * 100.0, scores['tri_cls'][2], scores['tri_cls'][1],
+        scores['tri_cls'][4] * 100.0, scores['tri_cls'][2], scores['tri_cls'][0], scores['tri_cls'][5] * 100.0))
+    logger.info("---------------------------------------------------------------------")
+    logger.info('Role I     - P: {:6.2f} ({:4d}/{:4d}), R: {:6.2f} ({:4d}/{:4d}), F: {:6.2f}'.format(
+        scores['arg_id'][3] * 100.0, scores['arg_id'][2], scores['arg_id'][1],
+        scores['arg_id'][4] * 100.0, scores['arg_id'][2], scores['arg_id'][0], scores['arg_id'][5] * 100.0))
+    logger.info('Role C     - P: {:6.2f} ({:4d}/{:4d}), R: {:6.2f} ({:4d}/{:4d}), F: {:6.2f}'.format(
+        scores['arg_cls'][3] * 100.0, scores['arg_cls'][2], scores['arg_cls'][1],
+        scores['arg_cls'][4] * 100.0, scores['arg_cls'][2], scores['arg_cls'][0], scores['arg_cls'][5] * 100.0))
+    logger.info("---------------------------------------------------------------------")
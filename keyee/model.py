@@ -1,4 +1,5 @@
 import logging
+import inspect
 import torch
 import torch.nn as nn
 from transformers import AutoConfig, AutoModelForPreTraining
@@ -14,18 +15,41 @@ class GenerativeModel(nn.Module):
         self.model_config =  AutoConfig.from_pretrained(config.model_name, cache_dir=config.cache_dir)
         self.model = AutoModelForPreTraining.from_pretrained(config.model_name, cache_dir=config.cache_dir, config=self.model_config)
         self.model.resize_token_embeddings(len(self.tokenizer))
+        if getattr(config, 'gradient_checkpointing', False):
+            # recompute the activations of every encoder/decoder layer in backward instead of storing them
+            self.model.config.use_cache = False
+            if 'gradient_checkpointing_kwargs' in inspect.signature(self.model.gradient_checkpointing_enable).parameters:
+                self.model.gradient_checkpointing_enable(gradient_checkpointing_kwargs={'use_reentrant': False})
+            else:
+                # transformers < 4.35 always uses reentrant checkpointing
+                self.model.gradient_checkpointing_enable()
 
-    def forward(self, batch):
+    def forward(self, batch, *batches):
+        """Loss of `batch`, plus the losses of `batches`, so that the EE and keyword batches go through DDP in one forward."""
+        loss = 0
+        for batch_ in (batch,) + batches:
+            outputs = self.model(input_ids=batch_.enc_idxs, 
+                                 attention_mask=batch_.enc_attn, 
+                                 decoder_input_ids=batch_.dec_idxs, 
+                                 decoder_attention_mask=batch_.dec_attn, 
+                                 labels=batch_.lbl_idxs, 
+                                 return_dict=True)
+            
+            loss = loss + outputs['loss']
+        
+        return loss
+
+    def example_losses(self, batch):
+        """Mean token loss of every example of the batch, used to find hard negatives."""
         outputs = self.model(input_ids=batch.enc_idxs, 
                              attention_mask=batch.enc_attn, 
                              decoder_input_ids=batch.dec_idxs, 
                              decoder_attention_mask=batch.dec_attn, 
-                             labels=batch.lbl_idxs, 
                              return_dict=True)
         
-        loss = outputs['loss']
-        
-        return loss
+        token_losses = nn.functional.cross_entropy(outputs['logits'].float().transpose(1, 2), batch.lbl_idxs, ignore_index=-100, reduction='none')
+        mask = batch.lbl_idxs != -100
+        return (token_losses * mask).sum(1) / mask.sum(1).clamp(min=1)
         
     def predict(self, batch, num_beams=4, max_length=50):
         self.eval()
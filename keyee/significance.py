@@ -0,0 +1,48 @@
+import json, logging
+import numpy as np
+from argparse import ArgumentParser
+from metrics import METRICS, bootstrap_confidence_interval, paired_bootstrap_test, approximate_randomization_test
+
+# configuration
+parser = ArgumentParser(description='Compare evaluation runs saved by `eval.py --save_counts`. The first file is the baseline.')
+parser.add_argument('counts', nargs='+', help='.npz files with per-sentence counts')
+parser.add_argument('--n_samples', type=int, default=10000)
+parser.add_argument('--alpha', type=float, default=0.05)
+parser.add_argument('--seed', type=int, default=42)
+parser.add_argument('--write_file', type=str, help='Save the comparison as JSON')
+args = parser.parse_args()
+
+# logger
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(message)s', datefmt='[%Y-%m-%d %H:%M:%S]')
+logger = logging.getLogger(__name__)
+
+runs = []
+for path in args.counts:
+    data = np.load(path)
+    runs.append((path, data['counts'], data['wnd_ids']))
+
+baseline_path, baseline_counts, baseline_wnd_ids = runs[0]
+results = []
+for path, counts, wnd_ids in runs:
+    result = {'file': path, 'ci': bootstrap_confidence_interval(counts, args.n_samples, args.alpha, args.seed)}
+    if path != baseline_path:
+        # paired tests are only meaningful on the same sentences in the same order
+        assert np.array_equal(wnd_ids, baseline_wnd_ids), f'{path} was not evaluated on the same sentences as {baseline_path}'
+        result['bootstrap'] = paired_bootstrap_test(counts, baseline_counts, args.n_samples, args.seed)
+        result['randomization'] = approximate_randomization_test(counts, baseline_counts, args.n_samples, args.seed)
+    results.append(result)
+
+    logger.info("---------------------------------------------------------------------")
+    logger.info(path)
+    for metric in METRICS:
+        f1, lower, upper = result['ci'][metric]
+        line = '{:8s} - F: {:6.2f} [{:6.2f}, {:6.2f}]'.format(metric, f1 * 100.0, lower * 100.0, upper * 100.0)
+        if 'bootstrap' in result:
+            line += ', delta: {:+6.2f}, bootstrap p: {:.4f}, randomization p: {:.4f}'.format(
+                result['bootstrap'][metric][0] * 100.0, result['bootstrap'][metric][1], result['randomization'][metric][1])
+        logger.info(line)
+logger.info("---------------------------------------------------------------------")
+
+if args.write_file:
+    with open(args.write_file, 'w') as fw:
+        json.dump(results, fw, indent=4)
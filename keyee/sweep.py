@@ -0,0 +1,162 @@
+import os, sys, json, glob, time, logging, subprocess
+import numpy as np
+from argparse import ArgumentParser, Namespace
+from dataset import read_header, subset_examples
+
+# configuration
+parser = ArgumentParser(description='Train every low-resource split x seed combination of a dataset and collect the scores.')
+parser.add_argument('-c', '--config', required=True, help='Base configuration, its train files should be the full training set')
+parser.add_argument('-s', '--split_dir', help='Directory of doc_list_* files (default: resource/low_resource_split/<dataset>)')
+parser.add_argument('--splits', nargs='+', help='Split names to run, e.g. 001 010 (default: all doc lists in split_dir)')
+parser.add_argument('--seeds', nargs='+', type=int, default=[42])
+parser.add_argument('--devices', nargs='+', type=int, default=[0], help='One training slot per entry, -1 is a CPU slot, e.g. --devices 0 1 -1 -1')
+parser.add_argument('--cpu_threads', type=int, default=4, help='OMP_NUM_THREADS of each CPU slot')
+parser.add_argument('-o', '--output_dir', help='Sweep directory (default: <output_dir of the config>/sweep)')
+parser.add_argument('--regenerate', action='store_true', default=False, help='Run generate_data.py even if the full artifacts exist')
+args = parser.parse_args()
+with open(args.config) as fp:
+    config = json.load(fp)
+config = Namespace(**config)
+
+split_dir = args.split_dir or os.path.join('resource', 'low_resource_split', config.dataset)
+sweep_dir = args.output_dir or os.path.join(config.output_dir, 'sweep')
+os.makedirs(sweep_dir, exist_ok=True)
+keyee_dir = os.path.dirname(os.path.abspath(__file__))
+
+# logger
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(message)s', datefmt='[%Y-%m-%d %H:%M:%S]',
+                    handlers=[logging.FileHandler(os.path.join(sweep_dir, 'sweep.log')), logging.StreamHandler()])
+logger = logging.getLogger(__name__)
+
+def has_doc_ids(path):
+    if not os.path.exists(path):
+        return False
+    # single pickles of earlier versions are generated again
+    return read_header(path) is not None
+
+def finished_history(run_dir):
+    """Score history of the last run in `run_dir` that trained all its epochs, None if there is none."""
+    for score_file in sorted(glob.glob(os.path.join(run_dir, '*', 'scores.json')), reverse=True):
+        with open(score_file) as f:
+            scores = json.load(f)
+        if 'finished' in scores:
+            finished = scores['finished']
+        else:
+            # scores of earlier versions, written after every epoch without the flag
+            with open(os.path.join(os.path.dirname(score_file), 'config.json')) as f:
+                finished = len(scores['history']) == json.load(f)['max_epoch']
+        if finished:
+            return scores['history']
+    return None
+
+def collect_scores(run_dir):
+    """Scores of the epoch with the best dev arg_cls F1, of a finished run."""
+    history = finished_history(run_dir)
+    if not history:
+        return None
+    best = max(history, key=lambda x: x['dev_scores']['arg_cls'][2])
+    return {
+        'epoch': best['epoch'],
+        'dev': {metric: best['dev_scores'][metric][2] for metric in ['tri_id', 'arg_id', 'arg_cls']},
+        'test': {metric: best['test_scores'][metric][2] for metric in ['tri_id', 'arg_id', 'arg_cls']},
+    }
+
+# 1. generate the finetune data of the full training set once, dev and test artifacts are shared by all runs
+if args.regenerate or not (has_doc_ids(config.train_finetune_file) and has_doc_ids(config.keyword_train_finetune_file)):
+    logger.info('Generating the full finetune data')
+    subprocess.run([sys.executable, os.path.join(keyee_dir, 'generate_data.py'), '-c', args.config], check=True)
+
+# 2. cut every low-resource split out of the full artifacts, once per split
+split_names = args.splits or sorted([os.path.basename(path)[len('doc_list_'):] for path in glob.glob(os.path.join(split_dir, 'doc_list_*'))])
+split_files = {}
+for split in split_names:
+    with open(os.path.join(split_dir, 'doc_list_{}'.format(split))) as f:
+        doc_ids = set([x.strip('\n') for x in f if x.strip()])
+    split_data_dir = os.path.join(config.finetune_dir, 'splits', split)
+    os.makedirs(split_data_dir, exist_ok=True)
+    train_file = os.path.join(split_data_dir, 'train_all.pkl')
+    keyword_train_file = os.path.join(split_data_dir, 'train_keywords_all.pkl')
+    n_example = subset_examples(config.train_finetune_file, train_file, doc_ids)
+    n_keyword = subset_examples(config.keyword_train_finetune_file, keyword_train_file, doc_ids)
+    logger.info(f'Split {split}: {len(doc_ids)} documents, {n_example} training examples, {n_keyword} keyword examples')
+    split_files[split] = (train_file, keyword_train_file)
+
+# 3. one configuration per split x seed
+jobs = []
+for split in split_names:
+    for seed in args.seeds:
+        run_dir = os.path.join(sweep_dir, split, str(seed))
+        if collect_scores(run_dir) is not None:
+            logger.info(f'Skipping split {split} seed {seed}, already finished')
+            continue
+        if glob.glob(os.path.join(run_dir, '*', 'scores.json')):
+            logger.info(f'Running split {split} seed {seed} again, the last run did not finish')
+        os.makedirs(run_dir, exist_ok=True)
+        run_config = dict(vars(config))
+        run_config.update({
+            'seed': seed,
+            'train_finetune_file': split_files[split][0],
+            'keyword_train_finetune_file': split_files[split][1],
+            'output_dir': run_dir,
+        })
+        jobs.append((split, seed, run_dir, run_config))
+logger.info(f'{len(jobs)} runs on {len(args.devices)} slots')
+
+# 4. run the jobs, one per slot at a time
+running = {}
+free_slots = list(range(len(args.devices)))
+failed = []
+while jobs or running:
+    while jobs and free_slots:
+        slot = free_slots.pop(0)
+        split, seed, run_dir, run_config = jobs.pop(0)
+        run_config['gpu_device'] = args.devices[slot]
+        config_path = os.path.join(run_dir, 'config.json')
+        with open(config_path, 'w') as f:
+            json.dump(run_config, f, indent=4)
+        env = dict(os.environ)
+        if args.devices[slot] < 0:
+            env['OMP_NUM_THREADS'] = str(args.cpu_threads)
+        log_file = open(os.path.join(run_dir, 'stdout.log'), 'w')
+        process = subprocess.Popen([sys.executable, os.path.join(keyee_dir, 'train.py'), '-c', config_path],
+                                   stdout=log_file, stderr=subprocess.STDOUT, env=env)
+        running[slot] = (process, log_file, split, seed)
+        logger.info(f'Started split {split} seed {seed} on device {args.devices[slot]}')
+
+    time.sleep(10)
+    for slot, (process, log_file, split, seed) in list(running.items()):
+        if process.poll() is not None:
+            log_file.close()
+            del running[slot]
+            free_slots.append(slot)
+            if process.returncode != 0:
+                failed.append((split, seed))
+                logger.info(f'Split {split} seed {seed} failed with code {process.returncode}')
+            else:
+                logger.info(f'Finished split {split} seed {seed}')
+
+# 5. summary
+summary = {}
+lines = ['split\tseeds\tdev_arg_cls\ttest_tri_id\ttest_arg_id\ttest_arg_cls']
+for split in split_names:
+    runs = {}
+    for seed in args.seeds:
+        scores = collect_scores(os.path.join(sweep_dir, split, str(seed)))
+        if scores is not None:
+            runs[seed] = scores
+    summary[split] = {'runs': runs}
+    if runs:
+        mean_std = lambda values: (float(np.mean(values)), float(np.std(values)))
+        summary[split]['dev_arg_cls'] = mean_std([r['dev']['arg_cls'] for r in runs.values()])
+        for metric in ['tri_id', 'arg_id', 'arg_cls']:
+            summary[split][f'test_{metric}'] = mean_std([r['test'][metric] for r in runs.values()])
+        lines.append('{}\t{}\t'.format(split, len(runs)) + '\t'.join(['{:.2f}±{:.2f}'.format(summary[split][key][0] * 100.0, summary[split][key][1] * 100.0)
+                                                                     for key in ['dev_arg_cls', 'test_tri_id', 'test_arg_id', 'test_arg_cls']]))
+
+with open(os.path.join(sweep_dir, 'summary.json'), 'w') as f:
+    json.dump(summary, f, indent=4)
+with open(os.path.join(sweep_dir, 'summary.tsv'), 'w') as f:
+    f.write('\n'.join(lines) + '\n')
+logger.info('Summary\n' + '\n'.join(lines))
+if failed:
+    logger.info(f'Failed runs: {failed}')
@@ -0,0 +1,234 @@
+import os, sys, json, re, math, inspect, random, logging
+from tqdm import tqdm
+from argparse import ArgumentParser
+from template_base import event_template
+
+logger = logging.getLogger(__name__)
+
+ENTITY_TYPES = ['PER', 'ORG', 'GPE', 'LOC', 'FAC', 'VEH', 'WEA']
+SPECIAL_TOKENS = ['<Trigger>', '<sep>', '<and>', '<Keyword>', '</Keyword>']
+
+def event_inventory(template_file):
+    """
+    Event types and their role types, read from the template classes of `template_file`
+    (`template_ace` or `template_ere`), e.g. {'Life:Be-Born': ['Person', 'Place'], ...}.
+    """
+    __import__(template_file)
+    inventory = {}
+    for name, theclass in inspect.getmembers(sys.modules[template_file], inspect.isclass):
+        if issubclass(theclass, event_template) and theclass is not event_template and theclass.__module__ == template_file:
+            event_type = name.replace('_', ':', 1).replace('_', '-')
+            inventory[event_type] = sorted(set(re.findall(r"ROLE_PH_MAP\['(\w+)'\]", inspect.getsource(theclass))))
+    return inventory
+
+def build_offline_tokenizer(output_dir):
+    """
+    Save a byte-level BART tokenizer without merges to `output_dir`, so synthetic data can
+    be built without any download. Every byte is a piece, which makes sequences longer
+    than with bart-large but goes through the same code paths.
+    """
+    from transformers import BartTokenizerFast
+    from transformers.models.bart.tokenization_bart import bytes_to_unicode
+
+    os.makedirs(output_dir, exist_ok=True)
+    vocab = ['<s>', '<pad>', '</s>', '<unk>'] + list(bytes_to_unicode().values()) + ['<mask>']
+    with open(os.path.join(output_dir, 'vocab.json'), 'w') as f:
+        json.dump({token: i for i, token in enumerate(vocab)}, f)
+    with open(os.path.join(output_dir, 'merges.txt'), 'w') as f:
+        f.write('#version: 0.2\n')
+    tokenizer = BartTokenizerFast(vocab_file=os.path.join(output_dir, 'vocab.json'), merges_file=os.path.join(output_dir, 'merges.txt'))
+    tokenizer.save_pretrained(output_dir)
+    return tokenizer
+
+def _poisson(rng, mean):
+    # Knuth's method, the means used here are small
+    threshold, k, p = math.exp(-mean), 0, 1.0
+    while True:
+        p *= rng.random()
+        if p < threshold:
+            return k
+        k += 1
+
+class SyntheticCorpus(object):
+    """
+    Random documents with the shape of ACE/ERE annotations.
+
+    Words are drawn from a Zipf-distributed vocabulary of random strings, so frequent
+    words repeat as in real text. Per sentence, the number of entities and events is
+    Poisson distributed around `entity_density` and `event_density`, and every event gets
+    about `argument_density` arguments, taken from the entities of its sentence with roles
+    of its event type. A fraction `overlap_ratio` of the entities overlaps an earlier one,
+    as a few do in ACE.
+    """
+    def __init__(self, template_file='template_ace', seed=42, sentences_per_doc=10, min_length=8, max_length=40,
+                 entity_density=4.0, event_density=0.6, argument_density=1.5, overlap_ratio=0.02, vocab_size=5000):
+        self.rng = random.Random(seed)
+        self.inventory = event_inventory(template_file)
+        self.event_types = sorted(self.inventory)
+        self.sentences_per_doc = sentences_per_doc
+        self.min_length = min_length
+        self.max_length = max_length
+        self.entity_density = entity_density
+        self.event_density = event_density
+        self.argument_density = argument_density
+        self.overlap_ratio = overlap_ratio
+        letters = 'abcdefghijklmnopqrstuvwxyz'
+        self.words = sorted(set(''.join(self.rng.choice(letters) for _ in range(self.rng.randint(2, 10))) for _ in range(vocab_size)))
+        self.rng.shuffle(self.words)
+        cum_weights, total = [], 0.0
+        for rank in range(len(self.words)):
+            total += 1.0 / (rank + 1)
+            cum_weights.append(total)
+        self.cum_weights = cum_weights
+
+    def sentence(self):
+        """Tokens, entities [(start, end, type)] and events [(trigger start, trigger end, type, [(entity index, role)])] of one sentence."""
+        rng = self.rng
+        tokens = rng.choices(self.words, cum_weights=self.cum_weights, k=rng.randint(self.min_length, self.max_length))
+        taken = [False] * len(tokens)
+        entities = []
+        for _ in range(_poisson(rng, self.entity_density)):
+            length = rng.choice([1, 1, 1, 2, 2, 3])
+            start = rng.randrange(len(tokens) - length + 1)
+            if any(taken[start:start + length]) and rng.random() >= self.overlap_ratio:
+                continue
+            entities.append((start, start + length, rng.choice(ENTITY_TYPES)))
+            for i in range(start, start + length):
+                taken[i] = True
+        entities.sort()
+
+        events = []
+        free = [i for i, t in enumerate(taken) if not t]
+        rng.shuffle(free)
+        for trigger in free[:_poisson(rng, self.event_density)]:
+            event_type = rng.choice(self.event_types)
+            roles = self.inventory[event_type]
+            arguments = []
+            if roles and entities:
+                for entity_idx in rng.sample(range(len(entities)), min(len(entities), _poisson(rng, self.argument_density))):
+                    arguments.append((entity_idx, rng.choice(roles)))
+            events.append((trigger, trigger + 1, event_type, arguments))
+        events.sort()
+        return tokens, entities, events
+
+    def documents(self, n_sentences):
+        """Yield (doc_id, sentences) until `n_sentences` sentences are generated."""
+        doc_num = 0
+        while n_sentences > 0:
+            sent_num = min(n_sentences, self.sentences_per_doc)
+            yield 'SYN{:07d}'.format(doc_num), [self.sentence() for _ in range(sent_num)]
+            n_sentences -= sent_num
+            doc_num += 1
+
+def to_oneie(doc_id, sentences, tokenize):
+    """Windows of one sentence in the format written by the preprocessing scripts."""
+    for i, (tokens, entities, events) in enumerate(sentences):
+        wnd_id = '{}-{}'.format(doc_id, i)
+        pieces = [tokenize(t) for t in tokens]
+        entity_mentions = [{'id': '{}-E{}'.format(wnd_id, j), 'start': start, 'end': end, 'entity_type': entity_type,
+                            'mention_type': 'UNK', 'text': ' '.join(tokens[start:end])}
+                           for j, (start, end, entity_type) in enumerate(entities)]
+        event_mentions = [{'event_type': event_type, 'id': '{}-EV{}'.format(wnd_id, j),
+                           'trigger': {'start': start, 'end': end, 'text': ' '.join(tokens[start:end])},
+                           'arguments': [{'entity_id': entity_mentions[entity_idx]['id'], 'text': entity_mentions[entity_idx]['text'], 'role': role}
+                                         for entity_idx, role in arguments]}
+                          for j, (start, end, event_type, arguments) in enumerate(events)]
+        yield {
+            'doc_id': doc_id,
+            'wnd_id': wnd_id,
+            'entity_mentions': entity_mentions,
+            'relation_mentions': [],
+            'event_mentions': event_mentions,
+            'entity_coreference': [],
+            'event_coreference': [],
+            'tokens': tokens,
+            'pieces': [p for w in pieces for p in w],
+            'token_lens': [len(p) for p in pieces],
+            'sentence': ' '.join(tokens),
+            'sentence_starts': [0],
+        }
+
+def to_dygie(doc_id, sentences):
+    """One document in the DyGIE++ format read by preprocessing/process_ace05e.py (document offsets, inclusive ends)."""
+    sentence_starts, ner, events, offset = [], [], [], 0
+    for tokens, entities_, events_ in sentences:
+        sentence_starts.append(offset)
+        ner.append([[offset + start, offset + end - 1, entity_type] for start, end, entity_type in entities_])
+        events.append([[[offset + start, event_type.replace(':', '.')]] +
+                       [[offset + entities_[entity_idx][0], offset + entities_[entity_idx][1] - 1, role] for entity_idx, role in arguments]
+                       for start, end, event_type, arguments in events_])
+        offset += len(tokens)
+    return {
+        'doc_key': doc_id,
+        'dataset': 'synthetic',
+        'sentences': [tokens for tokens, _, _ in sentences],
+        'ner': ner,
+        'relations': [[] for _ in sentences],
+        'events': events,
+        'clusters': [],
+        'event_clusters': [],
+        '_sentence_start': sentence_starts,
+    }
+
+def write_corpus(output_file, n_sentences, tokenizer=None, output_format='oneie', **kwargs):
+    """
+    Write `n_sentences` synthetic sentences to `output_file` (JSONL) and return the number of
+    documents. Documents are written as they are generated, so memory does not grow with
+    the corpus size. `tokenizer` is needed for the pieces of the OneIE format.
+    """
+    corpus = SyntheticCorpus(**kwargs)
+    piece_cache = {}
+    def tokenize(token):
+        if token not in piece_cache:
+            piece_cache[token] = tokenizer.tokenize(token)
+        return piece_cache[token]
+
+    doc_num = 0
+    progress = tqdm(total=n_sentences, ncols=75, desc='Synthetic')
+    with open(output_file, 'w', encoding='utf-8') as w:
+        for doc_id, sentences in corpus.documents(n_sentences):
+            if output_format == 'oneie':
+                for wnd in to_oneie(doc_id, sentences, tokenize):
+                    w.write(json.dumps(wnd) + '\n')
+            else:
+                w.write(json.dumps(to_dygie(doc_id, sentences)) + '\n')
+            progress.update(len(sentences))
+            doc_num += 1
+    progress.close()
+    return doc_num
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Generate a synthetic ACE/ERE-like corpus for load testing.')
+    parser.add_argument('-o', '--output', required=True, help='Path to the output file')
+    parser.add_argument('-n', '--n_sentences', type=int, default=100000)
+    parser.add_argument('-d', '--dataset', default='ace05e', choices=['ace05e', 'ace05ep', 'ere'], help='Event and role inventory')
+    parser.add_argument('-b', '--bert', help='Tokenizer name or path for the pieces (default: an offline byte-level BART tokenizer)')
+    parser.add_argument('-f', '--format', default='oneie', choices=['oneie', 'dygie'], help='oneie for keyee/, dygie for preprocessing/process_ace05e.py')
+    parser.add_argument('--sentences_per_doc', type=int, default=10)
+    parser.add_argument('--min_length', type=int, default=8)
+    parser.add_argument('--max_length', type=int, default=40)
+    parser.add_argument('--entity_density', type=float, default=4.0, help='Mean number of entities per sentence')
+    parser.add_argument('--event_density', type=float, default=0.6, help='Mean number of events per sentence')
+    parser.add_argument('--argument_density', type=float, default=1.5, help='Mean number of arguments per event')
+    parser.add_argument('--overlap_ratio', type=float, default=0.02, help='Fraction of entities overlapping another one')
+    parser.add_argument('--vocab_size', type=int, default=5000)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(message)s', datefmt='[%Y-%m-%d %H:%M:%S]')
+
+    tokenizer = None
+    if args.format == 'oneie':
+        from transformers import AutoTokenizer
+        if args.bert:
+            tokenizer = AutoTokenizer.from_pretrained(args.bert)
+        else:
+            tokenizer = build_offline_tokenizer(os.path.join(os.path.dirname(os.path.abspath(args.output)), 'offline_tokenizer'))
+        tokenizer.add_tokens(SPECIAL_TOKENS)
+
+    doc_num = write_corpus(args.output, args.n_sentences, tokenizer, args.format,
+                           template_file='template_ere' if args.dataset == 'ere' else 'template_ace', seed=args.seed,
+                           sentences_per_doc=args.sentences_per_doc, min_length=args.min_length, max_length=args.max_length,
+                           entity_density=args.entity_density, event_density=args.event_density,
+                           argument_density=args.argument_density, overlap_ratio=args.overlap_ratio, vocab_size=args.vocab_size)
+    logger.info(f'Wrote {args.n_sentences} sentences in {doc_num} documents to {args.output}')
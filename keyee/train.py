@@ -1,11 +1,14 @@
-import os, sys, json, logging, time, pprint, tqdm
+import os, sys, json, logging, time, pprint, resource, heapq, inspect, tqdm
 import numpy as np
 import torch
-from torch.utils.data import DataLoader
+import torch.distributed as dist
+from contextlib import nullcontext
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DataLoader, Subset
 from transformers import AutoTokenizer, AdamW, get_linear_schedule_with_warmup
 from model import GenerativeModel
-from dataset import GenDataset
-from utils import Summarizer, compute_f1
+from dataset import GenDataset, NegativeSampler
+from utils import Summarizer, MetricsSink, Profiler, ConfigurationError, compute_f1, check_precision, autocast, grad_scaler
 from argparse import ArgumentParser, Namespace
 import ipdb
 
@@ -23,33 +26,67 @@ np.random.seed(config.seed)
 torch.manual_seed(config.seed)
 torch.backends.cudnn.enabled = False
 
-# logger and summarizer
+# distributed data parallel, when launched with torchrun
+world_size = int(os.environ.get('WORLD_SIZE', 1))
+distributed = world_size > 1
+rank = int(os.environ.get('RANK', 0))
+local_rank = int(os.environ.get('LOCAL_RANK', 0))
+is_main = rank == 0
+if distributed:
+    dist.init_process_group(backend=getattr(config, 'dist_backend', None) or ('nccl' if config.gpu_device >= 0 else 'gloo'))
+
+# set GPU device, a negative gpu_device trains on CPU; with torchrun every process uses the GPU of its local rank
+if config.gpu_device >= 0:
+    gpu_device = local_rank if distributed else config.gpu_device
+    torch.cuda.set_device(gpu_device)
+    device = torch.device('cuda', gpu_device)
+else:
+    device = torch.device('cpu')
+
+# logger and summarizer, only the main process writes logs and outputs
 timestamp = time.strftime('%Y%m%d_%H%M%S', time.localtime())
+if distributed:
+    timestamp_ = [timestamp]
+    dist.broadcast_object_list(timestamp_, src=0)
+    timestamp = timestamp_[0]
 output_dir = os.path.join(config.output_dir, timestamp)
-if not os.path.exists(output_dir):
+if is_main and not os.path.exists(output_dir):
     os.makedirs(output_dir)
 log_path = os.path.join(output_dir, "train.log")
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(message)s', datefmt='[%Y-%m-%d %H:%M:%S]', 
-                    handlers=[logging.FileHandler(os.path.join(output_dir, "train.log")), logging.StreamHandler()])
+if is_main:
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(message)s', datefmt='[%Y-%m-%d %H:%M:%S]', 
+                        handlers=[logging.FileHandler(os.path.join(output_dir, "train.log")), logging.StreamHandler()])
+else:
+    logging.basicConfig(level=logging.WARNING, format=f'%(asctime)s - rank {rank} - %(name)s - %(message)s', datefmt='[%Y-%m-%d %H:%M:%S]')
 logger = logging.getLogger(__name__)
 logger.info(f"\n{pprint.pformat(vars(config), indent=4)}")
-summarizer = Summarizer(output_dir)
+if distributed:
+    logger.info(f'Distributed training on {world_size} processes ({dist.get_backend()})')
+summarizer = Summarizer(output_dir) if is_main else None
+profiler = Profiler(enabled=getattr(config, 'profile', True) and is_main, sync_cuda=getattr(config, 'profile_sync', False))
+profile_interval = getattr(config, 'profile_interval', 100)
+metrics = MetricsSink(summarizer, flush_every=getattr(config, 'metrics_interval', 20), enabled=is_main)
 
-# set GPU device
-torch.cuda.set_device(config.gpu_device)
+# mixed precision, fp16 scales the loss to avoid gradient underflow
+precision = getattr(config, 'precision', 'fp32')
+check_precision(precision, device)
+scaler = grad_scaler(precision)
 
 # check valid styles
 assert np.all([style in ['event_type', 'event_type_sent', 'static_keywords', 'template'] for style in config.input_style])
 assert np.all([style in ['trigger:sentence', 'argument:sentence'] for style in config.output_style])
 
 # output
-with open(os.path.join(output_dir, 'config.json'), 'w') as fp:
-    json.dump(vars(config), fp, indent=4)
+if is_main:
+    with open(os.path.join(output_dir, 'config.json'), 'w') as fp:
+        json.dump(vars(config), fp, indent=4)
 best_model_path = os.path.join(output_dir, 'best_model.mdl')
+scores_path = os.path.join(output_dir, 'scores.json')
 dev_prediction_path = os.path.join(output_dir, 'pred.dev.json')
 test_prediction_path = os.path.join(output_dir, 'pred.test.json')
 dev_keyword_prediction_path = os.path.join(output_dir, 'pred.keyword.dev.json')
 test_keyword_prediction_path = os.path.join(output_dir, 'pred.keyword.test.json')
+profile_path = os.path.join(output_dir, 'profile.json')
 
 # tokenizer
 tokenizer = AutoTokenizer.from_pretrained(config.model_name, cache_dir=config.cache_dir)
@@ -57,26 +94,123 @@ special_tokens = ['<Trigger>', '<sep>', '<and>', '<Keyword>', '</Keyword>']
 tokenizer.add_tokens(special_tokens)
 
 # load data
-train_set = GenDataset(tokenizer, config.max_length, config.train_finetune_file, config.max_output_length)
-dev_set = GenDataset(tokenizer, config.max_length, config.dev_finetune_file, config.max_output_length)
-test_set = GenDataset(tokenizer, config.max_length, config.test_finetune_file, config.max_output_length)
-keyword_train_set = GenDataset(tokenizer, config.max_length, config.keyword_train_finetune_file, config.max_output_length)
-keyword_dev_set = GenDataset(tokenizer, config.max_length, config.keyword_dev_finetune_file, config.max_output_length)
-keyword_test_set = GenDataset(tokenizer, config.max_length, config.keyword_test_finetune_file, config.max_output_length)
-train_batch_num = len(train_set) // config.train_batch_size + (len(train_set) % config.train_batch_size != 0)
-dev_batch_num = len(dev_set) // config.eval_batch_size + (len(dev_set) % config.eval_batch_size != 0)
-test_batch_num = len(test_set) // config.eval_batch_size + (len(test_set) % config.eval_batch_size != 0)
+# record files are read on demand, `example_cache_size` records (sentences) are cached per dataset
+cache_size = getattr(config, 'example_cache_size', 1024)
+train_set = GenDataset(tokenizer, config.max_length, config.train_finetune_file, config.max_output_length, device=device, cache_size=cache_size)
+dev_set = GenDataset(tokenizer, config.max_length, config.dev_finetune_file, config.max_output_length, device=device, cache_size=cache_size)
+test_set = GenDataset(tokenizer, config.max_length, config.test_finetune_file, config.max_output_length, device=device, cache_size=cache_size)
+keyword_train_set = GenDataset(tokenizer, config.max_length, config.keyword_train_finetune_file, config.max_output_length, device=device, cache_size=cache_size)
+keyword_dev_set = GenDataset(tokenizer, config.max_length, config.keyword_dev_finetune_file, config.max_output_length, device=device, cache_size=cache_size)
+keyword_test_set = GenDataset(tokenizer, config.max_length, config.keyword_test_finetune_file, config.max_output_length, device=device, cache_size=cache_size)
+assert config.train_batch_size % world_size == 0, 'train_batch_size must be divisible by the number of processes'
+
+# every epoch draws its own negatives from all the negatives of the training artifacts, n_negative per
+# sentence or negative_schedule[epoch - 1] (the last value for the later epochs), and every process
+# gets its part of them
+negative_schedule = getattr(config, 'negative_schedule', None)
+train_sampler = NegativeSampler(train_set, config.n_negative, negative_schedule, seed=config.seed, num_replicas=world_size, rank=rank)
+keyword_train_sampler = NegativeSampler(keyword_train_set, config.n_negative, negative_schedule, seed=config.seed, num_replicas=world_size, rank=rank)
+epoch_batch_num = lambda epoch: (train_sampler.total_size(epoch) + config.train_batch_size - 1) // config.train_batch_size
+
+# with hard_negative_interval set, the negatives are scored every that many epochs and the ones with a
+# high loss are drawn more often, see mine_hard_negatives
+hard_negative_interval = getattr(config, 'hard_negative_interval', None)
+hard_negative_uniform = getattr(config, 'hard_negative_uniform', 0.5)
+
+def shard(data_set):
+    """The contiguous block of `data_set` evaluated by this process."""
+    if not distributed:
+        return data_set
+    block = (len(data_set) + world_size - 1) // world_size
+    return Subset(data_set, range(min(rank * block, len(data_set)), min((rank + 1) * block, len(data_set))))
+
+dev_batch_num = (len(shard(dev_set)) + config.eval_batch_size - 1) // config.eval_batch_size
+test_batch_num = (len(shard(test_set)) + config.eval_batch_size - 1) // config.eval_batch_size
 
 # initialize the model
 model = GenerativeModel(config, tokenizer)
-model.cuda(device=config.gpu_device)
+model.to(device)
+
+def peak_memory_mb():
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated(device) / 2**20
+    # peak RSS of the process, it only grows, which is enough for probing increasing batch sizes
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def find_micro_batch_size(model, dataset, keyword_dataset, target_batch_size, memory_budget_mb):
+    """
+    Largest micro-batch size dividing `target_batch_size` whose training step fits in `memory_budget_mb`.
+
+    Every candidate is probed with a forward and backward pass on the longest examples of
+    both datasets, in the configured precision. The AdamW states, which are only allocated
+    at the first optimizer step, are added to the measured peak.
+    """
+    optimizer_state_mb = 2 * sum(p.numel() * p.element_size() for p in model.parameters()) / 2**20
+    # the longest examples are picked once, every candidate takes the first of them
+    longest_examples = [heapq.nlargest(target_batch_size, data_set, key=lambda x: len(x.input) + len(x.target))
+                        for data_set in [dataset, keyword_dataset]]
+    longest = lambda data_set, examples, n: data_set.collate_fn(examples[:n])
+    best = None
+    model.train()
+    for micro_batch_size in [b for b in range(1, target_batch_size + 1) if target_batch_size % b == 0]:
+        if device.type == 'cuda':
+            torch.cuda.empty_cache()
+            torch.cuda.reset_peak_memory_stats(device)
+        try:
+            with autocast(device, precision):
+                loss = model(longest(dataset, longest_examples[0], micro_batch_size),
+                             longest(keyword_dataset, longest_examples[1], micro_batch_size))
+            scaler.scale(loss).backward()
+            peak = peak_memory_mb() + optimizer_state_mb
+        except RuntimeError as e:
+            # torch.cuda.OutOfMemoryError (torch >= 1.13) is a RuntimeError
+            if 'out of memory' not in str(e):
+                raise
+            peak = float('inf')
+        model.zero_grad(set_to_none=True)
+        loss = None
+        logger.info(f'Micro-batch {micro_batch_size:3d}: peak memory {peak:10.1f} MB (budget {memory_budget_mb} MB)')
+        if peak > memory_budget_mb:
+            break
+        best = micro_batch_size
+    if device.type == 'cuda':
+        torch.cuda.empty_cache()
+    if best is None:
+        raise ConfigurationError(f'Even a micro-batch of 1 does not fit in {memory_budget_mb} MB')
+    return best
+
+# derive accumulate_step from the largest micro-batch that fits the memory budget
+# (per process, so with DDP the micro-batch is a divisor of train_batch_size / world_size)
+if getattr(config, 'memory_budget_mb', None):
+    micro_batch_size = find_micro_batch_size(model, train_set, keyword_train_set, config.train_batch_size // world_size, config.memory_budget_mb)
+    if distributed:
+        # every process must use the same accumulate_step
+        micro_batch_size_ = torch.tensor(micro_batch_size, device=device)
+        dist.all_reduce(micro_batch_size_, op=dist.ReduceOp.MIN)
+        micro_batch_size = int(micro_batch_size_)
+    config.accumulate_step = config.train_batch_size // world_size // micro_batch_size
+    logger.info(f'Micro-batch size {micro_batch_size}, accumulate_step {config.accumulate_step} for train_batch_size {config.train_batch_size}')
+    if is_main:
+        with open(os.path.join(output_dir, 'config.json'), 'w') as fp:
+            json.dump(vars(config), fp, indent=4)
+assert config.train_batch_size % (world_size * config.accumulate_step) == 0, 'train_batch_size must be divisible by world_size * accumulate_step'
+
+# gradients are averaged over the processes by DDP, every process trains on its part of the data
+static_graph = distributed and getattr(config, 'gradient_checkpointing', False)
+ddp_kwargs = {'static_graph': True} if static_graph else {}
+if static_graph:
+    # the EE and keyword batches run every checkpointed layer twice per step, with reentrant checkpointing (transformers
+    # < 4.35) its parameters are then marked ready twice in backward, which DDP only accepts for a static graph
+    if 'static_graph' not in inspect.signature(DistributedDataParallel).parameters:
+        raise ConfigurationError('gradient_checkpointing with distributed training needs torch >= 1.9')
+ddp_model = DistributedDataParallel(model, device_ids=[device.index] if device.type == 'cuda' else None, **ddp_kwargs) if distributed else model
 
 # optimizer
 param_groups = [{'params': model.parameters(), 'lr': config.learning_rate, 'weight_decay': config.weight_decay}]
 optimizer = AdamW(params=param_groups)
 schedule = get_linear_schedule_with_warmup(optimizer,
-                                           num_warmup_steps=train_batch_num*config.warmup_epoch,
-                                           num_training_steps=train_batch_num*config.max_epoch)
+                                           num_warmup_steps=sum(epoch_batch_num(epoch) for epoch in range(1, config.warmup_epoch+1)),
+                                           num_training_steps=sum(epoch_batch_num(epoch) for epoch in range(1, config.max_epoch+1)))
 
 
 def evaluation(model, dataset, keyword_dataset, config, progress):
@@ -94,12 +228,16 @@ def evaluation(model, dataset, keyword_dataset, config, progress):
     eval_gold_tri_num, eval_pred_tri_num, eval_match_tri_num = 0, 0, 0
     eval_gold_arg_num, eval_pred_arg_num, eval_match_arg_id, eval_match_arg_cls = 0, 0, 0, 0
     
-    for batch_idx, (batch, keyword_batch) in enumerate(zip(DataLoader(dataset, batch_size=config.eval_batch_size, 
-                                                shuffle=False, collate_fn=dataset.collate_fn),
-                                            DataLoader(keyword_dataset, batch_size=config.eval_batch_size, 
-                                                shuffle=False, collate_fn=keyword_dataset.collate_fn))):
+    for batch_idx, (batch, keyword_batch) in enumerate(zip(DataLoader(shard(dataset), batch_size=config.eval_batch_size, 
+                                                shuffle=False, collate_fn=profiler.wrap(dataset.collate_fn, 'eval/collate')),
+                                            DataLoader(shard(keyword_dataset), batch_size=config.eval_batch_size, 
+                                                shuffle=False, collate_fn=profiler.wrap(keyword_dataset.collate_fn, 'eval/collate')))):
         progress.update(1)
-        keyword_pred_text = model.predict(keyword_batch, num_beams=config.beam_size, max_length=config.max_output_length)
+        with profiler.timer('eval/generate'):
+            with autocast(device, precision):
+                keyword_pred_text = model.predict(keyword_batch, num_beams=config.beam_size, max_length=config.max_output_length)
+        profiler.count('eval/generate/examples', len(keyword_batch.input_text))
+        profiler.count('eval/generate/tokens', keyword_batch.enc_idxs.numel())
         keyword_gold_text = keyword_batch.target_text
         keyword_input_text = keyword_batch.input_text
         keyword_pred_objects = []
@@ -109,11 +247,13 @@ def evaluation(model, dataset, keyword_dataset, config, progress):
             template = theclass(config.input_style, config.output_style, info[2], info[1], info[0])
             
             # decode predictions
-            pred_object = template.decode_keywords(p_text)
+            with profiler.timer('eval/decode'):
+                pred_object = template.decode_keywords(p_text)
             keyword_pred_objects.append(pred_object)
             
             # calculate scores
-            sub_scores = template.evaluate_keywords(pred_object)
+            with profiler.timer('eval/score'):
+                sub_scores = template.evaluate_keywords(pred_object)
             eval_gold_key_num += sub_scores['gold_num']
             eval_pred_key_num += sub_scores['pred_num']
             eval_match_key_num += sub_scores['match_num']
@@ -127,7 +267,11 @@ def evaluation(model, dataset, keyword_dataset, config, progress):
                 # 'gold info': keyword_info
             })
 
-        pred_text = model.predict(batch, num_beams=config.beam_size, max_length=config.max_output_length)
+        with profiler.timer('eval/generate'):
+            with autocast(device, precision):
+                pred_text = model.predict(batch, num_beams=config.beam_size, max_length=config.max_output_length)
+        profiler.count('eval/generate/examples', len(batch.input_text))
+        profiler.count('eval/generate/tokens', batch.enc_idxs.numel())
         gold_text = batch.target_text
         input_text = batch.input_text
         for i_text, g_text, p_text, info in zip(input_text, gold_text, pred_text, batch.infos):
@@ -136,11 +280,13 @@ def evaluation(model, dataset, keyword_dataset, config, progress):
             template = theclass(config.input_style, config.output_style, info[2], info[1], info[0])
             
             # decode predictions
-            pred_object = template.decode(p_text)
+            with profiler.timer('eval/decode'):
+                pred_object = template.decode(p_text)
             gold_object = template.trigger_span + [_ for _ in template.get_converted_gold()]
             
             # calculate scores
-            sub_scores = template.evaluate(pred_object)
+            with profiler.timer('eval/score'):
+                sub_scores = template.evaluate(pred_object)
             eval_gold_tri_num += sub_scores['gold_tri_num']
             eval_pred_tri_num += sub_scores['pred_tri_num']
             eval_match_tri_num += sub_scores['match_tri_num']
@@ -158,6 +304,20 @@ def evaluation(model, dataset, keyword_dataset, config, progress):
                 'gold events': info[0]
             })
     
+    # sum the counts of all processes, and collect the outputs in the order of the dataset
+    if distributed:
+        counts = torch.tensor([eval_gold_key_num, eval_pred_key_num, eval_match_key_num,
+                               eval_gold_tri_num, eval_pred_tri_num, eval_match_tri_num,
+                               eval_gold_arg_num, eval_pred_arg_num, eval_match_arg_id, eval_match_arg_cls], dtype=torch.long, device=device)
+        dist.all_reduce(counts)
+        (eval_gold_key_num, eval_pred_key_num, eval_match_key_num,
+         eval_gold_tri_num, eval_pred_tri_num, eval_match_tri_num,
+         eval_gold_arg_num, eval_pred_arg_num, eval_match_arg_id, eval_match_arg_cls) = counts.tolist()
+        outputs = [None] * world_size
+        dist.all_gather_object(outputs, (write_output, keyword_write_output))
+        write_output = [x for output, _ in outputs for x in output]
+        keyword_write_output = [x for _, output in outputs for x in output]
+
     eval_scores = {
         'keyword_id': compute_f1(eval_pred_key_num, eval_gold_key_num, eval_match_key_num),
         'tri_id': compute_f1(eval_pred_tri_num, eval_gold_tri_num, eval_match_tri_num),
@@ -186,6 +346,52 @@ def evaluation(model, dataset, keyword_dataset, config, progress):
     return eval_scores, write_output, keyword_write_output
 
 
+def negative_losses(model, data_set, sampler, config):
+    """Loss of every negative of `data_set` (dataset index -> loss), every process scores its part of them."""
+    candidates = [i for group in sampler.negatives for i in group]
+    candidates = candidates[rank::world_size]
+    losses = []
+    for start in range(0, len(candidates), config.eval_batch_size):
+        indices = candidates[start:start+config.eval_batch_size]
+        with profiler.timer('train/mine/collate'):
+            batch = data_set.collate_fn([data_set[i] for i in indices])
+        with profiler.timer('train/mine/forward'), autocast(device, precision):
+            losses.extend(model.example_losses(batch).float().tolist())
+        profiler.count('train/mine/forward/examples', len(indices))
+    losses = dict(zip(candidates, losses))
+    if distributed:
+        outputs = [None] * world_size
+        dist.all_gather_object(outputs, losses)
+        losses = {i: loss for output in outputs for i, loss in output.items()}
+    return losses
+
+def mine_hard_negatives(model, dataset, keyword_dataset, sampler, keyword_sampler, config):
+    """
+    Score every negative of the training data with a forward pass of the current model and draw
+    the next negatives by their loss. When example i of the EE and keyword data is the same
+    sentence and event type for every i, a negative is scored by its EE plus keyword loss and
+    both samplers, which draw with the same seed, keep drawing the same pairs. Otherwise (e.g.
+    artifacts of earlier versions) the EE and keyword negatives are drawn by their own loss.
+    """
+    model.eval()
+    with torch.no_grad():
+        hardness = negative_losses(model, dataset, sampler, config)
+        keyword_hardness = negative_losses(model, keyword_dataset, keyword_sampler, config)
+    model.train()
+
+    if dataset.pairs_with(keyword_dataset):
+        hardness = {i: loss + keyword_hardness[i] for i, loss in hardness.items()}
+        keyword_hardness = hardness
+    else:
+        logger.info('The EE and keyword examples are not paired, their negatives are mined separately')
+    sampler.set_hardness(hardness, hard_negative_uniform)
+    keyword_sampler.set_hardness(keyword_hardness, hard_negative_uniform)
+    
+    if hardness:
+        values = sorted(hardness.values())
+        logger.info('Mined {} negatives, loss mean {:.4f}, median {:.4f}, 90th percentile {:.4f}'.format(
+            len(values), sum(values) / len(values), values[len(values) // 2], values[int(len(values) * 0.9)]))
+
 
 # start training
 logger.info("Start training ...")
@@ -196,43 +402,73 @@ best_dev_scores = {
     'arg_id': (0.0, 0.0, 0.0),
     'arg_cls': (0.0, 0.0, 0.0)
 }
+score_history = []
 for epoch in range(1, config.max_epoch+1):
     logger.info(log_path)
     logger.info(f"Epoch {epoch}")
     
+    # hard negatives of this epoch, mined with the model of the previous ones
+    if hard_negative_interval and epoch > 1 and (epoch - 1) % hard_negative_interval == 0:
+        with profiler.timer('train/mine'):
+            mine_hard_negatives(model, train_set, keyword_train_set, train_sampler, keyword_train_sampler, config)
+    
     # training
-    progress = tqdm.tqdm(total=train_batch_num, ncols=75, desc='Train {}'.format(epoch))
+    progress = tqdm.tqdm(total=epoch_batch_num(epoch), ncols=75, desc='Train {}'.format(epoch), disable=not is_main)
     model.train()
     optimizer.zero_grad()
-    for batch_idx, (batch, keyword_batch) in enumerate(zip(DataLoader(train_set, batch_size=config.train_batch_size // config.accumulate_step, 
-                                                 shuffle=True, drop_last=False, collate_fn=train_set.collate_fn), 
-                                          DataLoader(keyword_train_set, batch_size=config.train_batch_size // config.accumulate_step, 
-                                                 shuffle=True, drop_last=False, collate_fn=keyword_train_set.collate_fn))):        
+    step_start = time.perf_counter()
+    train_sampler.set_epoch(epoch)
+    keyword_train_sampler.set_epoch(epoch)
+    for batch_idx, (batch, keyword_batch) in enumerate(zip(DataLoader(train_set, batch_size=config.train_batch_size // world_size // config.accumulate_step, 
+                                                 sampler=train_sampler, drop_last=False, collate_fn=profiler.wrap(train_set.collate_fn, 'train/collate')), 
+                                          DataLoader(keyword_train_set, batch_size=config.train_batch_size // world_size // config.accumulate_step, 
+                                                 sampler=keyword_train_sampler, drop_last=False, collate_fn=profiler.wrap(keyword_train_set.collate_fn, 'train/collate')))):        
+        # gradients are only synchronized on the last micro-batch of an accumulation
+        # (DDP records a static graph in the first iteration, which has to synchronize)
+        skip_sync = distributed and (batch_idx + 1) % config.accumulate_step != 0 and not (static_graph and epoch == 1 and batch_idx == 0)
+        sync_context = lambda: ddp_model.no_sync() if skip_sync else nullcontext()
+
         # forard model        
-        ee_loss = model(batch)
-        keyword_loss = model(keyword_batch)
-        loss = ee_loss + keyword_loss
+        with sync_context(), profiler.timer('train/forward'), autocast(device, precision):
+            loss = ddp_model(batch, keyword_batch)
+        profiler.count('train/forward/examples', len(batch.input_text) + len(keyword_batch.input_text))
+        profiler.count('train/forward/tokens', batch.enc_idxs.numel() + batch.dec_idxs.numel() + keyword_batch.enc_idxs.numel() + keyword_batch.dec_idxs.numel())
         
         # record loss
-        summarizer.scalar_summary('train/loss', loss, summarizer_step)
+        metrics.add('train/loss', loss)
         summarizer_step += 1
         
         loss = loss * (1 / config.accumulate_step)
-        loss.backward()
+        with sync_context(), profiler.timer('train/backward'):
+            scaler.scale(loss).backward()
 
         if (batch_idx + 1) % config.accumulate_step == 0:
             progress.update(1)
-            torch.nn.utils.clip_grad_norm_(model.parameters(), config.grad_clipping)
-            optimizer.step()
-            schedule.step()
-            optimizer.zero_grad()
+            with profiler.timer('train/optimizer'):
+                scaler.unscale_(optimizer)
+                grad_norm = torch.nn.utils.clip_grad_norm_(model.parameters(), config.grad_clipping)
+                metrics.add('train/lr', schedule.get_last_lr()[0])
+                scaler.step(optimizer)
+                scaler.update()
+                schedule.step()
+                optimizer.zero_grad()
+            metrics.add('train/grad_norm', grad_norm)
+            step_end = time.perf_counter()
+            metrics.add('train/step_time', step_end - step_start)
+            step_start = step_end
+
+        metrics.step(summarizer_step)
+        if summarizer_step % profile_interval == 0:
+            profiler.write_summary(summarizer, summarizer_step)
+    metrics.flush(summarizer_step)
     progress.close()
 
     # eval dev set
     best_dev_flag = False
-    progress = tqdm.tqdm(total=dev_batch_num, ncols=75, desc='Dev {}'.format(epoch))
+    progress = tqdm.tqdm(total=dev_batch_num, ncols=75, desc='Dev {}'.format(epoch), disable=not is_main)
     dev_scores, write_output, keyword_write_output = evaluation(model, dev_set, keyword_dev_set, config, progress)
     progress.close()
+    profiler.write_summary(summarizer, summarizer_step)
         
     # check best dev model
     if dev_scores['arg_cls'][2] > best_dev_scores['arg_cls'][2]:
@@ -245,31 +481,46 @@ for epoch in range(1, config.max_epoch+1):
         best_dev_epoch = epoch
         
         # save best model
-        logger.info('Saving best model')
-        torch.save(model.state_dict(), best_model_path)
+        if is_main:
+            logger.info('Saving best model')
+            torch.save(model.state_dict(), best_model_path)
         
-        # save dev result
-        with open(dev_prediction_path, 'w') as fp:
-            json.dump(write_output, fp, indent=4)
-        with open(dev_keyword_prediction_path, 'w') as fp:
-            json.dump(keyword_write_output, fp, indent=4)
+            # save dev result
+            with open(dev_prediction_path, 'w') as fp:
+                json.dump(write_output, fp, indent=4)
+            with open(dev_keyword_prediction_path, 'w') as fp:
+                json.dump(keyword_write_output, fp, indent=4)
 
         # eval test set
-        progress = tqdm.tqdm(total=test_batch_num, ncols=75, desc='Test {}'.format(epoch))
+        progress = tqdm.tqdm(total=test_batch_num, ncols=75, desc='Test {}'.format(epoch), disable=not is_main)
         test_scores, write_output, keyword_write_output = evaluation(model, test_set, keyword_test_set, config, progress)
         progress.close()
+        profiler.write_summary(summarizer, summarizer_step)
         
         # save test result
-        with open(test_prediction_path, 'w') as fp:
-            json.dump(write_output, fp, indent=4)
-        with open(test_keyword_prediction_path, 'w') as fp:
-            json.dump(keyword_write_output, fp, indent=4)
+        if is_main:
+            with open(test_prediction_path, 'w') as fp:
+                json.dump(write_output, fp, indent=4)
+            with open(test_keyword_prediction_path, 'w') as fp:
+                json.dump(keyword_write_output, fp, indent=4)
             
+    score_history.append({"epoch": epoch, "dev_scores": dev_scores, "test_scores": test_scores})
+    if is_main:
+        with open(scores_path, 'w') as fp:
+            # `finished` tells keyee/sweep.py that the run was not interrupted
+            json.dump({"best_epoch": best_dev_epoch, "best_scores": best_dev_scores, "history": score_history,
+                       "finished": epoch == config.max_epoch}, fp, indent=4)
+    
     logger.info({"epoch": epoch, "dev_scores": dev_scores})
     if best_dev_flag:
         logger.info({"epoch": epoch, "test_scores": test_scores})
     logger.info("Current best")
     logger.info({"best_epoch": best_dev_epoch, "best_scores": best_dev_scores})
+    profiler.dump(profile_path)
         
+metrics.close(summarizer_step)
+profiler.log(logger)
 logger.info(log_path)
-logger.info("Done!")
\ No newline at end of file
+logger.info("Done!")
+if distributed:
+    dist.destroy_process_group()
\ No newline at end of file
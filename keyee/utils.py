@@ -1,5 +1,11 @@
+import json
+import time
+import queue
+import threading
 import torch
 import unicodedata
+from collections import Counter, defaultdict
+from contextlib import contextmanager, nullcontext
 from tensorboardX import SummaryWriter
 from typing import (
     Any,
@@ -28,6 +34,189 @@ class Summarizer(object):
         self.writer.add_text(tag, value, step)
 
 
+class MetricsSink(object):
+    """
+    Buffered scalars for the training loop.
+
+    `add(tag, value)` accumulates sum, max and count of a scalar; tensors stay on their
+    device, so no step waits for a device sync. Every `flush_every` calls of `step`, the
+    aggregates are handed to a background thread, which reads them and writes
+    `<tag>` (mean), `<tag>/max` and `<tag>/count` to the Summarizer.
+    """
+    def __init__(self, summarizer, flush_every=100, enabled=True):
+        self.enabled = enabled
+        self.summarizer = summarizer
+        self.flush_every = max(flush_every, 1)
+        self.sums = {}
+        self.maxes = {}
+        self.counts = Counter()
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._write, daemon=True)
+        if self.enabled:
+            self.thread.start()
+
+    def add(self, tag, value):
+        if not self.enabled:
+            return
+        if isinstance(value, torch.Tensor):
+            value = value.detach().float()
+        if tag in self.sums:
+            self.sums[tag] = self.sums[tag] + value
+            self.maxes[tag] = torch.maximum(self.maxes[tag], value) if isinstance(value, torch.Tensor) else max(self.maxes[tag], value)
+        else:
+            self.sums[tag] = value
+            self.maxes[tag] = value
+        self.counts[tag] += 1
+
+    def step(self, step):
+        if step % self.flush_every == 0:
+            self.flush(step)
+
+    def flush(self, step):
+        if self.counts:
+            self.queue.put((step, self.sums, self.maxes, self.counts))
+            self.sums = {}
+            self.maxes = {}
+            self.counts = Counter()
+
+    def _write(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            step, sums, maxes, counts = item
+            for tag, count in counts.items():
+                self.summarizer.scalar_summary(tag, float(sums[tag]) / count, step)
+                self.summarizer.scalar_summary('{}/max'.format(tag), float(maxes[tag]), step)
+                self.summarizer.scalar_summary('{}/count'.format(tag), count, step)
+
+    def close(self, step):
+        """Write what is left and stop the writer thread."""
+        if not self.enabled:
+            return
+        self.flush(step)
+        self.queue.put(None)
+        self.thread.join()
+
+
+PRECISION_DTYPES = {'fp32': torch.float32, 'fp16': torch.float16, 'bf16': torch.bfloat16}
+
+def check_precision(precision, device):
+    if precision not in PRECISION_DTYPES:
+        raise ConfigurationError(f'Unknown precision {precision}, choose from {list(PRECISION_DTYPES)}')
+    if precision == 'fp16' and device.type != 'cuda':
+        raise ConfigurationError('fp16 needs a GPU, use bf16 on CPU')
+    if precision == 'bf16' and not hasattr(torch, 'autocast'):
+        raise ConfigurationError('bf16 needs torch >= 1.10, use fp16 on GPU')
+
+def autocast(device, precision):
+    """Mixed-precision context for `device`, a no-op for fp32."""
+    if hasattr(torch, 'autocast'):
+        return torch.autocast(device_type=device.type, dtype=PRECISION_DTYPES[precision], enabled=precision != 'fp32')
+    # torch < 1.10 only has fp16 autocast on CUDA, see check_precision
+    return torch.cuda.amp.autocast() if precision == 'fp16' else nullcontext()
+
+def grad_scaler(precision):
+    """Loss scaler of fp16 training, disabled for the other precisions."""
+    if hasattr(torch, 'amp') and hasattr(torch.amp, 'GradScaler'):
+        return torch.amp.GradScaler('cuda', enabled=precision == 'fp16')
+    # torch < 2.3
+    return torch.cuda.amp.GradScaler(enabled=precision == 'fp16')
+
+
+class Profiler(object):
+    """
+    Wall-clock timers and counters for the hot-path stages.
+
+    `timer(stage)` times a block, `count(name, n)` adds to a counter. Counters named
+    `<stage>/examples` or `<stage>/tokens` are turned into throughput of that stage. Stats
+    are kept both for the whole run and for the current window, which `write_summary`
+    reports to TensorBoard and resets every N steps. With `sync_cuda`, CUDA is synchronized
+    before reading the clock, so GPU stages are not under-reported because of async kernels.
+    """
+    def __init__(self, enabled=True, sync_cuda=False):
+        self.enabled = enabled
+        self.sync_cuda = sync_cuda and torch.cuda.is_available()
+        self.times = defaultdict(float)
+        self.calls = Counter()
+        self.counters = Counter()
+        self.window_times = defaultdict(float)
+        self.window_calls = Counter()
+        self.window_counters = Counter()
+
+    @contextmanager
+    def timer(self, stage):
+        if not self.enabled:
+            yield
+            return
+        if self.sync_cuda:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.sync_cuda:
+                torch.cuda.synchronize()
+            elapsed = time.perf_counter() - start
+            self.times[stage] += elapsed
+            self.calls[stage] += 1
+            self.window_times[stage] += elapsed
+            self.window_calls[stage] += 1
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counters[name] += n
+            self.window_counters[name] += n
+
+    def wrap(self, fn, stage):
+        """Time every call of `fn`, e.g. a DataLoader collate_fn."""
+        if not self.enabled:
+            return fn
+        def wrapped(*args, **kwargs):
+            with self.timer(stage):
+                return fn(*args, **kwargs)
+        return wrapped
+
+    @staticmethod
+    def _summary(times, calls, counters):
+        summary = {}
+        for stage in sorted(times):
+            summary[stage] = {'time': times[stage], 'calls': calls[stage], 'avg_time': times[stage] / max(calls[stage], 1)}
+        for name in sorted(counters):
+            stage, _, unit = name.rpartition('/')
+            summary.setdefault(name, {})['count'] = counters[name]
+            if stage in times and times[stage] > 0:
+                summary[name]['{}_per_sec'.format(unit)] = counters[name] / times[stage]
+        return summary
+
+    def summary(self):
+        return self._summary(self.times, self.calls, self.counters)
+
+    def write_summary(self, summarizer, step, prefix='profile'):
+        """Report the stats of the current window to TensorBoard and start a new window."""
+        if not self.enabled:
+            return
+        for name, stats in self._summary(self.window_times, self.window_calls, self.window_counters).items():
+            for key, value in stats.items():
+                summarizer.scalar_summary('{}/{}/{}'.format(prefix, name, key), value, step)
+        self.window_times = defaultdict(float)
+        self.window_calls = Counter()
+        self.window_counters = Counter()
+
+    def dump(self, path):
+        if not self.enabled:
+            return
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=4)
+
+    def log(self, logger):
+        if not self.enabled:
+            return
+        for name, stats in self.summary().items():
+            logger.info('{:30s} {}'.format(name, ', '.join(['{}: {:.4f}'.format(k, v) if isinstance(v, float) else '{}: {}'.format(k, v)
+                                                           for k, v in stats.items()])))
+
+
 class ConfigurationError(Exception):
     """
     The exception raised by any AllenNLP object when it's misconfigured
@@ -0,0 +1,33 @@
+"""
+NLP backends of the preprocessing scripts, loaded when a language first needs them.
+
+English is split and tokenized with NLTK, stanza (Chinese and Arabic) and jieba (Chinese)
+are only imported and loaded on first use, once per process, so English runs neither wait
+for stanza models nor need them to be downloaded.
+"""
+from functools import lru_cache
+
+STANZA_LANGUAGES = {'english': 'en', 'chinese': 'zh', 'arabic': 'ar'}
+
+
+@lru_cache(maxsize=None)
+def stanza_pipeline(language: str, processors: str = 'tokenize'):
+    """Returns the stanza pipeline of `language` (english, chinese or arabic).
+
+    Args:
+        language (str): document language.
+        processors (str, optional): stanza processors. Defaults to 'tokenize'.
+    """
+    if language not in STANZA_LANGUAGES:
+        raise ValueError('Unsupported language: {}'.format(language))
+    import stanza
+    return stanza.Pipeline(lang=STANZA_LANGUAGES[language], processors=processors)
+
+
+@lru_cache(maxsize=None)
+def jieba_tokenizer():
+    """Returns the jieba tokenizer with its dictionary loaded."""
+    import jieba
+    tokenizer = jieba.Tokenizer()
+    tokenizer.initialize()
+    return tokenizer
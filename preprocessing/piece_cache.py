@@ -0,0 +1,117 @@
+"""
+Word pieces of every word type, cached per tokenizer.
+
+The conversion scripts tokenize one word at a time, so the pieces of a word only depend on
+the word and the tokenizer. `PieceCache` keeps them per word type, tokenizes the unseen
+types of a file together (in several processes with `workers`) and saves them to
+`cache_dir`, one file per tokenizer, so that later runs and the other scripts only tokenize
+the words they have not seen yet.
+"""
+import os
+import re
+import json
+import tempfile
+from multiprocessing import Pool
+from typing import Iterable, List
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'keyee', 'pieces')
+
+_worker_tokenizer = None
+
+
+def _init_worker(tokenizer):
+    global _worker_tokenizer
+    _worker_tokenizer = tokenizer
+
+
+def _tokenize_words(words: List[str]) -> List[List[str]]:
+    return batch_tokenize(_worker_tokenizer, words)
+
+
+def batch_tokenize(tokenizer, words: List[str]) -> List[List[str]]:
+    """Returns the pieces of every word, as `tokenizer.tokenize(word)` would.
+
+    Fast tokenizers encode all the words in one call, slow ones go word by word.
+    """
+    if getattr(tokenizer, 'is_fast', False):
+        encoded = tokenizer(words, add_special_tokens=False)
+        return [encoded.tokens(i) for i in range(len(words))]
+    return [tokenizer.tokenize(word) for word in words]
+
+
+def tokenizer_info(tokenizer) -> dict:
+    """What the cached pieces depend on, a cache file of another tokenizer is not used."""
+    return {
+        'class': tokenizer.__class__.__name__,
+        'name_or_path': tokenizer.name_or_path,
+        'vocab_size': len(tokenizer),
+        'do_lower_case': getattr(tokenizer, 'do_lower_case', None),
+    }
+
+
+class PieceCache(object):
+    """Cached `tokenizer.tokenize` of single words.
+
+    Args:
+        tokenizer (PreTrainedTokenizer): the tokenizer.
+        cache_dir (str, optional): directory of the cache files, None keeps
+            the pieces in memory only. Defaults to DEFAULT_CACHE_DIR.
+        workers (int, optional): number of processes tokenizing unseen word
+            types. Defaults to 1.
+    """
+    def __init__(self, tokenizer, cache_dir: str = DEFAULT_CACHE_DIR, workers: int = 1):
+        self.tokenizer = tokenizer
+        self.info = tokenizer_info(tokenizer)
+        self.workers = workers
+        self.pieces = {}
+        self.path = None
+        if cache_dir:
+            name = re.sub(r'[^\w.-]+', '_', '{}.{}'.format(self.info['class'], self.info['name_or_path']))
+            self.path = os.path.join(cache_dir, '{}.json'.format(name))
+            self.pieces.update(self.read())
+        self.new_words = 0
+
+    def read(self) -> dict:
+        if self.path is None or not os.path.exists(self.path):
+            return {}
+        with open(self.path, 'r', encoding='utf-8') as r:
+            data = json.load(r)
+        return data['pieces'] if data.get('tokenizer') == self.info else {}
+
+    def update(self, words: Iterable[str]):
+        """Tokenizes the word types of `words` that are not cached yet."""
+        unseen = list(dict.fromkeys(w for w in words if w not in self.pieces))
+        if not unseen:
+            return
+        if self.workers > 1 and len(unseen) >= self.workers * 100:
+            chunk_size = (len(unseen) + self.workers * 4 - 1) // (self.workers * 4)
+            chunks = [unseen[i:i + chunk_size] for i in range(0, len(unseen), chunk_size)]
+            with Pool(self.workers, initializer=_init_worker, initargs=(self.tokenizer,)) as pool:
+                pieces = [p for chunk_pieces in pool.map(_tokenize_words, chunks) for p in chunk_pieces]
+        else:
+            pieces = batch_tokenize(self.tokenizer, unseen)
+        self.pieces.update(zip(unseen, pieces))
+        self.new_words += len(unseen)
+
+    def tokenize(self, words: List[str]) -> List[List[str]]:
+        """Returns the pieces of every word of `words`."""
+        self.update(words)
+        return [self.pieces[w] for w in words]
+
+    def save(self):
+        """Adds the new word types to the cache file.
+
+        The file is read again first, so that runs sharing it keep the words
+        of each other, and replaced at once.
+        """
+        if self.path is None or not self.new_words:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        pieces = self.read()
+        pieces.update(self.pieces)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path), suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as w:
+            json.dump({'tokenizer': self.info, 'pieces': pieces}, w, ensure_ascii=False)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, self.path)
+        self.new_words = 0
@@ -1,6 +1,10 @@
 import json
+from bisect import bisect_right
+from itertools import chain, groupby
+from operator import itemgetter
 from argparse import ArgumentParser
 from transformers import BertTokenizer, RobertaTokenizer, AutoTokenizer
+from piece_cache import PieceCache, DEFAULT_CACHE_DIR
 
 
 def map_index(pieces):
@@ -29,7 +33,26 @@ def map_decode_back_pieces(encoded_input, ori_tokens, tokenizer):
     assert len(pieces) == len(ori_tokens)
     return pieces
 
-def convert(input_file, output_file, tokenizer, window_size_=3):
+def window_mentions(clusters, sent_starts, window_size, window_num):
+    # mentions (cluster index, start, end) of the coreference clusters in every window, in cluster order.
+    # window i holds a mention if sent_starts[i] <= start and end < sent_starts[i + window_size]
+    mentions = [[] for _ in range(window_num)]
+    for j, cluster in enumerate(clusters):
+        for mention in cluster:
+            start, end = mention[0], mention[1]
+            first = bisect_right(sent_starts, end) - window_size
+            last = bisect_right(sent_starts, start) - 1
+            for i in range(max(first, 0), min(last, window_num - 1) + 1):
+                mentions[i].append((j, start, end))
+    return mentions
+
+def convert(input_file, output_file, tokenizer, window_size_=3, piece_cache=None):
+    if piece_cache is None:
+        piece_cache = PieceCache(tokenizer, cache_dir=None)
+    # tokenize all the unseen word types of the file at once
+    with open(input_file, 'r', encoding='utf-8') as r:
+        piece_cache.update(t for line in r for sent in json.loads(line)['sentences'] for t in sent)
+
     with open(input_file, 'r', encoding='utf-8') as r, \
             open(output_file, 'w', encoding='utf-8') as w:
         for line in r:
@@ -50,20 +73,26 @@ def convert(input_file, output_file, tokenizer, window_size_=3):
                 window_size = sent_num
             else:
                 window_size = window_size_
+            window_num = sent_num - window_size + 1
+
+            # every sentence is tokenized and every coreference mention is placed once per document,
+            # the windows are assembled from them
+            sent_pieces = [piece_cache.tokenize(sent) for sent in sentences]
+            sent_token_lens = [[len(p) for p in pieces] for pieces in sent_pieces]
+            sent_pieces = [[p for ps in pieces for p in ps] for pieces in sent_pieces]
+            coref_entity_mentions = window_mentions(coref_entities, sent_starts, window_size, window_num)
+            coref_event_mentions = window_mentions(coref_events, sent_starts, window_size, window_num)
                 
             offset = 0
-            for i in range(sent_num - window_size + 1):
+            for i in range(window_num):
                 wnd_sent_starts = sent_starts[i:i+window_size+1]
-                wnd_start, wnd_end = wnd_sent_starts[0], wnd_sent_starts[-1]
 
                 def slice_fn(lst, ind, wnd): 
-                    return [item for j in range(wnd) for item in lst[ind+j]]
-                wnd_tokens, wnd_entities, wnd_relations, wnd_events = [slice_fn(
-                    lst, i, window_size) for lst in [sentences, entities, relations, events]]
+                    return list(chain.from_iterable(lst[ind:ind+wnd]))
+                wnd_tokens, wnd_entities, wnd_relations, wnd_events, pieces, word_lens = [slice_fn(
+                    lst, i, window_size) for lst in [sentences, entities, relations, events, sent_pieces, sent_token_lens]]
 
                 wnd_id = '{}-{}'.format(doc_id, i)
-                pieces = [tokenizer.tokenize(t) for t in wnd_tokens]
-                word_lens = [len(p) for p in pieces]            
 
                 wnd_entities_ = []
                 wnd_entity_map = {}
@@ -107,11 +136,11 @@ def convert(input_file, output_file, tokenizer, window_size_=3):
                     wnd_relations_.append(relation)
                 
                 # parse coref entities
-                # for each entity mention in a coref, only look up the obj in the dict if they are in the window
-                wnd_coref_ents = [[wnd_entity_map[(ent[0]-offset, ent[1]-offset+1)] for ent in coref if wnd_start <= ent[0]
-                                   and ent[1] < wnd_end and (ent[0]-offset, ent[1]-offset+1) in wnd_entity_map] for coref in coref_entities]
+                # for each entity mention of a coref in the window, only look up the obj in the dict if it is there
                 wnd_coref_ents_ = []
-                for j, ent_list in enumerate(wnd_coref_ents):
+                for j, mentions in groupby(coref_entity_mentions[i], key=itemgetter(0)):
+                    ent_list = [wnd_entity_map[(start-offset, end-offset+1)] for _, start, end in mentions
+                                if (start-offset, end-offset+1) in wnd_entity_map]
                     if len(ent_list) > 1:
                         wnd_coref_ents_.append({
                             'id': '{}-CE{}'.format(wnd_id, j),
@@ -153,11 +182,10 @@ def convert(input_file, output_file, tokenizer, window_size_=3):
                     wnd_event_map[(trigger_start, trigger_end)] = event_obj
 
                 # parse coref events
-                wnd_coref_evts = [[wnd_event_map[(evt[0]-offset, evt[1]-offset+1)]
-                                   for evt in coref if wnd_start <= evt[0] and evt[1] < wnd_end 
-                                   and (evt[0]-offset, evt[1]-offset+1) in wnd_event_map] for coref in coref_events]
                 wnd_coref_evts_ = []
-                for j, evt_list in enumerate(wnd_coref_evts):
+                for j, mentions in groupby(coref_event_mentions[i], key=itemgetter(0)):
+                    evt_list = [wnd_event_map[(start-offset, end-offset+1)] for _, start, end in mentions
+                                if (start-offset, end-offset+1) in wnd_event_map]
                     if len(evt_list) > 1:
                         wnd_coref_evts_.append({
                             'id': '{}-CEV{}'.format(wnd_id, j),
@@ -173,13 +201,14 @@ def convert(input_file, output_file, tokenizer, window_size_=3):
                     'entity_coreference': wnd_coref_ents_,
                     'event_coreference': wnd_coref_evts_,
                     'tokens': wnd_tokens,
-                    'pieces': [p for w in pieces for p in w],
+                    'pieces': pieces,
                     'token_lens': word_lens,
                     'sentence': ' '.join(wnd_tokens),
                     'sentence_starts': [x-offset for x in wnd_sent_starts[:-1]],                  
                 }
                 w.write(json.dumps(wnd_) + '\n')
                 offset += len(sentences[i])
+    piece_cache.save()
 
 
 if __name__ == '__main__':
@@ -188,6 +217,8 @@ if __name__ == '__main__':
     parser.add_argument('-o', '--output', help='Path to the output file')
     parser.add_argument('-b', '--bert', help='BERT model name', default='bert-large-cased')
     parser.add_argument('-w', '--window', default=1, help='Integer for window size', type=int)
+    parser.add_argument('--workers', default=1, type=int, help='Number of processes tokenizing unseen words')
+    parser.add_argument('--piece_cache_dir', default=DEFAULT_CACHE_DIR, help='Path to the word piece cache directory')
     args = parser.parse_args()
     model_name = args.bert
     if model_name.startswith('bert-'):
@@ -199,4 +230,5 @@ if __name__ == '__main__':
     else:
         bert_tokenizer = AutoTokenizer.from_pretrained(args.bert, do_lower_case=False, use_fast=False)
     
-    convert(args.input, args.output, bert_tokenizer, args.window)
\ No newline at end of file
+    piece_cache = PieceCache(bert_tokenizer, args.piece_cache_dir, workers=args.workers)
+    convert(args.input, args.output, bert_tokenizer, args.window, piece_cache=piece_cache)
\ No newline at end of file
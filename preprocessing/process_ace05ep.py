@@ -11,7 +11,9 @@ import json
 import glob
 import tqdm
 import random
+import traceback
 import torch
+from multiprocessing import Pool
 from lxml import etree
 from typing import List, Dict, Any, Tuple
 from bs4 import BeautifulSoup
@@ -24,12 +26,8 @@ from transformers import (BertTokenizer,
                           AutoTokenizer)
 from nltk import (sent_tokenize as sent_tokenize_,
                   wordpunct_tokenize as wordpunct_tokenize_)
-#import jieba                  
-import stanza
-
-#nlp_ar = stanza.Pipeline(lang='ar', processors='tokenize')
-nlp_en = stanza.Pipeline(lang='en', processors='tokenize')
-#nlp_zh = stanza.Pipeline(lang='zh', processors='tokenize')
+from nlp_backends import stanza_pipeline, jieba_tokenizer
+from piece_cache import PieceCache, DEFAULT_CACHE_DIR
 
 TAG_PATTERN = re.compile('<[^<>]+>', re.MULTILINE)
 
@@ -128,10 +126,7 @@ def sent_tokenize(text: Tuple[str, int, int],
     if language == 'english':
         sentences = sent_tokenize_(text, language=language)
     else:
-        if language == 'chinese':
-            doc = nlp_zh(text)
-        elif language == 'arabic':
-            doc = nlp_ar(text)
+        doc = stanza_pipeline(language)(text)
         
         ending_char_idx = [0]
         for sent in doc.sentences:
@@ -1036,7 +1031,7 @@ def tokenize(sentences: List[Tuple[str, int, int]],
         tokens = []
         if language == 'chinese':
             def _tokenize_chinese(text):
-                return [c for c in jieba.cut(text) if c.strip()]
+                return [c for c in jieba_tokenizer().cut(text) if c.strip()]
 
             # tokenize each chunk
             chunks = [(s, e, t, _tokenize_chinese(t))
@@ -1060,10 +1055,7 @@ def tokenize(sentences: List[Tuple[str, int, int]],
         #else:
         elif language == 'arabic':
             for chunk_start, _, t in chunks:
-                if language == 'english':
-                    doc = nlp_en(t)
-                elif language == 'arabic':
-                    doc = nlp_ar(t)
+                doc = stanza_pipeline(language)(t)
                 for sent in doc.sentences:
                     for tok in sent.tokens:
                         if tok.text != '':
@@ -1203,13 +1195,39 @@ def convert(sgm_file: str,
     return Document(doc_id, sentence_objs)
 
 
+def convert_job(job: Tuple[str, bool, str, int]) -> Tuple[str, str, str]:
+    """Converts one document of `convert_batch`, in a worker process or not.
+
+    Args:
+        job (Tuple[str, bool, str, int]): SGM file path, time_and_val, language
+            and window size.
+
+    Returns:
+        Tuple[str, str, str]: the SGM file path, the JSON line of the document
+        (None if it is skipped or fails) and the error traceback (None if it
+        does not fail).
+    """
+    sgm_file, time_and_val, language, window_size = job
+    apf_file = sgm_file.replace('.sgm', '.apf.xml')
+    try:
+        doc = convert(sgm_file, apf_file, time_and_val=time_and_val,
+                      language=language, window_size=window_size)
+    except Exception:
+        return sgm_file, None, traceback.format_exc()
+    return sgm_file, json.dumps(doc.to_dict()) if doc else None, None
+
+
 def convert_batch(input_path: str,
                   output_path: str,
                   time_and_val: bool = False,
                   language: str = 'english',
-                  window_size: int = 1):
+                  window_size: int = 1,
+                  workers: int = 1):
     """Converts a batch of documents.
 
+    Documents that fail to convert are reported and skipped, the others are
+    written in the order of the SGM files, also with several workers.
+
     Args:
         input_path (str): path to the input directory. Usually, it is the path 
             to the LDC2006T06/data/English or LDC2006T06/data/Chinese folder.
@@ -1218,6 +1236,7 @@ def convert_batch(input_path: str,
             Defaults to False.
         language (str, optional): document language. Available options: english,
             chinese, arabic. Defaults to 'english'.
+        workers (int, optional): number of worker processes. Defaults to 1.
     """
     if language == 'english':
         sgm_files = glob.glob(os.path.join(
@@ -1230,16 +1249,27 @@ def convert_batch(input_path: str,
     print(input_path)
     print('Converting the dataset to JSON format')
     print('#SGM files: {}'.format(len(sgm_files)))
+    jobs = [(sgm_file, time_and_val, language, window_size) for sgm_file in sgm_files]
+    pool = Pool(workers) if workers > 1 else None
+    results = pool.imap(convert_job, jobs) if pool else map(convert_job, jobs)
+    failed = []
     progress = tqdm.tqdm(total=len(sgm_files))
     with open(output_path, 'w', encoding='utf-8') as w:
-        for sgm_file in sgm_files:
+        for sgm_file, line, error in results:
             progress.update(1)
-            apf_file = sgm_file.replace('.sgm', '.apf.xml')
-            doc = convert(sgm_file, apf_file, time_and_val=time_and_val,
-                          language=language, window_size=window_size)
-            if doc:
-                w.write(json.dumps(doc.to_dict()) + '\n')
+            if error:
+                failed.append((sgm_file, error))
+            elif line:
+                w.write(line + '\n')
     progress.close()
+    if pool:
+        pool.close()
+        pool.join()
+    if failed:
+        print('Failed to convert {} documents:'.format(len(failed)))
+        for sgm_file, error in failed:
+            print(sgm_file)
+            print(error)
 
 
 def strQ2B(ustring):
@@ -1290,15 +1320,24 @@ def map_decode_back_pieces(encoded_input, ori_tokens, tokenizer):
 def convert_to_oneie(input_path: str,
                      output_path: str,
                      language: str,
-                     tokenizer: PreTrainedTokenizer):
+                     tokenizer: PreTrainedTokenizer,
+                     piece_cache: PieceCache = None):
     """Converts files to OneIE format.
 
     Args:
         input_path (str): path to the input file.
         output_path (str): path to the output file.
         tokenizer (PreTrainedTokenizer): wordpiece tokenizer.
+        piece_cache (PieceCache, optional): cached pieces of the word types
+            of `tokenizer`. Defaults to an in-memory cache.
     """
     print('Converting the dataset to OneIE format')
+    if piece_cache is None:
+        piece_cache = PieceCache(tokenizer, cache_dir=None)
+    # tokenize all the unseen word types of the file at once
+    with open(input_path, 'r', encoding='utf-8') as r:
+        piece_cache.update(t for line in r for sentence in json.loads(line)['sentences']
+                           for t in sentence['tokens'])
     skip_num = 0
     with open(input_path, 'r', encoding='utf-8') as r, \
             open(output_path, 'w', encoding='utf-8') as w:
@@ -1312,7 +1351,7 @@ def convert_to_oneie(input_path: str,
                                               add_special_tokens=False)
                     pieces = map_decode_back_pieces(encoded_input, tokens, tokenizer)
                 else:
-                    pieces = [tokenizer.tokenize(t) for t in tokens]
+                    pieces = piece_cache.tokenize(tokens)
                 token_lens = [len(x) for x in pieces]
                 if 0 in token_lens:
                     skip_num += 1
@@ -1449,6 +1488,7 @@ def convert_to_oneie(input_path: str,
                 }
                 w.write(json.dumps(sent_obj) + '\n')
     print('skip num: {}'.format(skip_num))
+    piece_cache.save()
 
 
 def split_data(input_file: str,
@@ -1513,6 +1553,10 @@ if __name__ == '__main__':
     parser.add_argument('--time_and_val', action='store_true',
                         help='Extracts times and values')
     parser.add_argument('-w', '--window', default=1, help='Integer for window size', type=int)
+    parser.add_argument('--workers', default=1, type=int,
+                        help='Number of processes converting the documents')
+    parser.add_argument('--piece_cache_dir', default=DEFAULT_CACHE_DIR,
+                        help='Path to the word piece cache directory')
 
     args = parser.parse_args()
     if args.lang not in ['chinese', 'english', 'arabic']:
@@ -1548,11 +1592,12 @@ if __name__ == '__main__':
         # Convert to doc-level JSON format
         json_path = os.path.join(args.output, '{}.{}.json'.format(args.lang, f_size))
         convert_batch(input_dir, json_path, time_and_val=args.time_and_val,
-                      language=args.lang, window_size=args.window)
+                      language=args.lang, window_size=args.window, workers=args.workers)
 
         # Convert to OneIE format
         oneie_path = os.path.join(args.output, '{}.{}.oneie.json'.format(args.lang, f_size))
-        convert_to_oneie(json_path, oneie_path, args.lang, tokenizer=tokenizer)
+        piece_cache = PieceCache(tokenizer, args.piece_cache_dir, workers=args.workers)
+        convert_to_oneie(json_path, oneie_path, args.lang, tokenizer=tokenizer, piece_cache=piece_cache)
 
         # Split the data
         if args.split:
@@ -3,6 +3,8 @@ import re
 import json
 import glob
 import random
+import traceback
+from multiprocessing import Pool
 from lxml import etree
 from bs4 import BeautifulSoup
 from dataclasses import dataclass
@@ -13,6 +15,7 @@ from transformers import (BertTokenizer, RobertaTokenizer,
                           XLMRobertaTokenizer, PreTrainedTokenizer,
                           AutoTokenizer)
 from argparse import ArgumentParser, Namespace
+from piece_cache import PieceCache, DEFAULT_CACHE_DIR
 
 
 ERE_V1 = 'LDC2015E29_DEFT_Rich_ERE_English_Training_Annotation_V1'
@@ -1324,14 +1327,37 @@ def extract(source_path: str,
     return Document(doc_id=doc_id, sentences=sentence_objs)
 
 
-def process_batch(input_dir, output_file, window_size=1, dataset='normal', language='english'):
+def extract_job(job: Tuple[str, str, str, int, str]) -> Tuple[str, List[str], str]:
+    """Extracts one document of `process_batch`, in a worker process or not.
+
+    Args:
+        job (Tuple[str, str, str, int, str]): source file path, annotation file
+            path, document ID, window size and language.
+
+    Returns:
+        Tuple[str, List[str], str]: the source file path, the JSON lines of the
+        sentences and the error traceback (None if it does not fail).
+    """
+    source_file, annotation_file, doc_id, window_size, language = job
+    try:
+        doc = extract(source_file, annotation_file, doc_id, window_size, language)
+    except Exception:
+        return source_file, [], traceback.format_exc()
+    return source_file, [json.dumps(sent.to_dict()) for sent in doc.sentences], None
+
+
+def process_batch(input_dir, output_file, window_size=1, dataset='normal', language='english', workers=1):
     """Processes a batch of documents.
 
+    Documents that fail to be extracted are reported and skipped, the others
+    are written in the order of the source files, also with several workers.
+
     Args:
         input_dir (str): path to the input directory.
         output_file (str): path to the output file.
         dataset (str, optional): dataset type. Defaults to 'normal'.
         language (str, optional): dataset language. Defaults to 'english'.
+        workers (int, optional): number of worker processes. Defaults to 1.
     """
     if dataset == 'normal':
         source_files = glob.glob(
@@ -1347,30 +1373,47 @@ def process_batch(input_dir, output_file, window_size=1, dataset='normal', langu
     else:
         raise ValueError('Unknown dataset type: {}'.format(dataset))
 
+    jobs = []
+    for source_file in source_files:
+        doc_id = os.path.basename(source_file).replace('.txt', '') \
+            .replace('.cmp', '').replace('.mp', '')
+        if dataset == 'normal':
+            annotation_file = os.path.join(input_dir, 'ere', 'cmptxt',
+                                           '{}.rich_ere.xml'.format(doc_id))
+        elif dataset == 'r2v2':
+            annotation_file = os.path.join(input_dir, 'ere',
+                                           '{}.rich_ere.xml'.format(doc_id))
+        elif dataset == 'parallel':
+            annotation_file = os.path.join(input_dir, 'eng', 'ere',
+                                           '{}.rich_ere.xml'.format(doc_id))
+        elif dataset == 'spanish':
+            annotation_file = (source_file.replace('/source/', '/ere/')
+                               .replace('.txt', '.rich_ere.xml'))
+        jobs.append((source_file, annotation_file, doc_id, window_size, language))
+
+    pool = Pool(workers) if workers > 1 else None
+    results = pool.imap(extract_job, jobs) if pool else map(extract_job, jobs)
+    failed = []
     with open(output_file, 'w', encoding='utf-8') as w:
-        for source_file in source_files:
-            doc_id = os.path.basename(source_file).replace('.txt', '') \
-                .replace('.cmp', '').replace('.mp', '')
-            if dataset == 'normal':
-                annotation_file = os.path.join(input_dir, 'ere', 'cmptxt',
-                                               '{}.rich_ere.xml'.format(doc_id))
-            elif dataset == 'r2v2':
-                annotation_file = os.path.join(input_dir, 'ere',
-                                               '{}.rich_ere.xml'.format(doc_id))
-            elif dataset == 'parallel':
-                annotation_file = os.path.join(input_dir, 'eng', 'ere',
-                                               '{}.rich_ere.xml'.format(doc_id))
-            elif dataset == 'spanish':
-                annotation_file = (source_file.replace('/source/', '/ere/')
-                                   .replace('.txt', '.rich_ere.xml'))
-            doc = extract(source_file, annotation_file, doc_id, window_size, language)
-            for sent in doc.sentences:
-                w.write(json.dumps(sent.to_dict()) + '\n')
+        for source_file, lines, error in results:
+            if error:
+                failed.append((source_file, error))
+            for line in lines:
+                w.write(line + '\n')
+    if pool:
+        pool.close()
+        pool.join()
+    if failed:
+        print('Failed to extract {} documents:'.format(len(failed)))
+        for source_file, error in failed:
+            print(source_file)
+            print(error)
 
 
 def ere_to_oneie(input_file: str,
                  output_file: str,
-                 tokenizer: PreTrainedTokenizer):
+                 tokenizer: PreTrainedTokenizer,
+                 piece_cache: PieceCache = None):
     """Converts to OneIE format.
 
     Args:
@@ -1378,7 +1421,14 @@ def ere_to_oneie(input_file: str,
         output_file (str): path to the output file.
         tokenizer (PreTrainedTokenizer): a tokenizer that converts tokens to
             word pieces.
+        piece_cache (PieceCache, optional): cached pieces of the word types
+            of `tokenizer`. Defaults to an in-memory cache.
     """
+    if piece_cache is None:
+        piece_cache = PieceCache(tokenizer, cache_dir=None)
+    # tokenize all the unseen word types of the file at once
+    with open(input_file, 'r', encoding='utf-8') as r:
+        piece_cache.update(t for line in r for t in json.loads(line)['tokens'])
     skip_num = 0
     with open(input_file, 'r', encoding='utf-8') as r, \
         open(output_file, 'w', encoding='utf-8') as w:
@@ -1386,7 +1436,7 @@ def ere_to_oneie(input_file: str,
             inst = json.loads(line)
             # tokens
             tokens = inst['tokens']
-            pieces = [tokenizer.tokenize(t) for t in tokens]
+            pieces = piece_cache.tokenize(tokens)
             token_lens = [len(x) for x in pieces]
             if 0 in token_lens:
                 skip_num += 1
@@ -1504,6 +1554,7 @@ def ere_to_oneie(input_file: str,
                 'sentence_starts': inst['sentence_starts'][:-1]
             }) + '\n')
     print('#Skip: {}'.format(skip_num))
+    piece_cache.save()
 
 
 def split_data(input_file, output_dir, split_path):
@@ -1578,6 +1629,10 @@ def parse_arguments() -> Namespace:
                         help='Path to the split folder')
 
     parser.add_argument('-w', '--window', default=1, help='Integer for window size', type=int)
+    parser.add_argument('--workers', default=1, type=int,
+                        help='Number of processes extracting the documents')
+    parser.add_argument('--piece_cache_dir', default=DEFAULT_CACHE_DIR,
+                        help='Path to the word piece cache directory')
     args = parser.parse_args()
    
     return args
@@ -1611,6 +1666,8 @@ def main():
     else:
         f_size = 'w{}'.format(args.window)
 
+    piece_cache = PieceCache(tokenizer, args.piece_cache_dir, workers=args.workers)
+
     sub_set = [
         ("LDC2015E29_DEFT_Rich_ERE_English_Training_Annotation_V2/data", "normal"),
         ("LDC2015E68_DEFT_Rich_ERE_English_Training_Annotation_R2_V2/data", "r2v2"),
@@ -1626,14 +1683,15 @@ def main():
                     json_path,
                     window_size=args.window,
                     dataset=dataset,
-                    language="english"
+                    language="english",
+                    workers=args.workers
                     )
 
         # Convert to OneIE foramt
         oneie_path = os.path.join(args.output, '{}.{}.{}.oneie.json'.format("english",
                                                                         dataset,
                                                                         f_size))
-        ere_to_oneie(json_path, oneie_path, tokenizer=tokenizer)
+        ere_to_oneie(json_path, oneie_path, tokenizer=tokenizer, piece_cache=piece_cache)
     
     if args.split:
         all_data = []
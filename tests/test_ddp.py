@@ -0,0 +1,63 @@
+import os, sys, json, glob, subprocess
+import pytest
+import torch
+import torch.distributed as dist
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'keyee'))
+
+from synthetic_data import SPECIAL_TOKENS, build_offline_tokenizer, write_corpus
+
+pytestmark = pytest.mark.skipif(not dist.is_available() or not dist.is_gloo_available(), reason='needs the gloo backend')
+
+SPLITS = {'train': 16, 'dev': 4, 'test': 4}
+
+@pytest.fixture(scope='module')
+def work_dir(tmp_path_factory):
+    """A tiny randomly initialized BART and the finetune data of a small synthetic corpus."""
+    from transformers import BartConfig, BartForConditionalGeneration
+
+    work_dir = tmp_path_factory.mktemp('ddp')
+    tokenizer = build_offline_tokenizer(str(work_dir / 'tiny-bart'))
+    model_config = BartConfig(vocab_size=len(tokenizer), d_model=16, max_position_embeddings=1024,
+                              encoder_layers=1, decoder_layers=1, encoder_attention_heads=2, decoder_attention_heads=2,
+                              encoder_ffn_dim=32, decoder_ffn_dim=32, pad_token_id=tokenizer.pad_token_id,
+                              bos_token_id=tokenizer.bos_token_id, eos_token_id=tokenizer.eos_token_id,
+                              decoder_start_token_id=tokenizer.eos_token_id, forced_eos_token_id=None)
+    torch.manual_seed(0)
+    BartForConditionalGeneration(model_config).save_pretrained(str(work_dir / 'tiny-bart'))
+
+    tokenizer.add_tokens(SPECIAL_TOKENS)
+    with open(os.path.join(ROOT, 'config', 'config_keyee_ace05e.json')) as f:
+        config = json.load(f)
+    finetune_dir = work_dir / 'finetune'
+    for i, (split, n_sentences) in enumerate(SPLITS.items()):
+        write_corpus(str(work_dir / f'{split}.oneie.json'), n_sentences, tokenizer, seed=i)
+        config[f'{split}_file'] = str(work_dir / f'{split}.oneie.json')
+        config[f'{split}_finetune_file'] = str(finetune_dir / f'{split}_all.pkl')
+        config[f'keyword_{split}_finetune_file'] = str(finetune_dir / f'{split}_keywords_all.pkl')
+    config.update({'finetune_dir': str(finetune_dir), 'vocab_file': str(finetune_dir / 'vocab.json'),
+                   'output_dir': str(work_dir / 'output'), 'model_name': str(work_dir / 'tiny-bart'),
+                   'cache_dir': str(work_dir), 'gpu_device': -1, 'n_negative': 2, 'max_epoch': 2, 'warmup_epoch': 0,
+                   'train_batch_size': 8, 'eval_batch_size': 8, 'accumulate_step': 2, 'beam_size': 1,
+                   'max_output_length': 16, 'precision': 'fp32', 'memory_budget_mb': None, 'profile': False})
+    with open(work_dir / 'config.json', 'w') as f:
+        json.dump(config, f)
+    subprocess.run([sys.executable, os.path.join(ROOT, 'keyee', 'generate_data.py'), '-c', str(work_dir / 'config.json')],
+                   check=True, capture_output=True)
+    return work_dir
+
+def test_ddp_with_gradient_checkpointing(work_dir):
+    """Two gloo processes train with gradient checkpointing and gradient accumulation."""
+    with open(work_dir / 'config.json') as f:
+        config = json.load(f)
+    config['gradient_checkpointing'] = True
+    with open(work_dir / 'config_checkpointing.json', 'w') as f:
+        json.dump(config, f)
+    result = subprocess.run([sys.executable, '-m', 'torch.distributed.run', '--standalone', '--nproc_per_node', '2',
+                             os.path.join(ROOT, 'keyee', 'train.py'), '-c', str(work_dir / 'config_checkpointing.json')],
+                            cwd=os.path.join(ROOT, 'keyee'), capture_output=True, text=True)
+    assert result.returncode == 0, result.stdout[-3000:] + result.stderr[-3000:]
+    with open(glob.glob(str(work_dir / 'output' / '*' / 'scores.json'))[-1]) as f:
+        scores = json.load(f)
+    assert scores['finished']
@@ -0,0 +1,49 @@
+import os, sys, json, subprocess
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'keyee'))
+
+from dataset import GenDataset, read_header
+from synthetic_data import SPECIAL_TOKENS, build_offline_tokenizer, write_corpus
+
+SPLITS = ['train', 'dev', 'test']
+
+@pytest.fixture(scope='module')
+def finetune_dir(tmp_path_factory):
+    """generate_data.py run on a small synthetic corpus with the offline tokenizer."""
+    work_dir = tmp_path_factory.mktemp('generate_data')
+    tokenizer = build_offline_tokenizer(str(work_dir / 'tokenizer'))
+    tokenizer.add_tokens(SPECIAL_TOKENS)
+    with open(os.path.join(ROOT, 'config', 'config_keyee_ace05e.json')) as f:
+        config = json.load(f)
+    finetune_dir = work_dir / 'finetune'
+    for i, split in enumerate(SPLITS):
+        write_corpus(str(work_dir / f'{split}.oneie.json'), 30, tokenizer, seed=i)
+        config[f'{split}_file'] = str(work_dir / f'{split}.oneie.json')
+        config[f'{split}_finetune_file'] = str(finetune_dir / f'{split}_all.pkl')
+        config[f'keyword_{split}_finetune_file'] = str(finetune_dir / f'{split}_keywords_all.pkl')
+    config.update({'finetune_dir': str(finetune_dir), 'vocab_file': str(finetune_dir / 'vocab.json'),
+                   'model_name': str(work_dir / 'tokenizer'), 'cache_dir': str(work_dir), 'n_negative': 4})
+    with open(work_dir / 'config.json', 'w') as f:
+        json.dump(config, f)
+    subprocess.run([sys.executable, os.path.join(ROOT, 'keyee', 'generate_data.py'), '-c', str(work_dir / 'config.json')],
+                   check=True, capture_output=True)
+    return finetune_dir
+
+@pytest.mark.parametrize('split', SPLITS)
+def test_ee_and_keyword_examples_are_paired(finetune_dir, split):
+    header = read_header(str(finetune_dir / f'{split}_all.pkl'))
+    keyword_header = read_header(str(finetune_dir / f'{split}_keywords_all.pkl'))
+    event_types = [header['event_types'][t] for t in header['event_type']]
+    keyword_event_types = [keyword_header['event_types'][t] for t in keyword_header['event_type']]
+    assert len(event_types) > 0
+    assert event_types == keyword_event_types
+    assert list(header['record']) == list(keyword_header['record'])
+    assert list(header['negative']) == list(keyword_header['negative'])
+
+    data_set = GenDataset(None, 1024, str(finetune_dir / f'{split}_all.pkl'), device='cpu')
+    keyword_set = GenDataset(None, 1024, str(finetune_dir / f'{split}_keywords_all.pkl'), device='cpu')
+    assert data_set.pairs_with(keyword_set)
+    assert not data_set.pairs_with(GenDataset(None, 1024, str(finetune_dir / f'{split}_keywords_all.pkl'),
+                                              unseen_types=[event_types[0]], device='cpu'))
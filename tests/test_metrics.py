@@ -0,0 +1,31 @@
+import os, sys
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'keyee'))
+
+from metrics import METRICS, paired_bootstrap_test
+
+def random_counts(rng, sentence_num=200):
+    """Per-sentence (gold, pred, match) counts of every metric."""
+    gold = rng.integers(0, 4, size=(sentence_num, len(METRICS)))
+    pred = rng.integers(0, 4, size=(sentence_num, len(METRICS)))
+    match = np.minimum(gold, pred) * rng.integers(0, 2, size=(sentence_num, len(METRICS)))
+    return np.stack([gold, pred, match], axis=-1)
+
+def test_paired_bootstrap_identical_systems():
+    counts = random_counts(np.random.default_rng(0))
+    result = paired_bootstrap_test(counts, counts.copy(), n_samples=1000)
+    for metric in METRICS:
+        assert result[metric] == (0.0, 1.0)
+
+def test_paired_bootstrap_direction():
+    rng = np.random.default_rng(0)
+    counts_b = random_counts(rng)
+    counts_a = counts_b.copy()
+    counts_a[..., 2] = np.minimum(counts_a[..., 0], counts_a[..., 1])
+    better = paired_bootstrap_test(counts_a, counts_b, n_samples=1000)
+    worse = paired_bootstrap_test(counts_b, counts_a, n_samples=1000)
+    for metric in METRICS:
+        assert better[metric][0] > 0 and better[metric][1] < 0.05
+        assert worse[metric][0] == -better[metric][0]
+        assert worse[metric][1] == better[metric][1]